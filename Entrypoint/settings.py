@@ -127,3 +127,103 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 INFURA_URL = "<HTTP URL>"
+
+# JSON-RPC endpoints shared by the whole process, the fastest healthy one is used and the others
+# take over when it fails or falls behind. Defaults to INFURA_URL alone
+RPC_ENDPOINTS = []
+# Requests per second allowed across all endpoints, a batch counts as one request per call; None disables the limit
+RPC_REQUESTS_PER_SECOND = 10
+# Number of requests that may be sent at once before the rate limit kicks in
+RPC_BURST = 20
+# Number of times a failed request is retried, on another endpoint if there is one
+RPC_MAX_RETRIES = 3
+# Seconds to wait for an endpoint to answer
+RPC_TIMEOUT = 10
+# Keep-alive connections kept open to each endpoint
+RPC_POOL_SIZE = 10
+# Every how many seconds the head of every endpoint is requested, so that one that stalled is avoided (None to disable)
+RPC_HEAD_PROBE_INTERVAL = 30
+
+# Local file caching the responses about finalized blocks (blocks, receipts, logs) and token metadata,
+# so that backfills and restarts don't fetch them from the provider again; None disables the cache
+CHAIN_CACHE_PATH = BASE_DIR / 'chain_cache.sqlite'
+# Size of the cache file after which the least recently used responses are evicted
+CHAIN_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Blocks at least this deep below the head are considered final and cached
+CHAIN_CACHE_CONFIRMATIONS = 6
+
+# Number of worker threads used to process confirmed block ranges, both by the
+# `backfill` command and when catching up from the last checkpoint after a restart
+BACKFILL_WORKERS = 4
+
+# Number of blocks requested in a single JSON-RPC batch when catching up
+BLOCK_BATCH_SIZE = 20
+
+# Fetch block headers first, and download the transactions only of the blocks whose logs bloom may hold one of our
+# token transfers. Plain ETH transfers aren't in the bloom, so this only applies with TRACK_ETH_TRANSACTIONS off
+BLOCK_BLOOM_PREFILTER = False
+
+# How blocks are consumed:
+# - "polling": one block at a time in a thread, with confirmed ranges caught up by `BACKFILL_WORKERS` threads
+# - "pipeline": an asyncio pipeline where fetching, filtering, confirmation tracking and persistence overlap,
+#   with at most `PIPELINE_QUEUE_SIZE` items waiting between two stages
+CONSUMER_MODE = "polling"
+PIPELINE_QUEUE_SIZE = 100
+
+# Whether the web process also starts a consumer. Normally consumers run with `manage.py run_consumer`;
+# either way, only the instance holding the lease of a shard consumes it, and renews the lease every third
+# of CONSUMER_LEASE_DURATION seconds. Watched accounts are split between CONSUMER_SHARDS consumers.
+CONSUMER_AUTOSTART = False
+CONSUMER_LEASE_DURATION = 30
+CONSUMER_SHARDS = 1
+
+# Whether incoming and outgoing ETH transactions are processed, for wallets that only hold tokens
+TRACK_ETH_TRANSACTIONS = True
+
+# How ERC20 transfers are picked up:
+# - "transactions": decode the input of transactions sent to token contracts (only direct `transfer` calls)
+# - "logs": read the `Transfer` events of watched tokens with one `eth_getLogs` request per block range
+ERC20_INGESTION_MODE = "transactions"
+
+# Number of worker processes decoding ERC20 transfer calls in large blocks (0 decodes in the consumer itself),
+# and how many transactions are sent to a worker at once
+ERC20_DECODER_PROCESSES = 0
+ERC20_DECODER_CHUNK_SIZE = 64
+
+# Every how many seconds all account and token balances are refreshed from the chain (None to disable),
+# how many balances are requested per JSON-RPC batch and how many batches can be in flight at once
+BALANCE_RECONCILIATION_INTERVAL = None
+BALANCE_RECONCILIATION_BATCH_SIZE = 100
+BALANCE_RECONCILIATION_WORKERS = 4
+
+# Where balances come from: "rpc" asks the chain for every balance a block changes, "ledger" adds them up
+# from the stored transactions and the last snapshot of each balance, without any request
+BALANCE_MODE = "rpc"
+# In ledger mode, every how many seconds balances are snapshotted (None to disable), so that they're added up
+# from the transactions after the snapshot only. The reconciliation interval above then compares the ledger
+# with the chain, and corrects the balances that drifted
+BALANCE_SNAPSHOT_INTERVAL = None
+
+# BIP39 mnemonic the accounts minted by the `provision_accounts` command are derived from.
+# Anyone holding it controls every derived account, so keep it out of version control
+ACCOUNT_HD_MNEMONIC = None
+# BIP32 path of the node whose children are the derived accounts
+ACCOUNT_HD_PATH = "m/44'/60'/0'/0"
+# Number of processes deriving keys, None for one per CPU
+ACCOUNT_PROVISIONING_PROCESSES = None
+
+# Number of worker processes signing the transactions of large payout batches (0 signs in the web process),
+# and how many transactions are sent to a worker at once
+PAYOUT_SIGNING_PROCESSES = 0
+PAYOUT_SIGNING_CHUNK_SIZE = 100
+
+# The consumer's metrics are served in the Prometheus text format at /metrics/ when it runs inside the web process
+# (CONSUMER_AUTOSTART), and on METRICS_PORT by the run_consumer command (None to disable)
+METRICS_PORT = None
+# Share of the blocks whose handling is profiled with cProfile (0 to disable, e.g. 0.01 for one block in a hundred).
+# Statistics of all the profiled blocks are written to BLOCK_PROFILE_PATH, readable with pstats or snakeviz
+BLOCK_PROFILE_SAMPLE_RATE = 0
+BLOCK_PROFILE_PATH = BASE_DIR / 'block_profile.pstats'
+
+# Rows read from the database per round trip by the transaction exports, and formatted and written at once
+EXPORT_CHUNK_SIZE = 2000
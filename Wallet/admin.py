@@ -1,7 +1,7 @@
 from decimal import Decimal
+from typing import List
 
-from django.conf import settings
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.admin.helpers import ActionForm
 from django.db.models import QuerySet
 from django import forms
@@ -9,6 +9,8 @@ from django.http import HttpRequest
 from web3 import Web3
 
 from Wallet.models import Account, SentTransaction, ReceivedTransaction, validate_public_address, Token
+from Wallet.pagination import KeysetPaginationAdmin
+from Wallet.payouts import Payout, payout_engine
 
 
 @admin.register(Token)
@@ -21,7 +23,7 @@ class AdminToken(admin.ModelAdmin):
 
 
 @admin.register(Account)
-class AdminAccount(admin.ModelAdmin):
+class AdminAccount(KeysetPaginationAdmin):
     readonly_fields = ["public_key", "balance", "erc20_balances"]
     exclude = ["tokens"]
     list_display = ["name", "public_key", "balance"]
@@ -31,60 +33,36 @@ class AdminAccount(admin.ModelAdmin):
         address = forms.CharField(validators=[validate_public_address])
         token = forms.ModelChoiceField(Token.objects.all(), required=False)
 
+    def _pay(self, request: HttpRequest, payouts: List[Payout]):
+        payout_engine().pay(payouts)
+        failed = [payout for payout in payouts if payout.error is not None]
+        if len(failed) < len(payouts):
+            self.message_user(request, f"Sent {len(payouts) - len(failed)} transactions.", messages.SUCCESS)
+        for payout in failed:
+            self.message_user(request, f"{payout.account} couldn't send its transaction: {payout.error}", messages.ERROR)
+
     @admin.action(description="Send ETH to another address")
     def send_eth(self, request: HttpRequest, queryset: QuerySet):
-        for account in queryset:
-            account: Account
-
-            web3_client = Web3(Web3.HTTPProvider(settings.INFURA_URL))
-            # noinspection PyTypeChecker
-            signed_transaction = web3_client.eth.account.sign_transaction(
-                dict(
-                    to=request.POST["address"],
-                    value=Web3.toWei(Decimal(request.POST["amount"]), "ether"),
-                    gas=1000000,
-                    gasPrice=web3_client.eth.gas_price,
-                    nonce=web3_client.eth.get_transaction_count(account.public_key)
-                ),
-                account.private_key.hex()
-            )
-            web3_client.eth.send_raw_transaction(signed_transaction.rawTransaction)
+        amount = Web3.toWei(Decimal(request.POST["amount"]), "ether")
+        self._pay(request, [Payout(account, request.POST["address"], amount) for account in queryset])
 
     @admin.action(description="Send ERC20 to another address")
     def send_erc20(self, request: HttpRequest, queryset: QuerySet):
-        for account in queryset:
-            account: Account
-            web3_client = Web3(Web3.HTTPProvider(settings.INFURA_URL))
-            # noinspection PyTypeChecker
-            token = Token.objects.get(pk=request.POST["token"])
-            # noinspection PyTypeChecker
-            contract = web3_client.eth.contract(
-                address=token.contract_address,
-                abi=token.abi
-            )
-            # noinspection PyTypeChecker
-            signed_transaction = web3_client.eth.account.signTransaction(
-                contract.functions.transfer(
-                    request.POST["address"],
-                    token.to_lowest_denomination(request.POST["amount"])
-                ).buildTransaction({
-                    "gas": 1000000,
-                    "gasPrice": web3_client.eth.gas_price,
-                    "nonce": web3_client.eth.get_transaction_count(account.public_key)
-                }),
-                account.private_key
-            )
-
-            web3_client.eth.send_raw_transaction(signed_transaction.rawTransaction)
+        # noinspection PyTypeChecker
+        token = Token.objects.get(pk=request.POST["token"])
+        amount = token.to_lowest_denomination(request.POST["amount"])
+        self._pay(request, [Payout(account, request.POST["address"], amount, token) for account in queryset])
 
     actions = [send_eth, send_erc20]
     action_form = SendForm
 
 
 @admin.register(SentTransaction)
-class AdminSentTransaction(admin.ModelAdmin):
+class AdminSentTransaction(KeysetPaginationAdmin):
     readonly_fields = ("tx_hash", "amount")
     list_display = ["tx_hash", "amount", "token", "sender", "receiver"]
+    # Loaded with the rows in a single query, the token also gives the decimals of the amount
+    list_select_related = ("token", "sender")
 
     def has_change_permission(self, request, obj=None):
         return False
@@ -97,9 +75,10 @@ class AdminSentTransaction(admin.ModelAdmin):
 
 
 @admin.register(ReceivedTransaction)
-class AdminReceivedTransaction(admin.ModelAdmin):
+class AdminReceivedTransaction(KeysetPaginationAdmin):
     readonly_fields = ("tx_hash", "amount")
     list_display = ["tx_hash", "amount", "token", "sender", "receiver"]
+    list_select_related = ("token", "receiver")
 
     def has_change_permission(self, request, obj=None):
         return False
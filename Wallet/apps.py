@@ -2,6 +2,7 @@ import logging
 import threading
 
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class WalletConfig(AppConfig):
@@ -9,26 +10,20 @@ class WalletConfig(AppConfig):
     name = 'Wallet'
 
     def ready(self):
-        def _background_task():
-            from django.conf import settings
-            from web3 import Web3
-
-            from blockchain_consumer.block_fetcher import BlockFetcher
-            from blockchain_consumer.incoming import IncomingTransactionProcessor
-            from blockchain_consumer.incoming import IncomingERC20Processor
-            from blockchain_consumer.outgoing import OutgoingTransactionProcessor
-            from blockchain_consumer.outgoing import OutgoingERC20Processor
+        # Connects the signals that keep the watched address index and the contract cache up to date
+        import blockchain_consumer.contract_cache  # noqa: F401
+        import blockchain_consumer.watch_index  # noqa: F401
 
-            web3_client = Web3(Web3.HTTPProvider(settings.INFURA_URL))
+        # The consumer normally runs as a separate process through the run_consumer command
+        if not settings.CONSUMER_AUTOSTART:
+            return
 
-            block_fetcher = BlockFetcher(web3_client)
-            block_fetcher.subscribe(IncomingTransactionProcessor(web3_client))
-            block_fetcher.subscribe(IncomingERC20Processor(web3_client))
-            block_fetcher.subscribe(OutgoingTransactionProcessor(web3_client))
-            block_fetcher.subscribe(OutgoingERC20Processor(web3_client))
+        def _background_task():
+            from blockchain_consumer.consumer import run_consumer
+            from blockchain_consumer.rpc import get_web3_client
 
             logging.basicConfig(level=logging.INFO)
 
-            block_fetcher.start()
+            run_consumer(get_web3_client())
 
         threading.Thread(target=_background_task, daemon=True).start()
@@ -0,0 +1,191 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.db.models import QuerySet
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from web3 import Web3
+
+from Wallet.models import Account, ReceivedTransaction, SentTransaction, Token
+from blockchain_consumer.rpc import get_web3_client
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+DIRECTIONS = ("all", "sent", "received")
+COLUMNS = (
+    "direction", "tx_hash", "log_index", "block_number", "account", "counterparty",
+    "token", "token_contract", "amount", "amount_wei", "fee_wei"
+)
+ETH_DECIMALS = 18
+
+# (direction, transaction hash, log index, block number, account address, counterparty address, token id,
+# amount in wei, fee in wei)
+ExportRow = Tuple[str, bytes, Optional[int], Optional[int], str, str, Optional[int], int, int]
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    # ISO 8601, in the default time zone unless it has an offset
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"{value} is not an ISO 8601 date and time.")
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def first_block_since(web3_client: Web3, timestamp: int) -> int:
+    # Binary search over the block timestamps, which only ever increase. One past the head if no block is that recent
+    low, high = 0, web3_client.eth.block_number + 1
+    while low < high:
+        middle = (low + high) // 2
+        if web3_client.eth.get_block(middle)["timestamp"] < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def block_range(
+    from_block: Optional[int] = None,
+    to_block: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    web3_client: Optional[Web3] = None
+) -> Tuple[Optional[int], Optional[int]]:
+    # Transactions only record their block, a time range narrows the blocks to the ones produced in it, until excluded
+    if since is not None:
+        since_block = first_block_since(web3_client or get_web3_client(), int(since.timestamp()))
+        from_block = since_block if from_block is None else max(from_block, since_block)
+    if until is not None:
+        until_block = first_block_since(web3_client or get_web3_client(), int(until.timestamp())) - 1
+        to_block = until_block if to_block is None else min(to_block, until_block)
+    return from_block, to_block
+
+
+class TransactionExport:
+    def __init__(
+        self,
+        direction: str = "all",
+        account: Optional[str] = None,
+        token: Optional[str] = None,
+        from_block: Optional[int] = None,
+        to_block: Optional[int] = None,
+        chunk_size: int = 2000
+    ):
+        if direction not in DIRECTIONS:
+            raise ValueError(f"The direction must be one of {', '.join(DIRECTIONS)}, not {direction}.")
+        self._direction = direction
+        self._account = self._find_account(account) if account else None
+        # "ETH" only keeps the ETH transactions, the ones without a token
+        self._token = self._find_token(token) if token and token.upper() != "ETH" else None
+        self._eth_only = bool(token) and token.upper() == "ETH"
+        self._from_block = from_block
+        self._to_block = to_block
+        self._chunk_size = chunk_size
+        self._tokens: Dict[int, Token] = {}
+
+    @staticmethod
+    def _find_account(address: str) -> Account:
+        try:
+            return Account.objects.get(public_key__iexact=address)
+        except Account.DoesNotExist:
+            raise ValueError(f"No account has the address {address}.")
+
+    @staticmethod
+    def _find_token(token: str) -> Token:
+        # By contract address, or by symbol as long as it's not ambiguous
+        tokens = list(Token.objects.filter(contract_address__iexact=token))
+        if not tokens:
+            tokens = list(Token.objects.filter(symbol__iexact=token))
+        if len(tokens) != 1:
+            raise ValueError(f"{token} matches {len(tokens)} tokens, use the contract address.")
+        return tokens[0]
+
+    def _filter(self, queryset: QuerySet, account_field: str) -> QuerySet:
+        if self._account is not None:
+            queryset = queryset.filter(**{account_field: self._account})
+        if self._token is not None:
+            queryset = queryset.filter(token=self._token)
+        elif self._eth_only:
+            queryset = queryset.filter(token__isnull=True)
+        if self._from_block is not None:
+            queryset = queryset.filter(block_number__gte=self._from_block)
+        if self._to_block is not None:
+            queryset = queryset.filter(block_number__lte=self._to_block)
+        # The primary key order follows its index, so the rows are read without sorting them first
+        return queryset.order_by("pk")
+
+    def _rows(self) -> Iterator[ExportRow]:
+        # Plain tuples instead of model instances, read from a server-side cursor where the database has them
+        if self._direction in ("all", "sent"):
+            sent = self._filter(SentTransaction.objects, "sender").values_list(
+                "transaction_hash", "log_index", "block_number", "sender__public_key", "receiver", "token_id",
+                "amount_wei", "fee_wei"
+            )
+            for row in sent.iterator(chunk_size=self._chunk_size):
+                yield ("sent",) + row
+        if self._direction in ("all", "received"):
+            received = self._filter(ReceivedTransaction.objects, "receiver").values_list(
+                "transaction_hash", "log_index", "block_number", "receiver__public_key", "sender", "token_id", "amount_wei"
+            )
+            for row in received.iterator(chunk_size=self._chunk_size):
+                yield ("received",) + row + (0,)
+
+    def _load_tokens(self, rows: List[ExportRow]):
+        # Tokens are looked up once per batch, for the ones no earlier batch used
+        missing = {row[6] for row in rows if row[6] is not None} - self._tokens.keys()
+        if missing:
+            self._tokens.update(Token.objects.in_bulk(missing))
+
+    def _format(self, row: ExportRow) -> tuple:
+        direction, transaction_hash, log_index, block_number, account, counterparty, token_id, amount_wei, fee_wei = row
+        token = self._tokens[token_id] if token_id is not None else None
+        decimals = token.decimals if token is not None else ETH_DECIMALS
+        # Fixed-point notation, a zero amount would come out as 0E-18 otherwise
+        amount = f"{Decimal(amount_wei).scaleb(-decimals):f}"
+        return (
+            direction, "0x" + bytes(transaction_hash).hex(), log_index, block_number, account, counterparty,
+            token.symbol if token is not None else "ETH", token.contract_address if token is not None else "",
+            amount, str(amount_wei), str(fee_wei)
+        )
+
+    def batches(self) -> Iterator[List[tuple]]:
+        rows = self._rows()
+        while True:
+            batch = list(islice(rows, self._chunk_size))
+            if not batch:
+                return
+            self._load_tokens(batch)
+            yield [self._format(row) for row in batch]
+
+    def _csv(self) -> Iterator[str]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+        for batch in self.batches():
+            writer.writerows(batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            # Only the header, nothing matched
+            yield buffer.getvalue()
+
+    def _ndjson(self) -> Iterator[str]:
+        for batch in self.batches():
+            # Amounts stay strings, a float can't hold them exactly
+            yield "".join(json.dumps(dict(zip(COLUMNS, row))) + "\n" for row in batch)
+
+    def stream(self, export_format: str) -> Iterator[str]:
+        # One chunk of text per batch of rows, only a single batch is held in memory at a time.
+        # The format is checked here rather than once the response already started streaming
+        if export_format not in CONTENT_TYPES:
+            raise ValueError(f"The format must be one of {', '.join(CONTENT_TYPES)}, not {export_format}.")
+        return self._csv() if export_format == "csv" else self._ndjson()
@@ -0,0 +1,47 @@
+import logging
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from blockchain_consumer.backfill import Backfiller
+from blockchain_consumer.consumer import build_processors
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.rpc import get_web3_client
+from blockchain_consumer.transfer_logs import TransferLogSource
+
+
+class Command(BaseCommand):
+    help = "Processes the transactions in a range of already confirmed blocks."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="from_block", type=int, required=True)
+        parser.add_argument("--to", dest="to_block", type=int, required=True)
+        parser.add_argument("--workers", type=int, default=settings.BACKFILL_WORKERS)
+
+    def handle(self, *args, from_block: int, to_block: int, workers: int, **options):
+        logging.basicConfig(level=logging.INFO)
+
+        web3_client = get_web3_client()
+
+        dispatcher = BlockDispatcher(TransferLogSource(web3_client))
+        for processor in build_processors(web3_client):
+            dispatcher.subscribe(processor)
+
+        confirmed_head = web3_client.eth.block_number - dispatcher.confirmations_required()
+        if to_block > confirmed_head:
+            raise CommandError(f"Block {to_block} doesn't have enough confirmations yet, the last one that does is {confirmed_head}.")
+        if from_block > to_block:
+            raise CommandError("--from must not be greater than --to.")
+
+        failures = Backfiller(
+            web3_client,
+            dispatcher,
+            workers=workers,
+            batch_size=settings.BLOCK_BATCH_SIZE,
+            prefilter=settings.BLOCK_BLOOM_PREFILTER
+        ).run(from_block, to_block)
+        if failures:
+            raise CommandError(
+                "Some blocks couldn't be processed, run the command again from the first failed block: " +
+                ", ".join(f"{processor_name} at block {block_number}" for processor_name, block_number in failures.items())
+            )
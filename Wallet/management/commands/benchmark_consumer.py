@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from Wallet.models import Account, Token
+from blockchain_consumer.benchmark import ConsumerBenchmark, SyntheticChain, create_watched_addresses
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the throughput of each processor and of the block fetcher over a synthetic chain, "
+        "served in process without any network access. Runs against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--blocks", type=int, default=200)
+        parser.add_argument("--transactions-per-block", type=int, default=150)
+        parser.add_argument("--erc20-share", type=float, default=0.3, help="Share of the transactions that are ERC20 transfers.")
+        parser.add_argument("--hit-rate", type=float, default=0.05, help="Share of the transactions involving a watched account.")
+        parser.add_argument("--accounts", type=int, default=1000, help="Number of watched accounts.")
+        parser.add_argument("--tokens", type=int, default=10, help="Number of watched tokens.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--no-memory", action="store_true", help="Skip the runs measuring the peak memory.")
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            dest="as_json",
+            help="Print the results as JSON, e.g. to compare them in CI."
+        )
+
+    def handle(self, *args, blocks: int, transactions_per_block: int, erc20_share: float, hit_rate: float,
+               accounts: int, tokens: int, seed: int, no_memory: bool, as_json: bool, **options):
+        logging.basicConfig(level=logging.WARNING)
+        if blocks < 1 or accounts < 1:
+            raise CommandError("--blocks and --accounts must be at least 1.")
+        if not (0 <= erc20_share <= 1 and 0 <= hit_rate <= 1):
+            raise CommandError("--erc20-share and --hit-rate must be between 0 and 1.")
+
+        with tempfile.TemporaryDirectory() as directory:
+            if connection.vendor == "sqlite":
+                # An in-memory database can't be shared by the consumer's threads
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(directory, "benchmark.sqlite")
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                results = self._run(blocks, transactions_per_block, erc20_share, hit_rate, accounts, tokens, seed, no_memory)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if as_json:
+            self.stdout.write(json.dumps([result.as_dict() for result in results], indent=2))
+            return
+        self.stdout.write(f"{'':<36}{'blocks/s':>12}{'tx/s':>12}{'queries/block':>16}{'peak MiB':>12}")
+        for result in results:
+            peak_memory = "-" if result.peak_memory is None else f"{result.peak_memory / 2 ** 20:.1f}"
+            self.stdout.write(
+                f"{result.name:<36}{result.blocks_per_second:>12.1f}{result.transactions_per_second:>12.0f}"
+                f"{result.queries_per_block:>16.1f}{peak_memory:>12}"
+            )
+
+    @staticmethod
+    def _run(blocks, transactions_per_block, erc20_share, hit_rate, accounts, tokens, seed, no_memory):
+        create_watched_addresses(accounts, tokens, seed=seed)
+
+        chain = SyntheticChain(
+            list(Account.objects.values_list("public_key", flat=True)),
+            list(Token.objects.values_list("contract_address", flat=True)),
+            blocks=blocks,
+            transactions_per_block=transactions_per_block,
+            erc20_share=erc20_share,
+            hit_rate=hit_rate,
+            seed=seed
+        )
+        return ConsumerBenchmark(
+            chain,
+            measure_memory=not no_memory,
+            batch_size=settings.BLOCK_BATCH_SIZE,
+            prefilter=settings.BLOCK_BLOOM_PREFILTER
+        ).run()
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from Wallet.export import CONTENT_TYPES, DIRECTIONS, TransactionExport, block_range, parse_time
+
+
+class Command(BaseCommand):
+    help = (
+        "Streams the stored transactions as CSV or newline-delimited JSON, optionally for a single account or token "
+        "and a range of blocks or time. Memory use doesn't depend on the number of rows exported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=list(CONTENT_TYPES), default="csv", dest="export_format")
+        parser.add_argument("--direction", choices=DIRECTIONS, default="all")
+        parser.add_argument("--account", help="Address of the account.")
+        parser.add_argument("--token", help="Contract address or symbol of the token, or ETH.")
+        parser.add_argument("--from-block", type=int)
+        parser.add_argument("--to-block", type=int)
+        parser.add_argument("--since", help="ISO 8601 date and time, looked up as a block on chain.")
+        parser.add_argument("--until", help="ISO 8601 date and time (excluded), looked up as a block on chain.")
+        parser.add_argument("--chunk-size", type=int, default=settings.EXPORT_CHUNK_SIZE)
+        parser.add_argument("--output", "-o", help="File to write to instead of the standard output.")
+
+    def handle(self, *args, export_format: str, direction: str, account: str, token: str, from_block: int,
+               to_block: int, since: str, until: str, chunk_size: int, output: str, **options):
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+        try:
+            from_block, to_block = block_range(from_block, to_block, parse_time(since), parse_time(until))
+            stream = TransactionExport(
+                direction=direction,
+                account=account,
+                token=token,
+                from_block=from_block,
+                to_block=to_block,
+                chunk_size=chunk_size
+            ).stream(export_format)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # Written in chunks as the rows are read
+        if output is None:
+            for chunk in stream:
+                self.stdout.write(chunk, ending="")
+            return
+        with open(output, "w", newline="", encoding="utf-8") as file:
+            for chunk in stream:
+                file.write(chunk)
@@ -0,0 +1,30 @@
+import logging
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from Wallet.provisioning import AccountProvisioner
+
+
+class Command(BaseCommand):
+    help = "Creates deposit accounts whose keys are derived from the ACCOUNT_HD_MNEMONIC seed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, required=True)
+        parser.add_argument("--name-prefix", default="deposit-")
+        parser.add_argument("--processes", type=int, default=settings.ACCOUNT_PROVISIONING_PROCESSES)
+
+    def handle(self, *args, count: int, name_prefix: str, processes: int, **options):
+        logging.basicConfig(level=logging.INFO)
+
+        if not settings.ACCOUNT_HD_MNEMONIC:
+            raise CommandError("ACCOUNT_HD_MNEMONIC must be set to derive accounts.")
+        if count < 1:
+            raise CommandError("--count must be at least 1.")
+
+        indexes = AccountProvisioner(
+            settings.ACCOUNT_HD_MNEMONIC,
+            base_path=settings.ACCOUNT_HD_PATH,
+            processes=processes
+        ).provision(count, name_prefix=name_prefix)
+        self.stdout.write(f"Created {len(indexes)} accounts, derivation indexes {indexes.start} to {indexes.stop - 1}.")
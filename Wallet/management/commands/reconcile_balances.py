@@ -0,0 +1,39 @@
+import logging
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db.models import Min
+
+from Wallet.models import BlockCheckpoint
+from blockchain_consumer.balances import reconcile_balances
+from blockchain_consumer.block_fetcher import BlockFetcher
+from blockchain_consumer.ledger import check_balance_drift
+from blockchain_consumer.rpc import get_web3_client
+
+
+class Command(BaseCommand):
+    help = (
+        "Refreshes the balances of all accounts, for ETH and every token, from the chain. "
+        "In ledger mode, corrects the ledger balances that drifted from the chain instead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.BALANCE_RECONCILIATION_BATCH_SIZE)
+        parser.add_argument("--workers", type=int, default=settings.BALANCE_RECONCILIATION_WORKERS)
+
+    def handle(self, *args, batch_size: int, workers: int, **options):
+        logging.basicConfig(level=logging.INFO)
+
+        web3_client = get_web3_client()
+        if settings.BALANCE_MODE != "ledger":
+            reconcile_balances(web3_client, batch_size=batch_size, max_workers=workers)
+            return
+
+        # Every shard stored its transactions up to its own checkpoint, the lowest one holds for all of them
+        block_number = BlockCheckpoint.objects.filter(
+            name__startswith=BlockFetcher.CHECKPOINT_NAME
+        ).aggregate(block_number=Min("block_number"))["block_number"]
+        if block_number is None:
+            raise CommandError("No block was processed yet, the ledger can't be checked.")
+        drifted = check_balance_drift(web3_client, block_number, batch_size=batch_size, max_workers=workers, fix=True)
+        self.stdout.write(f"Corrected {drifted} ledger balances at block {block_number}.")
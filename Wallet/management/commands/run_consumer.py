@@ -0,0 +1,44 @@
+import logging
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from blockchain_consumer.consumer import run_consumer
+from blockchain_consumer.metrics import serve_metrics
+from blockchain_consumer.rpc import get_web3_client
+from blockchain_consumer.sharding import Shard
+
+
+class Command(BaseCommand):
+    help = "Consumes new blocks. Instances consuming the same shard elect a leader, the others stand by."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=settings.CONSUMER_SHARDS,
+            help="Number of consumers the watched accounts are split between."
+        )
+        parser.add_argument("--shard", type=int, default=None, help="Index of the shard to consume, from 0.")
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=settings.METRICS_PORT,
+            help="Port the consumer's metrics are served on, in the Prometheus text format."
+        )
+
+    def handle(self, *args, shards: int, shard: int, metrics_port: int, **options):
+        logging.basicConfig(level=logging.INFO)
+
+        if shard is None:
+            if shards > 1:
+                raise CommandError("--shard is required when consuming more than one shard.")
+            shard = 0
+        try:
+            consumer_shard = Shard(shard, shards)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if metrics_port:
+            serve_metrics(metrics_port)
+        run_consumer(get_web3_client(), consumer_shard)
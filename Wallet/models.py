@@ -1,15 +1,18 @@
+from datetime import timedelta
 from decimal import Decimal
-from typing import Union
+from typing import Optional, Union
 
 import eth_utils
-from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 from hexbytes import HexBytes
 from eth_account import Account as EthAccount
 from web3 import Web3
 from web3.contract import Contract
 
+from blockchain_consumer.rpc import get_web3_client
+
 
 def validate_public_address(address: str):
     if not eth_utils.is_hex_address(address):
@@ -45,8 +48,7 @@ class Token(models.Model):
         return self.name
 
     def clean(self):
-        web3_client = Web3(Web3.HTTPProvider(settings.INFURA_URL))
-        contract = web3_client.eth.contract(
+        contract = get_web3_client().eth.contract(
             address=HexBytes.fromhex(self.contract_address.strip("0x")),
             abi=self.abi
         )
@@ -58,16 +60,12 @@ class Token(models.Model):
         super().clean()
 
     def to_lowest_denomination(self, value: Union[int, float, Decimal]) -> int:
-        result = Decimal(value)
-        for _ in range(self.decimals):
-            result *= 10
-        return int(result)
+        # A single multiplication by the power of ten rather than one per decimal place
+        return int(Decimal(value) * 10 ** self.decimals)
 
     def from_lowest_denomination(self, value: Union[int, float, Decimal]) -> Decimal:
-        result = Decimal(value)
-        for _ in range(self.decimals):
-            result /= 10
-        return result
+        # Dividing drops the trailing zeros, 1.5 rather than 1.500000
+        return Decimal(value) / Decimal(10 ** self.decimals)
 
 
 class Account(models.Model):
@@ -76,6 +74,8 @@ class Account(models.Model):
     private_key = models.BinaryField(unique=True, validators=[validate_private_key], editable=False)
     # Balance in ETH wei
     balance_wei = models.PositiveBigIntegerField(editable=False)
+    # Position of the account under the HD seed it was derived from, if it was provisioned in bulk
+    derivation_index = models.PositiveIntegerField(null=True, blank=True, unique=True, editable=False)
     tokens = models.ManyToManyField(to=Token, through="TokenBalance")
 
     def __str__(self):
@@ -87,13 +87,17 @@ class Account(models.Model):
                 token_balance.token.symbol,
                 str(token_balance.token.from_lowest_denomination(token_balance.balance))
             ])
-            for token_balance in TokenBalance.objects.filter(account=self)
+            for token_balance in TokenBalance.objects.filter(account=self).select_related("token")
         ])
 
     def __init__(self, *args, **kwargs):
-        account = EthAccount.create()
-        kwargs["private_key"], kwargs["public_key"] = account.key, Web3.toChecksumAddress(account.address)
-        kwargs["balance_wei"] = 0
+        # Rows loaded from the database come in as positional arguments and already have their keys,
+        # a key pair is only generated for a new account that wasn't given one
+        if not args:
+            if "private_key" not in kwargs:
+                account = EthAccount.create()
+                kwargs["private_key"], kwargs["public_key"] = account.key, Web3.toChecksumAddress(account.address)
+            kwargs.setdefault("balance_wei", 0)
         super().__init__(*args, **kwargs)
 
     def balance(self) -> Decimal:
@@ -130,30 +134,141 @@ class TokenBalance(models.Model):
 class Transaction(models.Model):
     class Meta:
         abstract = True
-
-    transaction_hash = models.BinaryField(unique=True, validators=[validate_tx_hash])
+        constraints = [
+            # A transaction can transfer tokens to or from several of the accounts, each of its Transfer logs is a row
+            models.UniqueConstraint(fields=["transaction_hash", "log_index"], name="%(app_label)s_%(class)s_unique_log"),
+            # NULLs never conflict, so rows that don't come from a log are unique by their hash alone
+            models.UniqueConstraint(
+                fields=["transaction_hash"],
+                condition=models.Q(log_index__isnull=True),
+                name="%(app_label)s_%(class)s_unique_hash"
+            ),
+        ]
+
+    transaction_hash = models.BinaryField(validators=[validate_tx_hash])
+    # Position of the Transfer log in its block, for transfers read from the logs
+    log_index = models.PositiveIntegerField(null=True, editable=False)
     # Amount in the smallest denomination of the transacted token. If ETH, amount in wei.
     amount_wei = models.PositiveBigIntegerField(editable=False)
     token = models.ForeignKey(Token, on_delete=models.CASCADE, null=True)
+    # Block the transaction was included in, unknown for transactions stored before it was recorded
+    block_number = models.PositiveBigIntegerField(null=True, db_index=True, editable=False)
 
     def tx_hash(self) -> str:
         return "0x" + self.transaction_hash.hex()
 
     def amount(self) -> Decimal:
-        result = Decimal(self.amount_wei)
-
         decimals = 18 if not self.token else self.token.decimals
-        for _ in range(decimals):
-            result /= 10
-
-        return result
+        return Decimal(self.amount_wei) / Decimal(10 ** decimals)
 
 
 class SentTransaction(Transaction):
     sender = models.ForeignKey(Account, on_delete=models.CASCADE)
-    receiver = models.CharField(max_length=128, validators=[validate_public_address])
+    receiver = models.CharField(max_length=128, validators=[validate_public_address], db_index=True)
+    # Gas paid by the sender, in wei. Only recorded in the ledger balance mode
+    fee_wei = models.PositiveBigIntegerField(default=0, editable=False)
 
 
 class ReceivedTransaction(Transaction):
-    sender = models.CharField(max_length=128, validators=[validate_public_address])
+    sender = models.CharField(max_length=128, validators=[validate_public_address], db_index=True)
     receiver = models.ForeignKey(Account, on_delete=models.CASCADE)
+
+
+class BlockCheckpoint(models.Model):
+    name = models.CharField(unique=True, max_length=128)
+    # Every transaction in this block and the blocks before it has been fully processed
+    block_number = models.PositiveBigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.block_number}"
+
+    @classmethod
+    def load(cls, name: str) -> Optional[int]:
+        try:
+            return cls.objects.get(name=name).block_number
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def store(cls, name: str, block_number: int):
+        # A plain UPDATE doesn't read the row first, so concurrent writers don't deadlock on SQLite's lock upgrade
+        if not cls.objects.filter(name=name).update(block_number=block_number):
+            cls.objects.update_or_create(name=name, defaults={"block_number": block_number})
+
+
+class PendingTransaction(models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["processor", "transaction_hash", "log_index"], name="unique_pending_log"),
+            models.UniqueConstraint(
+                fields=["processor", "transaction_hash"],
+                condition=models.Q(log_index__isnull=True),
+                name="unique_pending_transaction"
+            ),
+        ]
+
+    # Name of the transaction processor that will process the transaction once it's confirmed
+    processor = models.CharField(max_length=128)
+    transaction_hash = models.BinaryField(validators=[validate_tx_hash])
+    # Set for transfers read from the logs, a single transaction can emit several of them
+    log_index = models.PositiveIntegerField(null=True)
+    block_number = models.PositiveBigIntegerField(db_index=True)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    token = models.ForeignKey(Token, on_delete=models.CASCADE, null=True)
+    # The other side of the transaction: the sender of incoming transactions, the receiver of outgoing ones
+    counterparty = models.CharField(max_length=128, validators=[validate_public_address])
+    amount_wei = models.PositiveBigIntegerField()
+
+
+class BalanceSnapshot(models.Model):
+    # Balance of an account at the end of a block, from which the ledger balance mode adds up the newer transactions
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["account", "token"], name="unique_balance_snapshot"),
+            # NULLs are distinct in a unique index, so ETH balances need their own constraint
+            models.UniqueConstraint(fields=["account"], condition=models.Q(token__isnull=True), name="unique_eth_balance_snapshot"),
+        ]
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    # ETH balances have no token
+    token = models.ForeignKey(Token, on_delete=models.CASCADE, null=True)
+    block_number = models.PositiveBigIntegerField()
+    # Signed, so that a drifting ledger can be told apart, and stored as its digits: a DecimalField this wide is
+    # a REAL on SQLite, which rounds balances past 2**53
+    balance = models.CharField(max_length=80)
+
+    def __str__(self):
+        return f"{self.account} {self.token or 'ETH'}: {self.balance} at block {self.block_number}"
+
+
+class ConsumerLease(models.Model):
+    # Only the holder of a lease runs the consumer it's named after, other instances wait for it to expire
+    name = models.CharField(unique=True, max_length=128)
+    owner = models.CharField(max_length=256)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name}: {self.owner} until {self.expires_at}"
+
+    @classmethod
+    def acquire(cls, name: str, owner: str, duration: timedelta) -> bool:
+        # Also renews the lease when it's already held by the owner
+        now = timezone.now()
+        taken_over = cls.objects.filter(
+            models.Q(owner=owner) | models.Q(expires_at__lt=now),
+            name=name
+        ).update(owner=owner, expires_at=now + duration)
+        if taken_over:
+            return True
+        try:
+            # In a savepoint, so that losing the race doesn't break a surrounding transaction
+            with transaction.atomic():
+                cls.objects.create(name=name, owner=owner, expires_at=now + duration)
+        except IntegrityError:
+            # Held by someone else
+            return False
+        return True
+
+    @classmethod
+    def release(cls, name: str, owner: str):
+        cls.objects.filter(name=name, owner=owner).delete()
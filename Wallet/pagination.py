@@ -0,0 +1,125 @@
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Max, Min, QuerySet
+from django.utils.functional import cached_property
+
+OLDER_VAR = "older_than"
+NEWER_VAR = "newer_than"
+
+
+# Row count of a table from the database statistics, without scanning it. -1 on PostgreSQL until it's first analyzed
+ROW_COUNT_STATISTICS = {
+    "postgresql": "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)",
+    "mysql": "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+}
+
+
+def estimated_row_count(queryset: QuerySet) -> int:
+    connection = connections[queryset.db]
+    statistics_query = ROW_COUNT_STATISTICS.get(connection.vendor)
+    if statistics_query is not None:
+        with connection.cursor() as cursor:
+            cursor.execute(statistics_query, [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        if row is not None and row[0] is not None and row[0] >= 0:
+            return int(row[0])
+
+    # Rows are only ever appended, so the span of the primary keys is close, and both ends come from the index
+    bounds = queryset.model._default_manager.using(queryset.db).aggregate(low=Min("pk"), high=Max("pk"))
+    if bounds["high"] is None:
+        return 0
+    return bounds["high"] - bounds["low"] + 1
+
+
+class EstimatedCountPaginator(Paginator):
+    # Below this many rows, counting them exactly is cheap enough
+    EXACT_COUNT_LIMIT = 10000
+    estimated = False
+
+    @cached_property
+    def count(self) -> int:
+        if self.object_list.query.where:
+            # Filtered listings go through an index, the statistics can't tell how many rows match
+            return super().count
+        estimate = estimated_row_count(self.object_list)
+        if estimate < self.EXACT_COUNT_LIMIT:
+            return super().count
+        self.estimated = True
+        return estimate
+
+
+class KeysetChangeList(ChangeList):
+    # Pages are fetched with "WHERE id < ?" from the last row of the previous page instead of an OFFSET,
+    # which reads every skipped row and gets slower the deeper the page
+    def __init__(self, request, *args, **kwargs):
+        self.cursor_params = {
+            name: request.GET[name] for name in (OLDER_VAR, NEWER_VAR) if name in request.GET
+        }
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        for name in (OLDER_VAR, NEWER_VAR):
+            lookup_params.pop(name, None)
+        return lookup_params
+
+    def _page(self, newer: bool) -> list:
+        # One extra row tells whether there is another page past this one
+        try:
+            if newer:
+                # Walks forward from the cursor, the rows are put back in descending order once fetched
+                queryset = self.queryset.filter(pk__gt=int(self.cursor_params[NEWER_VAR])).order_by("pk")
+            elif OLDER_VAR in self.cursor_params:
+                queryset = self.queryset.filter(pk__lt=int(self.cursor_params[OLDER_VAR])).order_by("-pk")
+            else:
+                queryset = self.queryset.order_by("-pk")
+        except ValueError:
+            raise IncorrectLookupParameters
+        return list(queryset[:self.list_per_page + 1])
+
+    def get_results(self, request):
+        # The cursor only applies to the page, actions on every selected row still get the whole filtered queryset
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        newer = NEWER_VAR in self.cursor_params
+        rows = self._page(newer)
+        if newer and len(rows) <= self.list_per_page:
+            # Back at the newest rows, which make up a full first page
+            self.cursor_params, newer = {}, False
+            rows = self._page(newer)
+        more = len(rows) > self.list_per_page
+        rows = rows[:self.list_per_page]
+        if newer:
+            rows.reverse()
+        has_older = bool(rows) if newer else more
+        has_newer = newer or OLDER_VAR in self.cursor_params
+
+        self.result_count = paginator.count
+        self.result_count_estimated = getattr(paginator, "estimated", False)
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = has_older or has_newer
+        self.paginator = paginator
+
+        removed = [OLDER_VAR, NEWER_VAR]
+        self.newest_url = self.get_query_string(remove=removed) if has_newer else None
+        self.newer_url = self.get_query_string({NEWER_VAR: rows[0].pk}, removed) if has_newer and rows else None
+        self.older_url = self.get_query_string({OLDER_VAR: rows[-1].pk}, removed) if has_older and rows else None
+
+
+class KeysetPaginationAdmin(admin.ModelAdmin):
+    # Changelist for tables with millions of rows: newest rows first, paginated by primary key, with an estimated count
+    change_list_template = "admin/Wallet/keyset_change_list.html"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ("-pk",)
+    # Sorting by another column would need a cursor over that column, and an index to make it fast
+    sortable_by = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
@@ -0,0 +1,214 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+from eth_account import Account as EthAccount
+from hexbytes import HexBytes
+from web3 import Web3
+
+from Wallet.models import Account, Token
+from blockchain_consumer.contract_cache import contract_cache
+from blockchain_consumer.rpc import get_web3_client
+from blockchain_consumer.rpc_batch import BatchRpcClient
+
+logger = logging.getLogger(__name__)
+
+# (transaction hash, raw signed transaction)
+SignedPayout = Tuple[bytes, bytes]
+
+# Replies to a raw transaction the node already received, which happens when a request that reached it
+# timed out and was sent again. Only taken as a success once the node knows the transaction by its hash
+RESUBMISSION_ERRORS = ("already known", "known transaction", "nonce too low")
+
+
+class Payout:
+    __slots__ = ("account", "receiver", "amount", "token", "transaction_hash", "error")
+
+    def __init__(self, account: Account, receiver: str, amount: int, token: Optional[Token] = None):
+        self.account = account
+        self.receiver = Web3.toChecksumAddress(receiver)
+        # In the smallest denomination of the token, or wei
+        self.amount = amount
+        self.token = token
+        # Set once the payout was submitted
+        self.transaction_hash: Optional[bytes] = None
+        self.error: Optional[str] = None
+
+
+class NonceManager:
+    # Hands out the nonces of our accounts locally, so that payouts sent in quick succession from the same account
+    # never reuse one. An account's nonce is read from the chain the first time it's needed, and again after
+    # a failed submission, since the nonce that failed has to be used by the next transaction.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_nonces: Dict[str, int] = {}
+
+    def unknown(self, addresses: List[str]) -> List[str]:
+        with self._lock:
+            return [address for address in set(addresses) if address not in self._next_nonces]
+
+    def seed(self, nonces: Dict[str, int]):
+        with self._lock:
+            for address, nonce in nonces.items():
+                self._next_nonces.setdefault(address, nonce)
+
+    def allocate(self, address: str) -> int:
+        with self._lock:
+            nonce = self._next_nonces[address]
+            self._next_nonces[address] = nonce + 1
+            return nonce
+
+    def forget(self, address: str):
+        with self._lock:
+            self._next_nonces.pop(address, None)
+
+
+def sign_transactions(transactions: List[Tuple[dict, bytes]]) -> List[SignedPayout]:
+    signed_transactions = []
+    for transaction, private_key in transactions:
+        signed_transaction = EthAccount.sign_transaction(transaction, private_key)
+        signed_transactions.append((bytes(signed_transaction.hash), bytes(signed_transaction.rawTransaction)))
+    return signed_transactions
+
+
+class PayoutEngine:
+    # Payouts are queued and sent in batches: the gas price and the chain id are fetched once per batch,
+    # transactions are signed by worker processes and all of them are submitted with a single JSON-RPC batch.
+    # Same limit the admin actions always used
+    GAS_LIMIT = 1000000
+
+    def __init__(self, web3_client: Web3, signing_processes: int = 0, chunk_size: int = 100):
+        self._web3_client = web3_client
+        self._rpc = BatchRpcClient(web3_client)
+        self._nonces = NonceManager()
+        self._signing_processes = signing_processes
+        self._chunk_size = chunk_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._queue: List[Payout] = []
+        self._queue_lock = threading.Lock()
+        # Batches are sent one at a time, so nonces are submitted in the order they were allocated
+        self._flush_lock = threading.Lock()
+
+    def enqueue(self, payouts: List[Payout]):
+        with self._queue_lock:
+            self._queue.extend(payouts)
+
+    def _prepare(self, payouts: List[Payout]) -> Tuple[int, int]:
+        # Gas price, chain id and the nonces of the accounts we haven't seen yet, in a single batch
+        unknown = self._nonces.unknown([payout.account.public_key for payout in payouts])
+        gas_price, chain_id, *nonces = self._rpc.call_many([
+            ("eth_gasPrice", []),
+            ("eth_chainId", []),
+            *(("eth_getTransactionCount", [address, "pending"]) for address in unknown),
+        ])
+        self._nonces.seed(dict(zip(unknown, nonces)))
+        return gas_price, chain_id
+
+    def _transaction(self, payout: Payout, gas_price: int, chain_id: int) -> dict:
+        transaction = {
+            "gas": self.GAS_LIMIT,
+            "gasPrice": gas_price,
+            "chainId": chain_id,
+            "nonce": self._nonces.allocate(payout.account.public_key),
+        }
+        if payout.token is None:
+            transaction.update(to=payout.receiver, value=payout.amount)
+        else:
+            contract = contract_cache.contract(self._web3_client, payout.token)
+            transaction.update(
+                to=payout.token.contract_address,
+                value=0,
+                data=contract.encodeABI(fn_name="transfer", args=[payout.receiver, payout.amount])
+            )
+        return transaction
+
+    def _signing_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._signing_processes,
+                # Forking a process that runs several threads isn't safe
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def _sign(self, transactions: List[Tuple[dict, bytes]]) -> List[SignedPayout]:
+        if not self._signing_processes or len(transactions) < 2 * self._chunk_size:
+            # Not worth the round trip to the workers
+            return sign_transactions(transactions)
+        chunks = [transactions[start:start + self._chunk_size] for start in range(0, len(transactions), self._chunk_size)]
+        return [signed for chunk in self._signing_pool().map(sign_transactions, chunks) for signed in chunk]
+
+    def _submitted_before(self, signed_transactions: List[SignedPayout], responses: List[dict]) -> Set[bytes]:
+        # Hashes of the transactions rejected as already received, that the node does have
+        resubmitted = [
+            transaction_hash for (transaction_hash, _), response in zip(signed_transactions, responses)
+            if "error" in response and any(error in str(response["error"]).lower() for error in RESUBMISSION_ERRORS)
+        ]
+        known = self._rpc.call("eth_getTransactionByHash", [[HexBytes(transaction_hash).hex()] for transaction_hash in resubmitted])
+        return {transaction_hash for transaction_hash, transaction in zip(resubmitted, known) if transaction is not None}
+
+    def _send(self, payouts: List[Payout]):
+        gas_price, chain_id = self._prepare(payouts)
+        transactions = [
+            (self._transaction(payout, gas_price, chain_id), bytes(payout.account.private_key))
+            for payout in payouts
+        ]
+        signed_transactions = self._sign(transactions)
+        responses = self._rpc.send_many([
+            ("eth_sendRawTransaction", [HexBytes(raw_transaction).hex()])
+            for _, raw_transaction in signed_transactions
+        ])
+
+        submitted = self._submitted_before(signed_transactions, responses)
+        for payout, (transaction_hash, _), response in zip(payouts, signed_transactions, responses):
+            if "error" in response and transaction_hash not in submitted:
+                payout.error = str(response["error"])
+                logger.error(f"Payout from {payout.account.public_key} to {payout.receiver} failed: {payout.error}")
+                # Later transactions of the account can't be mined until its nonce is used, which the next batch does
+                self._nonces.forget(payout.account.public_key)
+            else:
+                payout.transaction_hash = transaction_hash
+        logger.info(f"Submitted {sum(payout.error is None for payout in payouts)} of {len(payouts)} payouts.")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._queue_lock:
+                payouts, self._queue = self._queue, []
+            if not payouts:
+                return
+            try:
+                self._send(payouts)
+            except Exception as e:
+                for payout in payouts:
+                    if payout.transaction_hash is None and payout.error is None:
+                        payout.error = str(e)
+                # Nothing tells which of the allocated nonces reached the node
+                for address in {payout.account.public_key for payout in payouts}:
+                    self._nonces.forget(address)
+                raise
+
+    def pay(self, payouts: List[Payout]) -> List[Payout]:
+        # Another caller may flush the queue first, either way the payouts are sent when this returns
+        self.enqueue(payouts)
+        self.flush()
+        return payouts
+
+
+_payout_engine: Optional[PayoutEngine] = None
+_payout_engine_lock = threading.Lock()
+
+
+def payout_engine() -> PayoutEngine:
+    # A single engine per process, since the nonces it hands out are only safe if nobody else allocates them
+    global _payout_engine
+    with _payout_engine_lock:
+        if _payout_engine is None:
+            _payout_engine = PayoutEngine(
+                get_web3_client(),
+                signing_processes=settings.PAYOUT_SIGNING_PROCESSES,
+                chunk_size=settings.PAYOUT_SIGNING_CHUNK_SIZE
+            )
+        return _payout_engine
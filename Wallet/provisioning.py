@@ -0,0 +1,130 @@
+import hashlib
+import hmac
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Max
+from eth_account.hdaccount import seed_from_mnemonic
+from eth_account.hdaccount.deterministic import Node, SoftNode, derive_child_key
+from eth_keys import keys
+from eth_keys.constants import SECPK1_N
+
+from Wallet.models import Account
+
+logger = logging.getLogger(__name__)
+
+# (derivation index, private key, checksum address)
+DerivedKey = Tuple[int, bytes, str]
+
+
+def _master_node(seed: bytes) -> Tuple[bytes, bytes]:
+    master_node = hmac.new(b"Bitcoin seed", seed, hashlib.sha512).digest()
+    return master_node[:32], master_node[32:]
+
+
+def derive_parent(mnemonic: str, base_path: str, passphrase: str = "") -> Tuple[bytes, bytes]:
+    # Extended private key (key, chain code) of the node every deposit address is a direct child of
+    key, chain_code = _master_node(seed_from_mnemonic(mnemonic, passphrase))
+    for node in base_path.split("/")[1:]:
+        key, chain_code = derive_child_key(key, chain_code, Node.decode(node))
+    return key, chain_code
+
+
+def derive_children(parent_key: bytes, parent_chain_code: bytes, parent_point: bytes, indexes: List[int]) -> List[DerivedKey]:
+    # Same as BIP32's CKDpriv for non-hardened children, but with the parent's public point computed once
+    # instead of twice per child, which leaves a single point multiplication per address
+    parent = int.from_bytes(parent_key, "big")
+    derived = []
+    for index in indexes:
+        child = hmac.new(parent_chain_code, parent_point + index.to_bytes(4, "big"), hashlib.sha512).digest()
+        tweak = int.from_bytes(child[:32], "big")
+        child_key = (tweak + parent) % SECPK1_N
+        if tweak >= SECPK1_N or child_key == 0:
+            # Invalid child (probability below 2**-127), BIP32 moves on to the next index
+            child_key_bytes, _ = derive_child_key(parent_key, parent_chain_code, SoftNode(index))
+        else:
+            child_key_bytes = child_key.to_bytes(32, "big")
+        derived.append((index, child_key_bytes, keys.PrivateKey(child_key_bytes).public_key.to_checksum_address()))
+    return derived
+
+
+# Extended key of the parent node in the worker process, set once when the worker starts
+_worker_parent: Optional[Tuple[bytes, bytes, bytes]] = None
+
+
+def _init_worker(parent_key: bytes, parent_chain_code: bytes, parent_point: bytes):
+    global _worker_parent
+    _worker_parent = (parent_key, parent_chain_code, parent_point)
+
+
+def _derive_chunk(indexes: List[int]) -> List[DerivedKey]:
+    return derive_children(*_worker_parent, indexes)
+
+
+class AccountProvisioner:
+    # Mints deposit accounts whose keys are derived from a single HD seed, so they can all be recovered from it.
+    # Keys are derived by worker processes, and the accounts are inserted in batches without signals,
+    # which the watched address index picks up through its fingerprint.
+    def __init__(
+        self,
+        mnemonic: str,
+        base_path: str = "m/44'/60'/0'/0",
+        processes: Optional[int] = None,
+        chunk_size: int = 500,
+        batch_size: int = 1000
+    ):
+        self._parent_key, self._parent_chain_code = derive_parent(mnemonic, base_path)
+        self._parent_point = keys.PrivateKey(self._parent_key).public_key.to_compressed_bytes()
+        self._processes = processes or multiprocessing.cpu_count()
+        self._chunk_size = chunk_size
+        self._batch_size = batch_size
+
+    @staticmethod
+    def next_index() -> int:
+        last_index = Account.objects.aggregate(last=Max("derivation_index"))["last"]
+        return 0 if last_index is None else last_index + 1
+
+    def _insert(self, derived: List[DerivedKey], name_prefix: str):
+        with transaction.atomic():
+            Account.objects.bulk_create(
+                [
+                    Account(
+                        name=f"{name_prefix}{index}",
+                        public_key=public_key,
+                        private_key=private_key,
+                        derivation_index=index
+                    )
+                    for index, private_key, public_key in derived
+                ],
+                batch_size=self._batch_size
+            )
+
+    def provision(self, count: int, name_prefix: str = "deposit-") -> range:
+        # Continues after the last derived account, so running it again never mints the same address twice
+        start = self.next_index()
+        indexes = range(start, start + count)
+        chunks = [list(indexes[offset:offset + self._chunk_size]) for offset in range(0, count, self._chunk_size)]
+        logger.info(f"Deriving {count} accounts from index {start} with {self._processes} processes...")
+
+        parent = (self._parent_key, self._parent_chain_code, self._parent_point)
+        if self._processes < 2 or len(chunks) < 2:
+            for chunk in chunks:
+                self._insert(derive_children(*parent, chunk), name_prefix)
+            return indexes
+
+        with ProcessPoolExecutor(
+            max_workers=self._processes,
+            # Forking a process that runs several threads isn't safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=parent
+        ) as executor:
+            # Chunks come back in order, and are inserted while the next ones are being derived
+            for inserted, derived in enumerate(executor.map(_derive_chunk, chunks), start=1):
+                self._insert(derived, name_prefix)
+                if inserted % 20 == 0:
+                    logger.info(f"Provisioned {min(inserted * self._chunk_size, count)} of {count} accounts.")
+        return indexes
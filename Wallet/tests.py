@@ -1,3 +1,1161 @@
-from django.test import TestCase
+import asyncio
+import csv
+import itertools
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from typing import Callable, Dict
+from unittest import mock
 
-# Create your tests here.
+import requests
+import rlp
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from eth_account import Account as EthAccount
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.datastructures import AttributeDict
+from web3.providers import BaseProvider
+
+from Wallet.admin import AdminReceivedTransaction
+from Wallet.export import TransactionExport, first_block_since
+from Wallet.payouts import Payout, PayoutEngine
+from Wallet.models import (
+    Account, BalanceSnapshot, BlockCheckpoint, ConsumerLease, PendingTransaction, ReceivedTransaction, SentTransaction,
+    Token
+)
+from Wallet.pagination import EstimatedCountPaginator
+from Wallet.provisioning import AccountProvisioner
+from blockchain_consumer.abi_decoding import ProcessPoolTransferDecoder
+from blockchain_consumer.backfill import Backfiller
+from blockchain_consumer.block_fetcher import BlockFetcher
+from blockchain_consumer.chain_cache import ChainDataCache, cache_key, is_final
+from blockchain_consumer.confirmations import ConfirmationScheduler, PendingRecord
+from blockchain_consumer.consumer import _hold_lease, build_processors, run_consumer
+from blockchain_consumer.contract_cache import contract_cache
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.incoming import (
+    IncomingERC20Processor, IncomingERC20TransferProcessor, IncomingTransactionProcessor
+)
+from blockchain_consumer.outgoing import OutgoingERC20Processor, OutgoingERC20TransferProcessor, OutgoingTransactionProcessor
+from blockchain_consumer.ledger import _store_snapshots, check_balance_drift, ledger_balances
+from blockchain_consumer.pipeline import AsyncBlockPipeline
+from blockchain_consumer.rpc import PooledHTTPProvider
+from blockchain_consumer.rpc_batch import BatchBlockSource
+from blockchain_consumer.runner import ProcessorRunner
+from blockchain_consumer.sharding import Shard
+from blockchain_consumer.watch_index import watch_index
+
+
+TRANSFER_ABI = [{
+    "type": "function",
+    "name": "transfer",
+    "inputs": [{"name": "to", "type": "address"}, {"name": "amount", "type": "uint256"}],
+    "outputs": [{"name": "", "type": "bool"}],
+}]
+
+
+def address(number: int) -> str:
+    return Web3.toChecksumAddress("0x" + hex(number)[2:].rjust(40, "0"))
+
+
+def transaction_hash(number: int) -> HexBytes:
+    return HexBytes(number.to_bytes(32, "big"))
+
+
+class RpcError(Exception):
+    # Raised by a handler to answer with a JSON-RPC error
+    pass
+
+
+class FakeProvider(BaseProvider):
+    # Answers the JSON-RPC methods the test sets handlers for, and fails on any other
+    def __init__(self, handlers: Dict[str, Callable] = None):
+        super().__init__()
+        self.handlers = handlers or {}
+        self.calls = []
+
+    def make_request(self, method, params):
+        self.calls.append(method)
+        if method not in self.handlers:
+            raise AssertionError(f"Unexpected JSON-RPC call to {method}.")
+        try:
+            return {"jsonrpc": "2.0", "id": 1, "result": self.handlers[method](*params)}
+        except RpcError as e:
+            return {"jsonrpc": "2.0", "id": 1, "error": e.args[0]}
+
+
+class WatchedAddressesTestCase(TestCase):
+    def setUp(self):
+        self.token = Token.objects.create(contract_address=address(1000), abi="[]", name="Token", symbol="TKN", decimals=6)
+        self.alice = Account.objects.create(name="alice")
+        self.bob = Account.objects.create(name="bob")
+        watch_index.reload()
+        self.web3_client = Web3(FakeProvider())
+
+
+@override_settings(BALANCE_MODE="ledger")
+class MultiLogTransactionTests(WatchedAddressesTestCase):
+    def _transfer(self, log_index: int, receiver: Account, value: int) -> AttributeDict:
+        return AttributeDict({
+            "hash": transaction_hash(1),
+            "blockNumber": 10,
+            "logIndex": log_index,
+            "token": self.token.contract_address,
+            "from": address(5),
+            "to": receiver.public_key,
+            "value": value,
+        })
+
+    def test_every_transfer_of_a_transaction_is_stored(self):
+        # A multisend paying two of the accounts in a single transaction
+        processor = IncomingERC20TransferProcessor(self.web3_client)
+        records = processor.filter({"number": 10}, [self._transfer(3, self.alice, 100), self._transfer(4, self.bob, 200)])
+        self.assertEqual(len(records), 2)
+
+        scheduler = ConfirmationScheduler()
+        scheduler.register(processor.name, processor.CONFIRMATIONS_REQUIRED)
+        scheduler.add(records)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(PendingTransaction.objects.count(), 2)
+
+        # Restored from the database after a restart, both transfers are still pending
+        restored = ConfirmationScheduler()
+        restored.register(processor.name, processor.CONFIRMATIONS_REQUIRED)
+        restored.ensure_loaded()
+        self.assertEqual(len(restored), 2)
+
+        due = scheduler.pop_due(10 + processor.CONFIRMATIONS_REQUIRED)
+        self.assertEqual(len(due), 2)
+        processor.persist(due)
+        scheduler.complete(due)
+
+        self.assertEqual(
+            sorted(ReceivedTransaction.objects.values_list("log_index", "receiver_id", "amount_wei")),
+            [(3, self.alice.pk, 100), (4, self.bob.pk, 200)]
+        )
+        self.assertEqual(PendingTransaction.objects.count(), 0)
+
+        # Processing the block again doesn't store the transfers twice
+        processor.persist(due)
+        self.assertEqual(ReceivedTransaction.objects.count(), 2)
+
+    def test_transactions_without_logs_stay_unique_by_hash(self):
+        self.web3_client.provider.handlers["eth_getTransactionReceipt"] = lambda hash_: {"from": address(5), "status": "0x1"}
+        processor = IncomingTransactionProcessor(self.web3_client)
+        transaction = AttributeDict({
+            "hash": transaction_hash(2), "blockNumber": 10, "from": address(5), "to": self.alice.public_key, "value": 7
+        })
+        records = processor.filter({"number": 10}, [transaction])
+        self.assertIsNone(records[0].log_index)
+
+        processor.persist(records)
+        processor.persist(records)
+        self.assertEqual(ReceivedTransaction.objects.count(), 1)
+
+
+@override_settings(BALANCE_MODE="ledger")
+class LedgerSnapshotTests(WatchedAddressesTestCase):
+    # Past what a 64-bit integer holds, and far past 2**53 where a float starts rounding
+    BALANCE = 12345678901234567890123456789
+
+    def test_large_balances_are_snapshotted_exactly(self):
+        _store_snapshots({(self.alice, None): self.BALANCE}, 10)
+        ReceivedTransaction.objects.create(
+            transaction_hash=transaction_hash(1), block_number=11, amount_wei=1, sender=address(5), receiver=self.alice
+        )
+        self.assertEqual(BalanceSnapshot.objects.get().balance, str(self.BALANCE))
+        self.assertEqual(ledger_balances([(self.alice, None)], to_block=11), {(self.alice, None): self.BALANCE + 1})
+
+        # The chain agrees with the ledger, to the last wei
+        self.web3_client.provider.handlers.update({
+            "eth_getBalance": lambda account, block: hex(self.BALANCE + 1 if account == self.alice.public_key else 0),
+            "eth_call": lambda call, block: "0x" + "00" * 32,
+        })
+        self.assertEqual(check_balance_drift(self.web3_client, 11, max_workers=1), 0)
+
+    def test_an_account_has_a_single_eth_snapshot(self):
+        BalanceSnapshot.objects.create(account=self.alice, token=self.token, block_number=10, balance="1")
+        BalanceSnapshot.objects.create(account=self.alice, block_number=10, balance="1")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            BalanceSnapshot.objects.create(account=self.alice, block_number=11, balance="2")
+
+
+@override_settings(BALANCE_MODE="ledger")
+class LedgerFeeTests(WatchedAddressesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.receipts = {}
+        self.web3_client.provider.handlers["eth_getTransactionReceipt"] = lambda hash_: self.receipts[hash_]
+
+    def _receipt(self, number: int, sender: str, status: int = 1):
+        self.receipts[transaction_hash(number).hex()] = {
+            "transactionHash": transaction_hash(number).hex(), "from": sender, "status": hex(status),
+            "gasUsed": hex(21000), "effectiveGasPrice": hex(2),
+        }
+
+    def _record(self, processor, number: int, amount: int, token_id=None, log_index=None) -> PendingRecord:
+        return PendingRecord(processor.name, transaction_hash(number), 10, self.alice.pk, token_id, address(5), amount, log_index)
+
+    def test_the_fee_is_paid_once_and_only_by_the_sender_of_the_transaction(self):
+        processor = OutgoingERC20TransferProcessor(self.web3_client)
+        # Two transfers of a multisend sent by the account, and one made by a spender it approved
+        self._receipt(1, self.alice.public_key)
+        self._receipt(2, address(5))
+        # Nothing was received before, the balances go negative
+        with self.assertLogs("blockchain_consumer.ledger", level="WARNING"):
+            processor.persist([
+                self._record(processor, 1, 100, self.token.pk, log_index=0),
+                self._record(processor, 1, 200, self.token.pk, log_index=1),
+                self._record(processor, 2, 300, self.token.pk, log_index=0),
+            ])
+        self.assertEqual(
+            sorted(SentTransaction.objects.values_list("transaction_hash", "log_index", "fee_wei")),
+            [(transaction_hash(1), 0, 42000), (transaction_hash(1), 1, 0), (transaction_hash(2), 0, 0)]
+        )
+
+    def test_failed_transactions_move_nothing_but_still_pay_their_fee(self):
+        self._receipt(1, self.alice.public_key, status=0)
+        outgoing = OutgoingTransactionProcessor(self.web3_client)
+        with self.assertLogs("blockchain_consumer.ledger", level="WARNING"):
+            outgoing.persist([self._record(outgoing, 1, 100)])
+        self.assertEqual(list(SentTransaction.objects.values_list("amount_wei", "fee_wei")), [(0, 42000)])
+
+        incoming = IncomingTransactionProcessor(self.web3_client)
+        with self.assertLogs("blockchain_consumer.ledger", level="WARNING"):
+            incoming.persist([self._record(incoming, 1, 100)])
+        self.assertEqual(list(ReceivedTransaction.objects.values_list("amount_wei", flat=True)), [0])
+
+
+class AmountDisplayTests(WatchedAddressesTestCase):
+    def test_amounts_are_shown_without_trailing_zeros(self):
+        self.assertEqual(str(self.token.from_lowest_denomination(1500000)), "1.5")
+        self.assertEqual(str(self.token.from_lowest_denomination(0)), "0")
+        self.assertEqual(self.token.to_lowest_denomination(Decimal("1.5")), 1500000)
+        received = ReceivedTransaction(transaction_hash=transaction_hash(1), amount_wei=0, sender=address(5), receiver=self.alice)
+        self.assertEqual(str(received.amount()), "0")
+
+
+@mock.patch.object(AdminReceivedTransaction, "list_per_page", 2)
+class KeysetPaginationTests(WatchedAddressesTestCase):
+    URL = "/admin/Wallet/receivedtransaction/"
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.pks = [
+            ReceivedTransaction.objects.create(
+                transaction_hash=transaction_hash(number), amount_wei=number, sender=address(5), receiver=self.alice
+            ).pk
+            for number in range(1, 6)
+        ]
+
+    def _page(self, query: str = ""):
+        return self.client.get(self.URL + query).context["cl"]
+
+    def test_pages_follow_the_cursor_from_the_newest_rows(self):
+        first = self._page()
+        self.assertEqual([row.pk for row in first.result_list], [self.pks[4], self.pks[3]])
+        self.assertEqual(first.older_url, f"?older_than={self.pks[3]}")
+        self.assertIsNone(first.newer_url)
+
+        second = self._page(first.older_url)
+        self.assertEqual([row.pk for row in second.result_list], [self.pks[2], self.pks[1]])
+        self.assertEqual(second.newer_url, f"?newer_than={self.pks[2]}")
+
+        # The last page holds a single row, and nothing is older
+        last = self._page(second.older_url)
+        self.assertEqual([row.pk for row in last.result_list], [self.pks[0]])
+        self.assertIsNone(last.older_url)
+
+    def test_newer_pages_stop_at_the_newest_rows(self):
+        page = self._page(f"?newer_than={self.pks[0]}")
+        self.assertEqual([row.pk for row in page.result_list], [self.pks[2], self.pks[1]])
+        # Fewer newer rows than a page, the first page is shown instead
+        page = self._page(f"?newer_than={self.pks[2]}")
+        self.assertEqual([row.pk for row in page.result_list], [self.pks[4], self.pks[3]])
+        self.assertIsNone(page.newest_url)
+
+    def test_invalid_cursors_are_rejected(self):
+        self.assertEqual(self.client.get(self.URL + "?older_than=latest").status_code, 302)
+
+    def test_large_tables_are_counted_from_the_primary_keys(self):
+        ReceivedTransaction.objects.filter(pk=self.pks[2]).delete()
+        with mock.patch.object(EstimatedCountPaginator, "EXACT_COUNT_LIMIT", 0):
+            page = self._page()
+        self.assertTrue(page.result_count_estimated)
+        self.assertEqual(page.result_count, 5)
+        # Filtered lists are counted exactly
+        self.assertEqual(self._page(f"?receiver__id__exact={self.alice.pk}").result_count, 4)
+
+
+class ConfirmationSchedulerTests(WatchedAddressesTestCase):
+    PROCESSOR = "IncomingTransactionProcessor"
+    CONFIRMATIONS = 6
+
+    def _scheduler(self) -> ConfirmationScheduler:
+        scheduler = ConfirmationScheduler()
+        scheduler.register(self.PROCESSOR, self.CONFIRMATIONS)
+        scheduler.ensure_loaded()
+        return scheduler
+
+    def _record(self, number: int, block_number: int) -> PendingRecord:
+        return PendingRecord(self.PROCESSOR, transaction_hash(number), block_number, self.alice.pk, None, address(5), number)
+
+    def test_transactions_are_due_once_they_have_their_confirmations(self):
+        scheduler = self._scheduler()
+        scheduler.add([self._record(1, 10), self._record(2, 12)])
+        self.assertEqual(scheduler.pop_due(10 + self.CONFIRMATIONS - 1), [])
+        self.assertEqual([record.amount for record in scheduler.pop_due(10 + self.CONFIRMATIONS)], [1])
+        # A block skipped over still releases every bucket up to it
+        self.assertEqual([record.amount for record in scheduler.pop_due(100)], [2])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_a_block_seen_twice_is_scheduled_once(self):
+        scheduler = self._scheduler()
+        scheduler.add([self._record(1, 10)])
+        scheduler.add([self._record(1, 10)])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(PendingTransaction.objects.count(), 1)
+
+    def test_pending_transactions_survive_a_restart_until_completed(self):
+        self._scheduler().add([self._record(1, 10), self._record(2, 11)])
+
+        restored = self._scheduler()
+        self.assertEqual(len(restored), 2)
+        due = restored.pop_due(11 + self.CONFIRMATIONS)
+        restored.complete(due)
+        self.assertEqual(PendingTransaction.objects.count(), 0)
+        self.assertEqual(len(self._scheduler()), 0)
+
+    def test_failed_transactions_are_retried_at_the_given_block(self):
+        scheduler = self._scheduler()
+        scheduler.add([self._record(1, 10)])
+        due = scheduler.pop_due(20)
+        scheduler.retry(due, 21)
+        self.assertEqual(scheduler.pop_due(20), [])
+        self.assertEqual(scheduler.pop_due(21), due)
+        # Never completed, so still stored
+        self.assertEqual(PendingTransaction.objects.count(), 1)
+
+    def test_rollback_drops_the_transactions_of_later_blocks(self):
+        scheduler = self._scheduler()
+        scheduler.add([self._record(1, 10), self._record(2, 11), self._record(3, 12)])
+        self.assertEqual(scheduler.rollback(10), 2)
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(list(PendingTransaction.objects.values_list("block_number", flat=True)), [10])
+        self.assertEqual([record.amount for record in scheduler.pop_due(100)], [1])
+
+
+class ChainReorganizationTests(WatchedAddressesTestCase):
+    HEAD = 20
+
+    def setUp(self):
+        super().setUp()
+        # The chain the blocks were processed from, until the node switched to another branch
+        self.chain = self._branch(self.HEAD, fork_block=None)
+        self.web3_client.provider.handlers["eth_getBlockByNumber"] = lambda number, full: self.chain[int(number, 16)]
+
+    @staticmethod
+    def _branch(head: int, fork_block):
+        chain = []
+        for number in range(head + 1):
+            branch = 2 if fork_block is not None and number >= fork_block else 1
+            chain.append({
+                "number": hex(number), "hash": "0x" + (branch << 128 | number).to_bytes(32, "big").hex(),
+                "parentHash": chain[-1]["hash"] if chain else "0x" + "00" * 32, "timestamp": hex(number), "transactions": [],
+            })
+        return chain
+
+    def _fetcher(self, history_size: int) -> BlockFetcher:
+        fetcher = BlockFetcher(self.web3_client, reorg_history_size=history_size)
+        processor = IncomingTransactionProcessor(self.web3_client)
+        fetcher.subscribe(processor)
+        runner = ProcessorRunner(processor, fetcher._dispatcher, fetcher._cache)
+        runner.set_cursor(self.HEAD)
+        fetcher._runners = [runner]
+        for number in range(self.HEAD + 1):
+            fetcher._history.append(self.web3_client.eth.get_block(number))
+        fetcher._last_processed_block = self.web3_client.eth.get_block(self.HEAD)
+        # Waiting for their confirmations, in the blocks about to be orphaned and before them
+        fetcher._dispatcher.scheduler(processor).add([
+            PendingRecord(processor.name, transaction_hash(number), number, self.alice.pk, None, address(5), 1)
+            for number in (16, 18)
+        ])
+        self.runner = runner
+        return fetcher
+
+    def test_orphaned_blocks_are_rewound_to_the_fork_point(self):
+        fetcher = self._fetcher(history_size=64)
+        self.chain = self._branch(self.HEAD + 1, fork_block=18)
+        with self.assertLogs("blockchain_consumer.block_fetcher", level="WARNING") as logs:
+            fetcher._rewind(self.web3_client.eth.get_block(self.HEAD + 1))
+        self.assertFalse(any(record.levelname == "ERROR" for record in logs.records))
+
+        self.assertEqual(fetcher._last_processed_block["number"], 17)
+        self.assertEqual(self.runner.cursor, 17)
+        self.assertEqual(list(PendingTransaction.objects.values_list("block_number", flat=True)), [16])
+        # The new branch continues from the fork point
+        self.assertTrue(fetcher._history.extends(self.web3_client.eth.get_block(18)))
+
+    def test_reorganizations_past_the_confirmation_depth_are_reported(self):
+        fetcher = self._fetcher(history_size=64)
+        # Blocks up to 14 had their 6 confirmations, the new branch starts at block 12
+        self.chain = self._branch(self.HEAD + 1, fork_block=12)
+        with self.assertLogs("blockchain_consumer.block_fetcher", level="ERROR") as logs:
+            fetcher._rewind(self.web3_client.eth.get_block(self.HEAD + 1))
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("already confirmed", logs.output[0])
+        self.assertEqual(fetcher._last_processed_block["number"], 11)
+        self.assertEqual(PendingTransaction.objects.count(), 0)
+
+    def test_reorganizations_past_the_history_rewind_as_far_as_it_goes(self):
+        # Only the last 3 blocks are remembered
+        fetcher = self._fetcher(history_size=3)
+        self.chain = self._branch(self.HEAD + 1, fork_block=12)
+        with self.assertLogs("blockchain_consumer.block_fetcher", level="ERROR") as logs:
+            fetcher._rewind(self.web3_client.eth.get_block(self.HEAD + 1))
+        self.assertIn("deeper than the last 3 blocks", logs.output[0])
+        self.assertEqual(fetcher._last_processed_block["number"], 17)
+        self.assertEqual(list(PendingTransaction.objects.values_list("block_number", flat=True)), [16])
+
+
+class TransactionExportTests(WatchedAddressesTestCase):
+    URL = "/transactions/export/"
+
+    def setUp(self):
+        super().setUp()
+        for number in range(1, 6):
+            ReceivedTransaction.objects.create(
+                transaction_hash=transaction_hash(number), block_number=number, amount_wei=number * 500000,
+                sender=address(5), receiver=self.alice, token=self.token
+            )
+        SentTransaction.objects.create(
+            transaction_hash=transaction_hash(6), block_number=6, amount_wei=10 ** 18, fee_wei=21000,
+            sender=self.bob, receiver=address(5)
+        )
+
+    def test_rows_are_streamed_in_chunks(self):
+        chunks = list(TransactionExport(chunk_size=2).stream("csv"))
+        # Six rows, in batches of two
+        self.assertEqual(len(chunks), 3)
+        rows = list(csv.DictReader("".join(chunks).splitlines()))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(
+            (rows[0]["direction"], rows[0]["tx_hash"], rows[0]["amount"], rows[0]["fee_wei"]),
+            ("sent", transaction_hash(6).hex(), "1.000000000000000000", "21000")
+        )
+        self.assertEqual((rows[1]["token"], rows[1]["amount"], rows[1]["account"]), ("TKN", "0.500000", self.alice.public_key))
+
+    def test_filters_narrow_the_rows(self):
+        export = TransactionExport(direction="received", account=self.alice.public_key.lower(), token="tkn", from_block=2, to_block=3)
+        rows = [json.loads(line) for chunk in export.stream("ndjson") for line in chunk.splitlines()]
+        self.assertEqual([(row["block_number"], row["amount_wei"]) for row in rows], [(2, "1000000"), (3, "1500000")])
+        self.assertEqual(list(TransactionExport(token="ETH").stream("ndjson")), [json.dumps(dict(
+            direction="sent", tx_hash=transaction_hash(6).hex(), log_index=None, block_number=6,
+            account=self.bob.public_key, counterparty=address(5), token="ETH", token_contract="",
+            amount="1.000000000000000000", amount_wei=str(10 ** 18), fee_wei="21000"
+        )) + "\n"])
+
+    def test_invalid_parameters_are_rejected_before_streaming(self):
+        with self.assertRaises(ValueError):
+            TransactionExport(direction="incoming")
+        with self.assertRaises(ValueError):
+            TransactionExport(account=address(6))
+        with self.assertRaises(ValueError):
+            TransactionExport().stream("xlsx")
+
+    def test_time_ranges_are_turned_into_blocks(self):
+        # A block every 10 seconds
+        self.web3_client.provider.handlers.update({
+            "eth_blockNumber": lambda: hex(100),
+            "eth_getBlockByNumber": lambda number, full: {"number": number, "timestamp": hex(int(number, 16) * 10)},
+        })
+        self.assertEqual(first_block_since(self.web3_client, 250), 25)
+        self.assertEqual(first_block_since(self.web3_client, 251), 26)
+        self.assertEqual(first_block_since(self.web3_client, 5000), 101)
+
+    def test_the_view_is_for_staff_only(self):
+        self.assertEqual(self.client.get(self.URL).status_code, 302)
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        response = self.client.get(self.URL, {"format": "ndjson", "direction": "sent"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson; charset=utf-8")
+        self.assertEqual(len(b"".join(response.streaming_content).splitlines()), 1)
+        self.assertEqual(self.client.get(self.URL, {"from_block": "latest"}).status_code, 400)
+
+
+class TransferLogFailureTests(WatchedAddressesTestCase):
+    def _fetcher(self) -> BlockFetcher:
+        fetcher = BlockFetcher(self.web3_client)
+        fetcher.ROUTE_RETRY_DELAY = 0
+        fetcher.subscribe(IncomingERC20TransferProcessor(self.web3_client))
+        return fetcher
+
+    def _transfers(self) -> Dict[int, list]:
+        return {10: [AttributeDict({
+            "hash": transaction_hash(1), "blockNumber": 10, "logIndex": 0, "token": self.token.contract_address,
+            "from": address(5), "to": self.alice.public_key, "value": 100,
+        })]}
+
+    def test_a_block_is_not_routed_without_its_transfers(self):
+        fetcher = self._fetcher()
+        with mock.patch.object(fetcher._transfer_source, "get_transfers", side_effect=ConnectionError("429")):
+            with self.assertRaises(ConnectionError):
+                fetcher._dispatcher.route_block({"number": 10, "transactions": []})
+
+    def test_the_transfers_are_fetched_again_until_they_can_be_routed(self):
+        fetcher = self._fetcher()
+        side_effect = [ConnectionError("429"), self._transfers()]
+        with mock.patch.object(fetcher._transfer_source, "get_transfers", side_effect=side_effect):
+            with self.assertLogs("blockchain_consumer.block_fetcher", level="ERROR"):
+                routed = fetcher._route_block({"number": 10, "transactions": []})
+        self.assertEqual([len(transfers) for transfers in routed.values()], [1])
+
+
+class PayoutResubmissionTests(WatchedAddressesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.known = set()
+        self.web3_client.provider.handlers.update({
+            "eth_gasPrice": lambda: hex(1),
+            "eth_chainId": lambda: hex(1),
+            "eth_getTransactionCount": lambda account, block: hex(7),
+            "eth_getTransactionByHash": lambda hash_: {"hash": hash_} if hash_ in self.known else None,
+        })
+
+    def _pay(self, reply: str, reached_node: bool) -> Payout:
+        def send_raw_transaction(raw_transaction: str):
+            if reached_node:
+                # An earlier attempt of the same request was received, but its response was lost
+                self.known.add(Web3.keccak(hexstr=raw_transaction).hex())
+            raise RpcError({"code": -32000, "message": reply})
+
+        self.web3_client.provider.handlers["eth_sendRawTransaction"] = send_raw_transaction
+        return PayoutEngine(self.web3_client).pay([Payout(self.alice, address(5), 100)])[0]
+
+    def test_a_transaction_the_node_already_has_was_sent(self):
+        for reply in ("already known", "nonce too low"):
+            payout = self._pay(reply, reached_node=True)
+            self.assertIsNone(payout.error)
+            self.assertIn(Web3.toHex(payout.transaction_hash), self.known)
+
+    def test_a_nonce_used_by_another_transaction_is_an_error(self):
+        with self.assertLogs("Wallet.payouts", level="ERROR"):
+            payout = self._pay("nonce too low", reached_node=False)
+        self.assertIn("nonce too low", payout.error)
+        self.assertIsNone(payout.transaction_hash)
+
+
+class PayoutNonceTests(WatchedAddressesTestCase):
+    def setUp(self):
+        super().setUp()
+        # Next nonce of each account on the chain, and (sender, nonce) of every transaction sent
+        self.chain_nonces = {self.alice.public_key: 7, self.bob.public_key: 3}
+        self.sent = []
+        self.failing = set()
+        self.web3_client.provider.handlers.update({
+            "eth_gasPrice": lambda: hex(1),
+            "eth_chainId": lambda: hex(1),
+            "eth_getTransactionCount": lambda account, block: hex(self.chain_nonces[account]),
+            "eth_sendRawTransaction": self._send_raw_transaction,
+        })
+        self.engine = PayoutEngine(self.web3_client)
+
+    def _send_raw_transaction(self, raw_transaction: str) -> str:
+        sender = EthAccount.recover_transaction(raw_transaction)
+        nonce = int.from_bytes(rlp.decode(HexBytes(raw_transaction))[0], "big")
+        self.sent.append((sender, nonce))
+        if sender in self.failing:
+            raise RpcError({"code": -32000, "message": "insufficient funds for gas * price + value"})
+        return Web3.keccak(hexstr=raw_transaction).hex()
+
+    def _nonces(self, account: Account):
+        return [nonce for sender, nonce in self.sent if sender == account.public_key]
+
+    def test_nonces_are_allocated_in_order_within_and_across_batches(self):
+        self.engine.pay([Payout(self.alice, address(5), 1), Payout(self.bob, address(5), 1), Payout(self.alice, address(5), 2)])
+        self.engine.pay([Payout(self.alice, address(5), 3), Payout(self.bob, address(5), 2)])
+        self.assertEqual(self._nonces(self.alice), [7, 8, 9])
+        self.assertEqual(self._nonces(self.bob), [3, 4])
+        # Read from the chain once per account
+        self.assertEqual(self.web3_client.provider.calls.count("eth_getTransactionCount"), 2)
+
+    def test_the_nonce_is_read_again_after_a_failed_submission(self):
+        self.failing.add(self.alice.public_key)
+        with self.assertLogs("Wallet.payouts", level="ERROR"):
+            payouts = self.engine.pay([Payout(self.alice, address(5), 1), Payout(self.bob, address(5), 1)])
+        self.assertEqual([payout.error is None for payout in payouts], [False, True])
+
+        # The chain still expects nonce 7 from alice, bob's next nonce is known locally
+        self.failing.clear()
+        self.engine.pay([Payout(self.alice, address(5), 1), Payout(self.bob, address(5), 1)])
+        self.assertEqual(self._nonces(self.alice), [7, 7])
+        self.assertEqual(self._nonces(self.bob), [3, 4])
+        self.assertEqual(self.web3_client.provider.calls.count("eth_getTransactionCount"), 3)
+
+    def test_the_nonces_are_read_again_when_a_batch_couldnt_be_sent(self):
+        self.web3_client.provider.handlers["eth_sendRawTransaction"] = mock.Mock(side_effect=ConnectionError("timed out"))
+        with self.assertRaises(ConnectionError):
+            self.engine.pay([Payout(self.alice, address(5), 1)])
+
+        # The transaction may have reached the node, which the chain tells
+        self.chain_nonces[self.alice.public_key] = 8
+        self.web3_client.provider.handlers["eth_sendRawTransaction"] = self._send_raw_transaction
+        self.engine.pay([Payout(self.alice, address(5), 1)])
+        self.assertEqual(self._nonces(self.alice), [8])
+
+
+class AccountKeyTests(TestCase):
+    MNEMONIC = "test test test test test test test test test test test junk"
+
+    def test_loaded_accounts_keep_their_keys(self):
+        created = Account.objects.create(name="alice")
+        with mock.patch.object(EthAccount, "create") as create:
+            loaded = Account.objects.get()
+            list(Account.objects.all())
+        create.assert_not_called()
+        self.assertEqual((loaded.public_key, bytes(loaded.private_key)), (created.public_key, bytes(created.private_key)))
+
+    def test_provisioned_keys_match_the_hd_wallet(self):
+        EthAccount.enable_unaudited_hdwallet_features()
+        provisioner = AccountProvisioner(self.MNEMONIC, base_path=settings.ACCOUNT_HD_PATH, processes=1)
+        provisioner.provision(6)
+        for index in (0, 1, 5):
+            expected = EthAccount.from_mnemonic(self.MNEMONIC, account_path=f"{settings.ACCOUNT_HD_PATH}/{index}")
+            account = Account.objects.get(derivation_index=index)
+            self.assertEqual((account.public_key, bytes(account.private_key)), (expected.address, bytes(expected.key)))
+        # Provisioning again continues after the last derived account
+        self.assertEqual(provisioner.provision(2), range(6, 8))
+
+
+class ContractCacheTests(WatchedAddressesTestCase):
+    def test_contracts_are_rebuilt_only_when_the_token_changes(self):
+        self.token.abi = json.dumps(TRANSFER_ABI)
+        self.token.save()
+        compiled = contract_cache.get(self.web3_client, self.token)
+        self.assertIs(contract_cache.get(self.web3_client, self.token), compiled)
+        self.assertEqual(compiled.function_name("0xa9059cbb" + "00" * 64), "transfer")
+
+        # Saving the token drops its entry, the new ABI applies from the next call on
+        self.token.abi = "[]"
+        self.token.save()
+        rebuilt = contract_cache.get(self.web3_client, self.token)
+        self.assertIsNot(rebuilt, compiled)
+        self.assertIsNone(rebuilt.function_name("0xa9059cbb" + "00" * 64))
+
+
+class TransferDecodingTests(WatchedAddressesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.token.abi = json.dumps(TRANSFER_ABI)
+        self.token.save()
+
+    def _call(self, function: str, receiver: Account, amount: int) -> AttributeDict:
+        contract = self.web3_client.eth.contract(address=self.token.contract_address, abi=TRANSFER_ABI + [{
+            "type": "function", "name": "approve",
+            "inputs": [{"name": "spender", "type": "address"}, {"name": "amount", "type": "uint256"}],
+        }])
+        return AttributeDict({
+            "hash": transaction_hash(amount), "blockNumber": 10, "from": address(5), "to": self.token.contract_address,
+            "value": 0, "input": contract.encodeABI(fn_name=function, args=[receiver.public_key, amount])
+        })
+
+    def test_only_transfer_calls_are_decoded(self):
+        processor = IncomingERC20Processor(self.web3_client)
+        records = processor.filter({"number": 10}, [self._call("transfer", self.alice, 500), self._call("approve", self.bob, 1)])
+        self.assertEqual([(record.account_id, record.amount) for record in records], [(self.alice.pk, 500)])
+
+    def test_worker_processes_decode_with_the_cached_input_types(self):
+        types = contract_cache.get(self.web3_client, self.token).function(self._call("transfer", self.alice, 1)["input"])[1]
+        items = [(types, self._call("transfer", self.bob, amount)["input"]) for amount in range(1, 5)]
+        decoder = ProcessPoolTransferDecoder(processes=1, chunk_size=1)
+        self.addCleanup(lambda: decoder._get_pool().shutdown())
+        self.assertEqual(decoder.decode(items), [(self.bob.public_key, amount) for amount in range(1, 5)])
+
+
+class BloomPrefilterTests(WatchedAddressesTestCase):
+    def _dispatcher(self, *processor_classes) -> BlockDispatcher:
+        dispatcher = BlockDispatcher()
+        for processor_class in processor_classes:
+            dispatcher.subscribe(processor_class(self.web3_client))
+        return dispatcher
+
+    def test_blocks_without_our_transfers_are_skipped_by_the_token_routes(self):
+        headers = [
+            {"number": 10, "transactions": [transaction_hash(1)], "logsBloom": bytes(256)},
+            {"number": 11, "transactions": [], "logsBloom": b"\xff" * 256},
+            {"number": 12, "transactions": [transaction_hash(2)], "logsBloom": b"\xff" * 256},
+        ]
+        dispatcher = self._dispatcher(IncomingERC20Processor)
+        self.assertEqual(dispatcher.needs_transactions(headers), [False, False, True])
+
+    def test_the_prefilter_is_disabled_while_eth_is_followed(self):
+        self.assertIsNotNone(self._dispatcher(IncomingERC20Processor).bloom_prefilter())
+        dispatcher = self._dispatcher(IncomingERC20Processor, IncomingTransactionProcessor)
+        with self.assertLogs("blockchain_consumer.dispatcher", level="WARNING"):
+            self.assertIsNone(dispatcher.bloom_prefilter())
+
+    def test_blocks_are_fetched_in_one_request_without_a_prefilter(self):
+        self.web3_client.provider.handlers["eth_getBlockByNumber"] = lambda number, full: {
+            "number": number, "transactions": [], "logsBloom": "0x" + "00" * 256
+        }
+        source = BatchBlockSource(self.web3_client)
+        source.get_blocks([10, 11])
+        self.assertEqual(len(self.web3_client.provider.calls), 2)
+
+    @override_settings(TRACK_ETH_TRANSACTIONS=False)
+    def test_eth_tracking_can_be_turned_off(self):
+        processors = build_processors(self.web3_client)
+        self.assertEqual([type(processor) for processor in processors], [IncomingERC20Processor, OutgoingERC20Processor])
+        dispatcher = BlockDispatcher()
+        for processor in processors:
+            dispatcher.subscribe(processor)
+        self.assertIsNotNone(dispatcher.bloom_prefilter())
+
+
+class FlakyProcessor(IncomingTransactionProcessor):
+    # Fails to store the first `failures` batches it's given
+    def __init__(self, web3_client: Web3, failures: int):
+        super().__init__(web3_client)
+        self.failures = failures
+        self.persisted = []
+
+    def persist(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        self.persisted.extend(records)
+
+
+class BrokenFilterProcessor(IncomingTransactionProcessor):
+    def _filter_transactions(self, block, transactions):
+        raise RuntimeError("filter failed")
+
+
+class ScriptedProcessor(IncomingTransactionProcessor):
+    # Has a transaction in every block, but fails to filter or to store the ones of the given blocks
+    def __init__(self, web3_client: Web3, name: str, filter_failures=(), persist_failures=()):
+        super().__init__(web3_client)
+        self._name = name
+        self.filter_failures = set(filter_failures)
+        self.persist_failures = set(persist_failures)
+        self.filtered = []
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def filter(self, block, transactions=None):
+        if block["number"] in self.filter_failures:
+            raise RuntimeError("filter failed")
+        self.filtered.append(block["number"])
+        return [PendingRecord(self.name, transaction_hash(block["number"]), block["number"], 1, None, address(5), 1)]
+
+    def persist(self, records):
+        if any(record.block_number in self.persist_failures for record in records):
+            raise RuntimeError("database is locked")
+
+
+class PipelinePersistenceTests(WatchedAddressesTestCase):
+    def _pipeline(self, processor: FlakyProcessor) -> AsyncBlockPipeline:
+        pipeline = AsyncBlockPipeline(self.web3_client)
+        pipeline.PERSIST_RETRY_DELAY = 0
+        pipeline.subscribe(processor)
+        return pipeline
+
+    def _records(self, processor: FlakyProcessor, block_number: int):
+        record = PendingRecord(processor.name, transaction_hash(block_number), block_number, self.alice.pk, None, address(5), 1)
+        return {processor.name: [record]}
+
+    def test_confirmed_blocks_are_retried(self):
+        processor = FlakyProcessor(self.web3_client, failures=2)
+        with self.assertLogs("blockchain_consumer", level="ERROR"):
+            self._pipeline(processor)._persist_block(100, self._records(processor, 100), None)
+        self.assertEqual(len(processor.persisted), 1)
+        self.assertEqual(BlockCheckpoint.load(AsyncBlockPipeline.CHECKPOINT_NAME), 100 - processor.CONFIRMATIONS_REQUIRED)
+
+    def test_checkpoint_stays_before_a_block_that_failed(self):
+        processor = FlakyProcessor(self.web3_client, failures=AsyncBlockPipeline.PERSIST_RETRIES + 1)
+        pipeline = self._pipeline(processor)
+        with self.assertLogs("blockchain_consumer", level="ERROR"):
+            pipeline._persist_block(100, self._records(processor, 100), None)
+        pipeline._persist_block(150, self._records(processor, 150), None)
+        # Block 150 was stored, but the checkpoint can't skip block 100
+        self.assertEqual([record.block_number for record in processor.persisted], [150])
+        self.assertEqual(BlockCheckpoint.load(AsyncBlockPipeline.CHECKPOINT_NAME), 99)
+
+    def test_a_processor_that_failed_to_filter_a_block_did_not_handle_it(self):
+        processor = BrokenFilterProcessor(self.web3_client)
+        dispatcher = BlockDispatcher()
+        dispatcher.subscribe(processor)
+        block = {"number": 100, "transactions": []}
+        with self.assertLogs("blockchain_consumer.dispatcher", level="ERROR"):
+            self.assertEqual(dispatcher.filter_block(block), ({}, [processor.name]))
+            self.assertEqual(dispatcher.dispatch(block, confirmed=True), [processor.name])
+
+        pipeline = self._pipeline(FlakyProcessor(self.web3_client, failures=0))
+        with self.assertLogs("blockchain_consumer", level="ERROR"):
+            pipeline._persist_block(100, {}, 101, [processor.name])
+        pipeline._persist_block(150, {}, 151)
+        self.assertEqual(BlockCheckpoint.load(AsyncBlockPipeline.CHECKPOINT_NAME), 99)
+
+    def test_blocks_are_fetched_through_the_shared_client(self):
+        self.web3_client.provider.handlers.update({
+            "eth_blockNumber": lambda: hex(11),
+            "eth_getBlockByNumber": lambda number, full: {"number": number, "transactions": []},
+        })
+        pipeline = self._pipeline(FlakyProcessor(self.web3_client, failures=0))
+
+        async def fetch():
+            return await pipeline._head_block_number(), await pipeline._get_blocks([10, 11])
+
+        head, blocks = asyncio.run(fetch())
+        pipeline._fetch_executor.shutdown()
+        self.assertEqual(head, 11)
+        self.assertEqual([block["number"] for block in blocks], [10, 11])
+        self.assertEqual(self.web3_client.provider.calls, ["eth_blockNumber", "eth_getBlockByNumber", "eth_getBlockByNumber"])
+
+
+class FakeBlockCache:
+    # Serves empty blocks up to the head, and stops the runner once it asks for a later one
+    def __init__(self, head: int, on_get: Callable[[int], None] = None):
+        self.head = head
+        self.on_get = on_get
+        self.runner = None
+
+    def get(self, block_number: int, timeout):
+        if self.on_get is not None:
+            self.on_get(block_number)
+        if block_number > self.head:
+            self.runner.stop()
+            return None
+        return {"number": block_number, "transactions": []}, {self.runner.processor.ROUTE: []}
+
+
+class ProcessorRunnerTests(WatchedAddressesTestCase):
+    def _runner(self, processor: IncomingTransactionProcessor, cache: FakeBlockCache, cursor: int, **kwargs) -> ProcessorRunner:
+        dispatcher = BlockDispatcher()
+        dispatcher.subscribe(processor)
+        runner = ProcessorRunner(processor, dispatcher, cache, **kwargs)
+        runner.set_cursor(cursor)
+        cache.runner = runner
+        return runner
+
+    def test_a_failing_block_is_retried_from_the_cursor_with_backoff(self):
+        processor = FlakyProcessor(self.web3_client, failures=4)
+        runner = self._runner(processor, FakeBlockCache(head=16), cursor=15, retry_delay=1, max_retry_delay=3)
+        runner._scheduler.add([PendingRecord(processor.name, transaction_hash(1), 10, self.alice.pk, None, address(5), 1)])
+
+        waits = []
+        with mock.patch.object(runner._stopped, "wait", side_effect=lambda delay: waits.append((delay, runner.cursor))):
+            with self.assertLogs("blockchain_consumer.runner", level="ERROR"):
+                runner.run()
+        # The cursor stays before the block until its transaction, due at block 16, is stored
+        self.assertEqual(waits, [(1, 15), (2, 15), (3, 15), (3, 15)])
+        self.assertEqual(len(processor.persisted), 1)
+        self.assertEqual(BlockCheckpoint.load(runner.cursor_name), 16)
+
+    def test_a_block_read_before_a_rewind_is_not_processed(self):
+        processor = ScriptedProcessor(self.web3_client, "scripted")
+
+        def rewind_once(block_number):
+            if block_number == 21 and not processor.filtered:
+                runner.rewind(18)
+
+        runner = self._runner(processor, FakeBlockCache(head=21, on_get=rewind_once), cursor=20)
+        runner.run()
+        self.assertEqual(processor.filtered, [19, 20, 21])
+        self.assertEqual(runner.cursor, 21)
+
+
+class SerialExecutor:
+    # Runs the work on the calling thread, which sees the rows of the test's transaction
+    def __init__(self, max_workers: int = None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def map(self, function, *iterables):
+        return map(function, *iterables)
+
+
+class CatchUpTests(WatchedAddressesTestCase):
+    HEAD = 26
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("blockchain_consumer.backfill.ThreadPoolExecutor", SerialExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.web3_client.provider.handlers.update({
+            "eth_blockNumber": lambda: hex(self.HEAD),
+            "eth_getBlockByNumber": lambda number, full: {"number": number, "transactions": []},
+        })
+        # The first processor fails to filter block 12, the second to store block 17
+        self.processors = [
+            ScriptedProcessor(self.web3_client, "filter", filter_failures=[12, 15]),
+            ScriptedProcessor(self.web3_client, "persist", persist_failures=[17]),
+            ScriptedProcessor(self.web3_client, "healthy"),
+            ScriptedProcessor(self.web3_client, "ahead"),
+        ]
+
+    def _dispatcher(self) -> BlockDispatcher:
+        dispatcher = BlockDispatcher()
+        for processor in self.processors:
+            dispatcher.subscribe(processor)
+        return dispatcher
+
+    def test_the_backfiller_reports_the_first_block_each_processor_failed(self):
+        backfiller = Backfiller(self.web3_client, self._dispatcher(), workers=1, chunk_size=3, batch_size=2)
+        with self.assertLogs("blockchain_consumer.dispatcher", level="ERROR"):
+            self.assertEqual(backfiller.run(10, 20), {"filter": 12, "persist": 17})
+        self.assertEqual(backfiller.run(18, 20), {})
+
+    def test_processors_resume_from_their_own_cursors(self):
+        fetcher = BlockFetcher(self.web3_client, backfill_workers=1, batch_size=5)
+        for processor in self.processors:
+            fetcher.subscribe(processor)
+        BlockCheckpoint.store(fetcher.CHECKPOINT_NAME, 9)
+        BlockCheckpoint.store(ProcessorRunner.CURSOR_PREFIX + "persist", 14)
+        BlockCheckpoint.store(ProcessorRunner.CURSOR_PREFIX + "ahead", 22)
+
+        with mock.patch.object(ProcessorRunner, "run"), self.assertLogs("blockchain_consumer", level="ERROR"):
+            fetcher._resume()
+        fetcher.stop()
+        # Blocks up to 20 are confirmed, each processor that fell behind continues from the block it failed at
+        cursors = {runner.processor.name: runner.cursor for runner in fetcher._runners}
+        self.assertEqual(cursors, {"filter": 11, "persist": 16, "healthy": 20, "ahead": 22})
+        self.assertEqual(self.processors[1].filtered[0], 10)
+        self.assertEqual(self.processors[3].filtered, [])
+
+
+class ConsumerLeaseTests(TestCase):
+    DURATION = timedelta(seconds=30)
+
+    def _expire(self, name: str):
+        ConsumerLease.objects.filter(name=name).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_a_single_instance_holds_the_lease(self):
+        self.assertTrue(ConsumerLease.acquire("consumer", "first", self.DURATION))
+        self.assertFalse(ConsumerLease.acquire("consumer", "second", self.DURATION))
+        # Renewed by its holder, while other names are leased independently
+        self.assertTrue(ConsumerLease.acquire("consumer", "first", self.DURATION))
+        self.assertTrue(ConsumerLease.acquire("consumer@1/2", "second", self.DURATION))
+
+        ConsumerLease.release("consumer", "second")
+        self.assertFalse(ConsumerLease.acquire("consumer", "second", self.DURATION))
+        ConsumerLease.release("consumer", "first")
+        self.assertTrue(ConsumerLease.acquire("consumer", "second", self.DURATION))
+
+    def test_an_expired_lease_is_taken_over(self):
+        ConsumerLease.acquire("consumer", "first", self.DURATION)
+        self._expire("consumer")
+        self.assertTrue(ConsumerLease.acquire("consumer", "second", self.DURATION))
+        self.assertFalse(ConsumerLease.acquire("consumer", "first", self.DURATION))
+        self.assertEqual(ConsumerLease.objects.get().owner, "second")
+
+    def test_the_lease_is_held_until_the_consumer_stops(self):
+        ConsumerLease.acquire("consumer", "first", self.DURATION)
+        thread = mock.Mock(is_alive=mock.Mock(side_effect=[True, True, False]))
+        with mock.patch("blockchain_consumer.consumer.sleep"):
+            self.assertTrue(_hold_lease("consumer", "first", self.DURATION, thread))
+
+    def test_the_consumer_stands_down_once_the_lease_is_lost(self):
+        ConsumerLease.acquire("consumer", "first", self.DURATION)
+        thread = mock.Mock(is_alive=mock.Mock(return_value=True))
+
+        def take_over(seconds):
+            self._expire("consumer")
+            ConsumerLease.acquire("consumer", "second", self.DURATION)
+
+        with mock.patch("blockchain_consumer.consumer.sleep", side_effect=take_over):
+            self.assertFalse(_hold_lease("consumer", "first", self.DURATION, thread))
+
+    def test_the_consumer_stands_down_when_the_lease_cant_be_renewed_in_time(self):
+        thread = mock.Mock(is_alive=mock.Mock(return_value=True))
+        with mock.patch("blockchain_consumer.consumer.sleep"), \
+                mock.patch("blockchain_consumer.consumer.monotonic", side_effect=[0, 10, 20, 30]), \
+                mock.patch.object(ConsumerLease, "acquire", side_effect=ConnectionError("database is unreachable")), \
+                self.assertLogs("blockchain_consumer.consumer", level="ERROR") as logs:
+            self.assertFalse(_hold_lease("consumer", "first", self.DURATION, thread))
+        self.assertEqual(len(logs.records), 3)
+
+    def test_run_consumer_stops_the_block_fetcher_once_the_lease_is_lost(self):
+        class BlockingFetcher:
+            def __init__(self):
+                self.stopped = threading.Event()
+
+            def start(self):
+                self.stopped.wait()
+
+            def stop(self):
+                self.stopped.set()
+
+        class StandDown(Exception):
+            pass
+
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 1:
+                # Another instance takes over while the consumer runs
+                self._expire("consumer")
+                ConsumerLease.acquire("consumer", "other", self.DURATION)
+            else:
+                raise StandDown()
+
+        block_fetcher = BlockingFetcher()
+        with mock.patch("blockchain_consumer.consumer.build_block_fetcher", return_value=block_fetcher), \
+                mock.patch("blockchain_consumer.consumer.start_balance_reconciliation"), \
+                mock.patch("blockchain_consumer.consumer.sleep", side_effect=sleep), \
+                self.assertLogs("blockchain_consumer.consumer", level="ERROR"):
+            with self.assertRaises(StandDown):
+                run_consumer(Web3(FakeProvider()), lease_duration=self.DURATION)
+        self.assertTrue(block_fetcher.stopped.is_set())
+        self.assertEqual(list(ConsumerLease.objects.values_list("owner", flat=True)), ["other"])
+
+
+class ShardTests(SimpleTestCase):
+    def test_every_address_is_owned_by_exactly_one_shard(self):
+        addresses = [address(number) for number in range(1, 1001)]
+        for count in (2, 3, 8):
+            shards = [Shard(index, count) for index in range(count)]
+            owners = [[shard.owns(account) for shard in shards] for account in addresses]
+            self.assertTrue(all(sum(owned) == 1 for owned in owners))
+            # Spread over all the shards
+            self.assertTrue(all(any(owned[index] for owned in owners) for index in range(count)))
+            # Whatever the case of the address
+            self.assertEqual([[shard.owns(account.lower()) for shard in shards] for account in addresses], owners)
+
+    def test_a_single_shard_owns_everything(self):
+        self.assertTrue(Shard().owns(address(1)))
+        self.assertFalse(Shard(0, 2).owns(None))
+        with self.assertRaises(ValueError):
+            Shard(2, 2)
+
+
+class ChainCacheTests(SimpleTestCase):
+    HEAD = 100
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "chain_cache.sqlite")
+
+    def _cache(self, max_bytes: int) -> ChainDataCache:
+        cache = ChainDataCache(self.path, max_bytes)
+        self.addCleanup(cache._connection.close)
+        return cache
+
+    def _provider(self) -> PooledHTTPProvider:
+        provider = PooledHTTPProvider(
+            ["http://node"], cache=self._cache(10 ** 6), cache_confirmations=settings.CHAIN_CACHE_CONFIRMATIONS
+        )
+        provider._endpoints[0].head_block_number = self.HEAD
+        return provider
+
+    def _cached(self, provider: PooledHTTPProvider, calls) -> list:
+        provider.store_responses(calls, [{"jsonrpc": "2.0", "id": 1, "result": {"number": "0x1"}} for _ in calls])
+        return [response is not None for response in provider.cached_responses(calls)]
+
+    def test_only_blocks_with_enough_confirmations_are_cached(self):
+        final = self.HEAD - settings.CHAIN_CACHE_CONFIRMATIONS
+        calls = [
+            ("eth_getBlockByNumber", [hex(final), True]),
+            ("eth_getBlockByNumber", [hex(final + 1), True]),
+            ("eth_getLogs", [{"fromBlock": hex(final - 10), "toBlock": hex(final)}]),
+            ("eth_getLogs", [{"fromBlock": hex(final - 10), "toBlock": hex(final + 1)}]),
+        ]
+        self.assertEqual(self._cached(self._provider(), calls), [True, False, True, False])
+
+        # Until a head was seen, nothing is final
+        provider = self._provider()
+        provider._endpoints[0].head_block_number = None
+        self.assertEqual(self._cached(provider, [("eth_getBlockByNumber", [hex(final - 1), True])]), [False])
+
+    def test_tags_are_never_cached(self):
+        calls = [
+            ("eth_getBlockByNumber", ["latest", True]),
+            ("eth_getBlockByNumber", ["finalized", True]),
+            ("eth_getLogs", [{"fromBlock": "latest"}]),
+            ("eth_getLogs", [{"fromBlock": hex(10)}]),
+            ("eth_blockNumber", []),
+            ("eth_getBalance", [address(1), hex(10)]),
+        ]
+        self.assertEqual(self._cached(self._provider(), calls), [False] * len(calls))
+        self.assertIsNone(cache_key("eth_blockNumber", []))
+        self.assertFalse(is_final("eth_getBlockByNumber", ["latest", True], {"number": "0x1"}, self.HEAD))
+
+    def test_eviction_brings_the_size_under_the_limit(self):
+        max_bytes = 20000
+        cache = self._cache(max_bytes)
+        entries = [(f"entry{number}", os.urandom(500).hex()) for number in range(100)]
+        with mock.patch("blockchain_consumer.chain_cache.time", side_effect=itertools.count()):
+            cache.put_many(entries[:2])
+            for entry in entries[2:]:
+                # The first entry stays in use
+                cache.get_many([entries[0][0]])
+                cache.put_many([entry])
+        size = cache._connection.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+        self.assertLessEqual(size, max_bytes)
+        self.assertEqual(cache._size, size)
+        found = cache.get_many([key for key, _ in entries])
+        self.assertIn(entries[0][0], found)
+        self.assertNotIn(entries[1][0], found)
+        self.assertIn(entries[-1][0], found)
+
+
+class FakeSession:
+    # Stands in for the HTTP session of an endpoint whose head is stuck at a block
+    def __init__(self, head: int):
+        self.head = head
+        self.requests = 0
+
+    def post(self, uri, data, headers, timeout):
+        self.requests += 1
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"jsonrpc": "2.0", "id": json.loads(data)["id"], "result": hex(self.head)}).encode()
+        return response
+
+
+class EndpointFailoverTests(SimpleTestCase):
+    def _provider(self, head_probe_interval) -> PooledHTTPProvider:
+        provider = PooledHTTPProvider(
+            ["http://primary", "http://secondary"], requests_per_second=None, head_probe_interval=head_probe_interval
+        )
+        primary, secondary = provider._endpoints
+        # The primary is the fastest, but stopped following the chain at block 100
+        primary.session, primary.latency = FakeSession(100), 0.01
+        secondary.session, secondary.latency = FakeSession(200), 0.5
+        return provider
+
+    def test_a_stalled_endpoint_is_noticed_by_probing_every_head(self):
+        provider = self._provider(head_probe_interval=0)
+        heads = [int(provider.make_request("eth_blockNumber", [])["result"], 16) for _ in range(50)]
+        primary, secondary = provider._endpoints
+        self.assertEqual(secondary.head_block_number, 200)
+        self.assertEqual(set(heads), {200})
+
+    def test_heads_are_probed_at_most_once_per_interval(self):
+        provider = self._provider(head_probe_interval=3600)
+        for _ in range(10):
+            provider.make_request("eth_blockNumber", [])
+        primary, secondary = provider._endpoints
+        # One probe at the first request, then every request goes to the secondary
+        self.assertEqual(primary.session.requests, 1)
+        self.assertEqual(secondary.session.requests, 11)
@@ -1,3 +1,51 @@
-from django.shortcuts import render
+from typing import Optional
 
-# Create your views here.
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from Wallet.export import CONTENT_TYPES, TransactionExport, block_range, parse_time
+from blockchain_consumer.metrics import CONTENT_TYPE, registry
+
+
+@require_GET
+def metrics(request):
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
+
+
+def _parse_block(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    if not value.isdigit():
+        raise ValueError(f"{value} is not a block number.")
+    return int(value)
+
+
+@staff_member_required
+@require_GET
+def export_transactions(request):
+    export_format = request.GET.get("format", "csv")
+    try:
+        from_block, to_block = block_range(
+            _parse_block(request.GET.get("from_block")),
+            _parse_block(request.GET.get("to_block")),
+            parse_time(request.GET.get("since")),
+            parse_time(request.GET.get("until"))
+        )
+        export = TransactionExport(
+            direction=request.GET.get("direction", "all"),
+            account=request.GET.get("account"),
+            token=request.GET.get("token"),
+            from_block=from_block,
+            to_block=to_block,
+            chunk_size=settings.EXPORT_CHUNK_SIZE
+        )
+        stream = export.stream(export_format)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    # Rows are read and sent as the client downloads them, the whole export is never held in memory
+    response = StreamingHttpResponse(stream, content_type=CONTENT_TYPES[export_format])
+    response["Content-Disposition"] = f'attachment; filename="transactions.{export_format}"'
+    return response
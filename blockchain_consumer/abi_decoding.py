@@ -0,0 +1,89 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from eth_abi import decode_abi
+from eth_abi.exceptions import DecodingError
+from eth_utils import to_checksum_address
+from hexbytes import HexBytes
+
+logger = logging.getLogger(__name__)
+
+# (receiver, amount) of a decoded ERC20 transfer call
+DecodedTransfer = Tuple[str, int]
+
+
+def decode_transfer_input(types: List[str], transaction_input: str) -> Optional[DecodedTransfer]:
+    # The function was already matched by its selector, types are the inputs it declares in the token's ABI
+    data = bytes(HexBytes(transaction_input))
+    try:
+        arguments = decode_abi(types, data[4:])
+    except DecodingError:
+        return None
+
+    # transfer(address to, uint256 amount), whatever the parameters are named in the ABI
+    receiver = next((value for type_, value in zip(types, arguments) if type_ == "address"), None)
+    amount = next((value for type_, value in zip(types, arguments) if type_.startswith("uint")), None)
+    if receiver is None or amount is None:
+        return None
+    return to_checksum_address(receiver), amount
+
+
+def _decode_chunk(chunk: List[Tuple[List[str], str]]) -> List[Optional[DecodedTransfer]]:
+    return [decode_transfer_input(types, transaction_input) for types, transaction_input in chunk]
+
+
+class TransferDecoder:
+    def decode(self, items: List[Tuple[List[str], str]]) -> List[Optional[DecodedTransfer]]:
+        # Items are (input types of the transfer function, transaction input) pairs
+        return _decode_chunk(items)
+
+
+class ProcessPoolTransferDecoder(TransferDecoder):
+    # Decoding is pure Python, so large blocks are decoded in chunks by worker processes.
+    # The input types travel with each call, so the workers don't need to know the tokens
+    def __init__(self, processes: int, chunk_size: int = 64):
+        self._processes = processes
+        self._chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                logger.info(f"Starting {self._processes} decoder processes.")
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self._processes,
+                    # Forking a process that runs several threads isn't safe
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+
+    def decode(self, items: List[Tuple[List[str], str]]) -> List[Optional[DecodedTransfer]]:
+        if len(items) < 2 * self._chunk_size:
+            # Not worth the round trip to the workers
+            return super().decode(items)
+
+        chunks = [items[start:start + self._chunk_size] for start in range(0, len(items), self._chunk_size)]
+        return [decoded for chunk in self._get_pool().map(_decode_chunk, chunks) for decoded in chunk]
+
+
+_transfer_decoder: Optional[TransferDecoder] = None
+_transfer_decoder_lock = threading.Lock()
+
+
+def transfer_decoder() -> TransferDecoder:
+    global _transfer_decoder
+    with _transfer_decoder_lock:
+        if _transfer_decoder is None:
+            if settings.ERC20_DECODER_PROCESSES:
+                _transfer_decoder = ProcessPoolTransferDecoder(
+                    settings.ERC20_DECODER_PROCESSES,
+                    chunk_size=settings.ERC20_DECODER_CHUNK_SIZE
+                )
+            else:
+                _transfer_decoder = TransferDecoder()
+        return _transfer_decoder
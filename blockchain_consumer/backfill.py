@@ -0,0 +1,71 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+from django.db import connection
+from web3 import Web3
+
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.rpc_batch import BatchBlockSource
+
+logger = logging.getLogger(__name__)
+
+
+class Backfiller:
+    def __init__(
+        self,
+        web3_client: Web3,
+        dispatcher: BlockDispatcher,
+        workers: int = 4,
+        chunk_size: int = 50,
+        batch_size: int = 20,
+        prefilter: bool = False
+    ):
+        self._block_source = BatchBlockSource(
+            web3_client,
+            window=batch_size,
+            prefilter=dispatcher.bloom_prefilter() if prefilter else None
+        )
+        self._dispatcher = dispatcher
+        self._workers = workers
+        self._chunk_size = chunk_size
+        # Processor name -> first block it failed to process
+        self._failures: Dict[str, int] = {}
+        self._failures_lock = threading.Lock()
+
+    def _chunks(self, from_block: int, to_block: int) -> List[Tuple[int, int]]:
+        return [
+            (start, min(start + self._chunk_size - 1, to_block))
+            for start in range(from_block, to_block + 1, self._chunk_size)
+        ]
+
+    def _process_range(self, block_range: Tuple[int, int]):
+        start, end = block_range
+        try:
+            # Transfer logs for the whole chunk are fetched with a single request
+            transfers = self._dispatcher.fetch_transfers(start, end)
+            for block in self._block_source.iter_blocks(start, end):
+                failed = self._dispatcher.dispatch(
+                    block,
+                    confirmed=True,
+                    transfers=None if transfers is None else transfers.get(block["number"], [])
+                )
+                with self._failures_lock:
+                    for processor_name in failed:
+                        self._failures[processor_name] = min(self._failures.get(processor_name, block["number"]), block["number"])
+            logger.info(f"Backfilled blocks {start} to {end}")
+        finally:
+            # Worker threads get their own database connection, which Django won't close for us
+            connection.close()
+
+    def run(self, from_block: int, to_block: int) -> Dict[str, int]:
+        # Returns the first block each failing processor couldn't process
+        self._failures = {}
+        if from_block > to_block:
+            return {}
+        logger.info(f"Backfilling blocks {from_block} to {to_block} with {self._workers} workers...")
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            # Consuming the results re-raises any exception from the workers
+            list(executor.map(self._process_range, self._chunks(from_block, to_block)))
+        return self._failures
@@ -0,0 +1,83 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from eth_utils import function_signature_to_4byte_selector
+from web3 import Web3
+
+from Wallet.models import Account, Token
+from blockchain_consumer.persistence import BalanceKey, persist_balances
+from blockchain_consumer.rpc_batch import BatchRpcClient
+from blockchain_consumer.sharding import Shard
+
+logger = logging.getLogger(__name__)
+
+BALANCE_OF_SELECTOR = function_signature_to_4byte_selector("balanceOf(address)")
+
+
+def _balance_of_call_data(address: str) -> str:
+    # balanceOf(address) with the address left-padded to 32 bytes
+    return "0x" + BALANCE_OF_SELECTOR.hex() + address[2:].lower().rjust(64, "0")
+
+
+class BalanceFetcher:
+    def __init__(self, web3_client: Web3):
+        self._rpc = BatchRpcClient(web3_client)
+
+    def fetch(self, keys: Iterable[BalanceKey], block_identifier: str = "latest") -> Dict[BalanceKey, int]:
+        # Accounts hit by several transactions in the same block are only refreshed once
+        keys = list(set(keys))
+        calls = []
+        for account, token in keys:
+            if token is None:
+                calls.append(("eth_getBalance", [account.public_key, block_identifier]))
+            else:
+                calls.append((
+                    "eth_call",
+                    [{"to": token.contract_address, "data": _balance_of_call_data(account.public_key)}, block_identifier]
+                ))
+
+        balances = {}
+        for (account, token), result in zip(keys, self._rpc.call_many(calls)):
+            balances[(account, token)] = result if token is None else int.from_bytes(result, "big")
+        return balances
+
+
+def all_balance_keys(batch_size: int, shard: Shard) -> Iterator[List[BalanceKey]]:
+    tokens = list(Token.objects.all())
+    batch = []
+    for account in Account.objects.all().iterator():
+        if not shard.owns(account.public_key):
+            continue
+        for token in [None, *tokens]:
+            batch.append((account, token))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def reconcile_balances(web3_client: Web3, batch_size: int = 100, max_workers: int = 4, shard: Optional[Shard] = None):
+    fetcher = BalanceFetcher(web3_client)
+    refreshed = 0
+
+    # Balances are fetched concurrently, but only a bounded number of batches is in flight at a time
+    # and all database writes happen on this thread
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = set()
+        for batch in all_balance_keys(batch_size, shard or Shard()):
+            in_flight.add(executor.submit(fetcher.fetch, batch))
+            if len(in_flight) >= max_workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    balances = future.result()
+                    persist_balances(balances)
+                    refreshed += len(balances)
+
+        for future in in_flight:
+            balances = future.result()
+            persist_balances(balances)
+            refreshed += len(balances)
+
+    logger.info(f"Reconciled {refreshed} balances.")
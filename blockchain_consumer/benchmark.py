@@ -0,0 +1,405 @@
+import json
+import logging
+import random
+import threading
+import tracemalloc
+from time import perf_counter, sleep, time
+from typing import Any, Callable, Dict, List, Optional
+
+from django.db import connection
+from django.db.backends.signals import connection_created
+from eth_utils import function_signature_to_4byte_selector, to_checksum_address
+from web3 import Web3
+from web3.providers.base import BaseProvider
+from web3.types import BlockData, RPCEndpoint, RPCResponse
+
+from Wallet.models import (
+    Account,
+    BalanceSnapshot,
+    BlockCheckpoint,
+    PendingTransaction,
+    ReceivedTransaction,
+    SentTransaction,
+    Token,
+    TokenBalance,
+)
+from blockchain_consumer.bloom import TRANSFER_TOPIC, bloom_mask
+from blockchain_consumer.block_fetcher import BlockFetcher
+from blockchain_consumer.consumer import build_processors
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.rpc_batch import BatchBlockSource
+from blockchain_consumer.transaction_processor import TransactionProcessor
+from blockchain_consumer.transfer_logs import TransferLogSource
+
+logger = logging.getLogger(__name__)
+
+# Only what the processors use of a token's ABI
+ERC20_ABI = json.dumps([
+    {
+        "constant": False,
+        "inputs": [{"name": "_to", "type": "address"}, {"name": "_value", "type": "uint256"}],
+        "name": "transfer",
+        "outputs": [{"name": "", "type": "bool"}],
+        "type": "function",
+    },
+    {
+        "constant": True,
+        "inputs": [{"name": "_owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "balance", "type": "uint256"}],
+        "type": "function",
+    },
+    {
+        "anonymous": False,
+        "inputs": [
+            {"indexed": True, "name": "from", "type": "address"},
+            {"indexed": True, "name": "to", "type": "address"},
+            {"indexed": False, "name": "value", "type": "uint256"},
+        ],
+        "name": "Transfer",
+        "type": "event",
+    },
+])
+TRANSFER_SELECTOR = function_signature_to_4byte_selector("transfer(address,uint256)")
+# Seconds between two synthetic blocks
+BLOCK_TIME = 12
+
+
+def _random_address(rng: random.Random) -> str:
+    return to_checksum_address(rng.getrandbits(160).to_bytes(20, "big"))
+
+
+def _word(value: int) -> str:
+    return format(value, "064x")
+
+
+def _address_word(address: str) -> str:
+    return address[2:].lower().rjust(64, "0")
+
+
+class SyntheticChain:
+    # Blocks, logs and receipts in the shape a node returns them over JSON-RPC, generated from a seed so that
+    # every run processes the same chain. Among the transactions, hit_rate of them involve a watched account,
+    # and erc20_share of them are ERC20 transfers, the others plain ETH transfers.
+    def __init__(
+        self,
+        watched_accounts: List[str],
+        watched_tokens: List[str],
+        blocks: int = 200,
+        transactions_per_block: int = 150,
+        erc20_share: float = 0.3,
+        hit_rate: float = 0.05,
+        seed: int = 0
+    ):
+        self._rng = random.Random(seed)
+        self._watched_accounts = watched_accounts
+        self._watched_tokens = watched_tokens
+        self._unwatched_tokens = [_random_address(self._rng) for _ in range(max(len(watched_tokens), 1))]
+        self._next_hash = 0
+        self.blocks: List[dict] = []
+        self.logs: Dict[int, List[dict]] = {}
+        self.receipts: Dict[str, dict] = {}
+        self.transactions = 0
+
+        genesis_timestamp = int(time()) - blocks * BLOCK_TIME
+        for number in range(blocks + 1):
+            # The genesis block is empty, the consumer starts after it
+            size = transactions_per_block if number else 0
+            self._add_block(number, genesis_timestamp + number * BLOCK_TIME, size, erc20_share, hit_rate)
+
+    @property
+    def head(self) -> int:
+        return len(self.blocks) - 1
+
+    def _hash(self) -> str:
+        self._next_hash += 1
+        return "0x" + _word(self._next_hash)
+
+    def _parties(self, hit: bool):
+        sender, receiver = _random_address(self._rng), _random_address(self._rng)
+        if hit:
+            if self._rng.random() < 0.5:
+                sender = self._rng.choice(self._watched_accounts)
+            else:
+                receiver = self._rng.choice(self._watched_accounts)
+        return sender, receiver
+
+    def _add_block(self, number: int, timestamp: int, size: int, erc20_share: float, hit_rate: float):
+        block_hash = "0x" + _word(2 ** 255 + number)
+        transactions, logs, bloom = [], [], 0
+        for index in range(size):
+            hit = bool(self._watched_accounts) and self._rng.random() < hit_rate
+            sender, receiver = self._parties(hit)
+            transaction = {
+                "hash": self._hash(),
+                "blockHash": block_hash,
+                "blockNumber": hex(number),
+                "transactionIndex": hex(index),
+                "from": sender,
+                "nonce": hex(self._rng.getrandbits(16)),
+                "gas": hex(100000),
+                "gasPrice": hex(10 ** 9),
+                "v": "0x1b",
+                "r": "0x" + _word(1),
+                "s": "0x" + _word(1),
+            }
+            if self._watched_tokens and self._rng.random() < erc20_share:
+                # Transfers that miss our accounts still go through watched tokens half of the time,
+                # so the processors decode them before discarding them
+                watched_token = hit or self._rng.random() < 0.5
+                token = self._rng.choice(self._watched_tokens if watched_token else self._unwatched_tokens)
+                amount = self._rng.randrange(1, 10 ** 18)
+                transaction.update(
+                    to=token,
+                    value="0x0",
+                    input="0x" + TRANSFER_SELECTOR.hex() + _address_word(receiver) + _word(amount)
+                )
+                logs.append({
+                    "address": token,
+                    "topics": ["0x" + word for word in (TRANSFER_TOPIC.hex()[-64:], _address_word(sender), _address_word(receiver))],
+                    "data": "0x" + _word(amount),
+                    "blockNumber": hex(number),
+                    "blockHash": block_hash,
+                    "transactionHash": transaction["hash"],
+                    "transactionIndex": hex(index),
+                    "logIndex": hex(len(logs)),
+                    "removed": False,
+                })
+                # Same bloom bits a node sets for the log: its address and each of its topics
+                for value in (token[2:], TRANSFER_TOPIC.hex()[-64:], _address_word(sender), _address_word(receiver)):
+                    bloom |= bloom_mask(bytes.fromhex(value))
+            else:
+                transaction.update(to=receiver, value=hex(self._rng.randrange(1, 10 ** 18)), input="0x")
+            transactions.append(transaction)
+            self.receipts[transaction["hash"]] = {
+                "transactionHash": transaction["hash"],
+                "blockNumber": hex(number),
+                "status": "0x1",
+                "gasUsed": hex(21000 if transaction["input"] == "0x" else 52000),
+                "effectiveGasPrice": hex(10 ** 9),
+            }
+
+        self.blocks.append({
+            "number": hex(number),
+            "hash": block_hash,
+            "parentHash": "0x" + _word(2 ** 255 + number - 1) if number else "0x" + _word(0),
+            "timestamp": hex(timestamp),
+            "logsBloom": "0x" + bloom.to_bytes(256, "big").hex(),
+            "miner": "0x" + "00" * 20,
+            "difficulty": "0x0",
+            "totalDifficulty": "0x0",
+            "gasLimit": hex(30000000),
+            "gasUsed": hex(21000 * size),
+            "size": hex(1000 + 200 * size),
+            "extraData": "0x",
+            "nonce": "0x0000000000000000",
+            "mixHash": "0x" + _word(0),
+            "sha3Uncles": "0x" + _word(0),
+            "stateRoot": "0x" + _word(0),
+            "transactionsRoot": "0x" + _word(0),
+            "receiptsRoot": "0x" + _word(0),
+            "uncles": [],
+            "transactions": transactions,
+        })
+        self.logs[number] = logs
+        self.transactions += size
+
+
+class SyntheticProvider(BaseProvider):
+    # Answers the JSON-RPC methods the consumer uses from a synthetic chain, in the same process
+    def __init__(self, chain: SyntheticChain):
+        self._chain = chain
+        self._transactions = {
+            transaction["hash"]: transaction for block in chain.blocks for transaction in block["transactions"]
+        }
+
+    def _result(self, method: str, params: list) -> Any:
+        if method == "eth_blockNumber":
+            return hex(self._chain.head)
+        if method == "eth_chainId":
+            return "0x1"
+        if method == "eth_getBlockByNumber":
+            number = self._chain.head if params[0] == "latest" else int(params[0], 16)
+            if number > self._chain.head:
+                return None
+            block = dict(self._chain.blocks[number])
+            if not params[1]:
+                block["transactions"] = [transaction["hash"] for transaction in block["transactions"]]
+            return block
+        if method == "eth_getLogs":
+            log_filter = params[0]
+            addresses = {address.lower() for address in log_filter["address"]}
+            return [
+                log
+                for number in range(int(log_filter["fromBlock"], 16), min(int(log_filter["toBlock"], 16), self._chain.head) + 1)
+                for log in self._chain.logs[number]
+                if log["address"].lower() in addresses
+            ]
+        if method == "eth_getBalance":
+            return hex(10 ** 18)
+        if method == "eth_call":
+            # balanceOf is the only contract call the consumer makes
+            return "0x" + _word(10 ** 18)
+        if method == "eth_getTransactionReceipt":
+            return self._chain.receipts.get(params[0])
+        if method == "eth_getTransactionByHash":
+            return self._transactions.get(params[0])
+        raise NotImplementedError(method)
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        try:
+            return {"jsonrpc": "2.0", "id": 0, "result": self._result(method, params)}
+        except NotImplementedError:
+            return {"jsonrpc": "2.0", "id": 0, "error": {"code": -32601, "message": f"Method {method} not supported"}}
+
+    def isConnected(self) -> bool:
+        return True
+
+
+class QueryCounter:
+    # Counts the queries of every thread: the counter wraps each connection as it's opened
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _wrap(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self) -> "QueryCounter":
+        self._wrap(None, connection)
+        connection_created.connect(self._wrap)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._wrap)
+        connection.execute_wrappers.remove(self)
+
+
+class BenchmarkResult:
+    __slots__ = ("name", "blocks", "transactions", "seconds", "queries", "peak_memory")
+
+    def __init__(self, name: str, blocks: int, transactions: int, seconds: float, queries: int, peak_memory: Optional[int]):
+        self.name = name
+        self.blocks = blocks
+        self.transactions = transactions
+        self.seconds = seconds
+        self.queries = queries
+        # In bytes, None when memory wasn't measured
+        self.peak_memory = peak_memory
+
+    @property
+    def blocks_per_second(self) -> float:
+        return self.blocks / self.seconds
+
+    @property
+    def transactions_per_second(self) -> float:
+        return self.transactions / self.seconds
+
+    @property
+    def queries_per_block(self) -> float:
+        return self.queries / self.blocks
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "blocks_per_second": round(self.blocks_per_second, 2),
+            "transactions_per_second": round(self.transactions_per_second, 2),
+            "queries_per_block": round(self.queries_per_block, 2),
+            "peak_memory_bytes": self.peak_memory,
+        }
+
+
+class ConsumerBenchmark:
+    # Runs every processor on its own, then the whole block fetcher, over a synthetic chain. Each run starts
+    # from an empty ledger. Memory is measured with tracemalloc in a second run, which would slow the first down.
+    def __init__(self, chain: SyntheticChain, measure_memory: bool = True, batch_size: int = 20, prefilter: bool = False):
+        self._chain = chain
+        self._web3_client = Web3(SyntheticProvider(chain))
+        self._measure_memory = measure_memory
+        self._batch_size = batch_size
+        self._prefilter = prefilter
+
+    @staticmethod
+    def _reset():
+        for model in (ReceivedTransaction, SentTransaction, PendingTransaction, BlockCheckpoint, TokenBalance, BalanceSnapshot):
+            model.objects.all().delete()
+        Account.objects.update(balance_wei=0)
+
+    def _measure(self, name: str, run: Callable[[], None]) -> BenchmarkResult:
+        self._reset()
+        with QueryCounter() as queries:
+            started = perf_counter()
+            run()
+            seconds = perf_counter() - started
+
+        peak_memory = None
+        if self._measure_memory:
+            self._reset()
+            tracemalloc.start()
+            try:
+                run()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        result = BenchmarkResult(name, self._chain.head, self._chain.transactions, seconds, queries.count, peak_memory)
+        logger.info(f"{name}: {result.blocks_per_second:.1f} blocks/s, {result.transactions_per_second:.0f} transactions/s.")
+        return result
+
+    def _dispatch(self, processor: TransactionProcessor, blocks: List[BlockData]):
+        dispatcher = BlockDispatcher(TransferLogSource(self._web3_client))
+        dispatcher.subscribe(processor)
+        for block in blocks:
+            dispatcher.dispatch(block)
+
+    def _fetch_blocks(self):
+        # Starts right after the genesis block, the blocks that are already confirmed are backfilled
+        BlockCheckpoint.store(BlockFetcher.CHECKPOINT_NAME, 0)
+        block_fetcher = BlockFetcher(
+            self._web3_client,
+            polling_delay=0.05,
+            min_polling_delay=0.01,
+            batch_size=self._batch_size,
+            prefilter=self._prefilter
+        )
+        for processor in build_processors(self._web3_client):
+            block_fetcher.subscribe(processor)
+
+        thread = threading.Thread(target=block_fetcher.start, daemon=True)
+        thread.start()
+        while thread.is_alive() and (block_fetcher.processed_block_number() or 0) < self._chain.head:
+            sleep(0.01)
+        block_fetcher.stop()
+        thread.join()
+
+    def run(self) -> List[BenchmarkResult]:
+        # Downloading the blocks isn't part of the processors' runs
+        blocks = BatchBlockSource(self._web3_client, window=self._batch_size).get_blocks(list(range(1, self._chain.head + 1)))
+        results = [
+            self._measure(processor.name, lambda: self._dispatch(processor, blocks))
+            for processor in build_processors(self._web3_client)
+        ]
+        results.append(self._measure(BlockFetcher.__name__, self._fetch_blocks))
+        return results
+
+
+def create_watched_addresses(accounts: int, tokens: int, seed: int = 0):
+    # Keys are random bytes rather than real key pairs, nothing is ever signed
+    rng = random.Random(seed)
+    Token.objects.bulk_create([
+        Token(contract_address=_random_address(rng), abi=ERC20_ABI, name=f"Token {index}", symbol=f"T{index}", decimals=18)
+        for index in range(tokens)
+    ])
+    Account.objects.bulk_create(
+        [
+            Account(name=f"benchmark-{index}", public_key=_random_address(rng), private_key=rng.getrandbits(256).to_bytes(32, "big"))
+            for index in range(accounts)
+        ],
+        batch_size=1000
+    )
@@ -1,56 +1,289 @@
 import logging
-from collections import Generator
-from time import sleep
-from typing import Union
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+from typing import Deque, Dict, Generator, List, Optional, Tuple, Union
 
 from web3 import Web3
 from web3.exceptions import BlockNotFound
 from web3.types import BlockData
 
+from Wallet.models import BlockCheckpoint
+from blockchain_consumer.backfill import Backfiller
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.metrics import block_profiler, observe_head
+from blockchain_consumer.routing import Route
+from blockchain_consumer.rpc_batch import BatchBlockSource
+from blockchain_consumer.runner import BlockCache, ProcessorRunner
+from blockchain_consumer.sharding import Shard
+from blockchain_consumer.transfer_logs import TransferLogSource
 from blockchain_consumer.transaction_processor import TransactionProcessor
 
 logger = logging.getLogger(__name__)
 
 
+class AdaptivePollingInterval:
+    def __init__(
+        self,
+        min_delay: Union[int, float],
+        max_delay: Union[int, float],
+        expected_block_time: Union[int, float] = 13,
+        smoothing: float = 0.2
+    ):
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._block_time = float(expected_block_time)
+        self._smoothing = smoothing
+        self._last_timestamp: Optional[int] = None
+        self._overdue_polls = 0
+
+    def block_time(self) -> float:
+        return self._block_time
+
+    def observe_block(self, timestamp: int):
+        if self._last_timestamp is not None and timestamp > self._last_timestamp:
+            # Exponential moving average of the time between consecutive blocks
+            self._block_time += self._smoothing * (timestamp - self._last_timestamp - self._block_time)
+        self._last_timestamp = timestamp
+        self._overdue_polls = 0
+
+    def next_delay(self) -> float:
+        if self._last_timestamp is None:
+            return self._min_delay
+
+        remaining = self._last_timestamp + self._block_time - time()
+        if remaining > 0:
+            # Sleep until the next block is expected
+            delay = remaining
+        else:
+            # The next block is overdue: poll tightly at first, then back off while the chain stays idle
+            delay = self._min_delay * 2 ** self._overdue_polls
+            if delay < self._max_delay:
+                # Stops doubling once capped, a chain that stays idle for long would overflow it
+                self._overdue_polls += 1
+        return min(max(delay, self._min_delay), self._max_delay)
+
+
+class BlockHistory:
+    # Fixed-size ring buffer of the (number, hash) pairs of the last processed blocks
+    def __init__(self, size: int = 64):
+        self._blocks: Deque[Tuple[int, bytes]] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def append(self, block: BlockData):
+        self._blocks.append((block["number"], bytes(block["hash"])))
+
+    def extends(self, block: BlockData) -> bool:
+        if not self._blocks:
+            return True
+        number, block_hash = self._blocks[-1]
+        return block["number"] == number + 1 and bytes(block["parentHash"]) == block_hash
+
+    def newest_first(self) -> Generator[Tuple[int, bytes], None, None]:
+        yield from reversed(self._blocks)
+
+    def rewind(self, block_number: int):
+        while self._blocks and self._blocks[-1][0] > block_number:
+            self._blocks.pop()
+
+
 class BlockFetcher:
-    def __init__(self, web3_client: Web3, polling_delay: Union[int, float] = 10):
-        self._observers = set()
+    CHECKPOINT_NAME = "block_fetcher"
+    # Seconds between attempts at fetching the transfer logs of a block, doubled on every failure
+    ROUTE_RETRY_DELAY = 1
+    MAX_ROUTE_RETRY_DELAY = 60
+
+    def __init__(
+        self,
+        web3_client: Web3,
+        polling_delay: Union[int, float] = 10,
+        min_polling_delay: Union[int, float] = 1,
+        backfill_workers: int = 4,
+        batch_size: int = 20,
+        reorg_history_size: int = 64,
+        shard: Optional[Shard] = None,
+        prefilter: bool = False
+    ):
+        self._checkpoint_name = self.CHECKPOINT_NAME + (shard or Shard()).suffix
+        self._stopped = threading.Event()
+        self._transfer_source = TransferLogSource(web3_client)
+        self._dispatcher = BlockDispatcher(self._transfer_source)
         self._client = web3_client
-        self._polling_delay = polling_delay
+        # The prefilter depends on the processors, it's set once they subscribed
+        self._block_source = BatchBlockSource(web3_client, window=batch_size)
+        self._prefilter = prefilter
+        self._cache = BlockCache(self._block_source, self._dispatcher)
+        self._runners: List[ProcessorRunner] = []
+        self._runner_executor: Optional[ThreadPoolExecutor] = None
+        self._batch_size = batch_size
+        self._polling_interval = AdaptivePollingInterval(min_polling_delay, polling_delay)
+        self._backfill_workers = backfill_workers
         self._last_processed_block = None
+        self._history = BlockHistory(reorg_history_size)
 
     def subscribe(self, observer: TransactionProcessor):
-        self._observers.add(observer)
+        self._dispatcher.subscribe(observer)
 
-    def _notify_all(self, block: BlockData):
-        for observer in self._observers:
-            try:
-                observer.process_block(block)
-            except Exception as e:
-                logger.exception(f"An exception occurred while processing block: {e}")
+    def processed_block_number(self) -> Optional[int]:
+        # Last block that every processor has handled, once they all started
+        cursors = [runner.cursor for runner in self._runners]
+        return min(cursors) if cursors and None not in cursors else None
+
+    def _head_block_number(self) -> int:
+        # eth_blockNumber only returns a number, so polling the head doesn't download any block data
+        return self._client.eth.block_number
+
+    def _latest_block_header(self) -> BlockData:
+        return self._client.eth.get_block("latest", full_transactions=False)
+
+    def _store_checkpoint(self):
+        # Transactions in the last blocks may still be waiting for confirmations, so only the blocks
+        # that are fully confirmed for the slowest processor count as processed
+        confirmed_block_number = min(runner.cursor for runner in self._runners) - self._dispatcher.confirmations_required()
+        if confirmed_block_number >= 0:
+            BlockCheckpoint.store(self._checkpoint_name, confirmed_block_number)
+
+    def _catch_up(self, runners: List[ProcessorRunner], confirmed_head: int):
+        # Everything that is already confirmed is processed in parallel, only for the processors that are behind
+        from_block = min(runner.cursor for runner in runners) + 1
+        logger.info(f"Catching up from block {from_block}...")
+        dispatcher = BlockDispatcher(self._transfer_source)
+        for runner in runners:
+            dispatcher.subscribe(runner.processor)
+        failures = Backfiller(
+            self._client,
+            dispatcher,
+            workers=self._backfill_workers,
+            batch_size=self._batch_size,
+            prefilter=self._prefilter
+        ).run(from_block, confirmed_head)
+        for runner in runners:
+            # A processor that failed continues from the block before its first failure on its own thread
+            runner.set_cursor(failures.get(runner.processor.name, confirmed_head + 1) - 1)
+
+    def _resume(self) -> BlockData:
+        if self._prefilter:
+            self._block_source.set_prefilter(self._dispatcher.bloom_prefilter())
+        self._runners = [ProcessorRunner(processor, self._dispatcher, self._cache) for processor in self._dispatcher.processors()]
+        checkpoint = BlockCheckpoint.load(self._checkpoint_name)
+        if checkpoint is None:
+            latest_block_header = self._latest_block_header()
+            for runner in self._runners:
+                runner.set_cursor(latest_block_header["number"])
+        else:
+            # Each processor continues from its own cursor, which is never behind the global checkpoint
+            for runner in self._runners:
+                runner.load_cursor()
+                if runner.cursor is None or runner.cursor < checkpoint:
+                    runner.set_cursor(checkpoint)
+                runner.rewind(runner.cursor)
+
+            confirmed_head = self._head_block_number() - self._dispatcher.confirmations_required()
+            lagging_runners = [runner for runner in self._runners if runner.cursor < confirmed_head]
+            if lagging_runners:
+                self._catch_up(lagging_runners, confirmed_head)
+            self._store_checkpoint()
 
-    def _latest_block(self) -> BlockData:
-        return self._client.eth.get_block("latest", full_transactions=True)
+        self._runner_executor = ThreadPoolExecutor(max_workers=max(len(self._runners), 1), thread_name_prefix="processor")
+        for runner in self._runners:
+            self._runner_executor.submit(runner.run)
+        # Blocks are fetched from the slowest processor onwards, the others skip what they already handled
+        return self._client.eth.get_block(min(runner.cursor for runner in self._runners), full_transactions=False)
 
-    def _next_block(self) -> BlockData:
-        return self._client.eth.get_block(self._last_processed_block["number"] + 1, full_transactions=True)
+    def _find_fork_point(self) -> int:
+        # Walks back through the recently processed blocks until one is still part of the canonical chain
+        fork_point = None
+        for block_number, block_hash in self._history.newest_first():
+            fork_point = block_number - 1
+            if bytes(self._client.eth.get_block(block_number)["hash"]) == block_hash:
+                return block_number
+        logger.error(f"Chain reorganization deeper than the last {len(self._history)} blocks.")
+        return fork_point
+
+    def _rewind(self, block: BlockData):
+        fork_point = self._find_fork_point()
+        logger.warning(
+            f"Chain reorganization detected at block {block['number']}, rewinding to block {fork_point}."
+        )
+        # Transactions from the orphaned blocks are dropped before they are confirmed,
+        # the ones that were included again are picked up when the new blocks are processed
+        self._cache.rewind(fork_point)
+        dropped = sum(runner.rewind(fork_point) for runner in self._runners)
+        if dropped:
+            logger.warning(f"Dropped {dropped} pending transactions from orphaned blocks.")
+        confirmed_block_number = self._last_processed_block["number"] - self._dispatcher.confirmations_required()
+        if fork_point < confirmed_block_number:
+            logger.error(
+                f"Blocks up to {confirmed_block_number} were already confirmed, "
+                f"transactions from orphaned blocks after {fork_point} may have been stored."
+            )
+        self._history.rewind(fork_point)
+        self._last_processed_block = self._client.eth.get_block(fork_point, full_transactions=False)
 
     def _poll(self) -> Generator[BlockData, None, None]:
-        self._last_processed_block = self._latest_block()
+        self._last_processed_block = self._resume()
+        self._history.append(self._last_processed_block)
+        self._polling_interval.observe_block(self._last_processed_block["timestamp"])
+        while not self._stopped.is_set():
+            head_block_number = self._head_block_number()
+            observe_head(head_block_number, self._last_processed_block["number"], self._last_processed_block["timestamp"])
+            if head_block_number <= self._last_processed_block["number"]:
+                sleep(self._polling_interval.next_delay())
+                continue
+
+            # When we're more than one block behind, the missing blocks are fetched in JSON-RPC batches
+            try:
+                for block in self._block_source.iter_blocks(self._last_processed_block["number"] + 1, head_block_number):
+                    if self._stopped.is_set():
+                        return
+                    if not self._history.extends(block):
+                        # The block doesn't build on the last processed one, restart from the fork point
+                        self._rewind(block)
+                        break
+                    self._history.append(block)
+                    self._last_processed_block = block
+                    self._polling_interval.observe_block(block["timestamp"])
+                    observe_head(head_block_number, block["number"], block["timestamp"])
+                    logger.info(f"Found block {block['number']}")
+                    yield block
+            except BlockNotFound:
+                # The head moved, but the node we hit doesn't serve the block yet, retry
+                sleep(self._polling_interval.next_delay())
+
+    def _route_block(self, block: BlockData) -> Optional[Dict[Route, list]]:
+        # A block is only handed to the runners once its transfers were fetched, retried until they are.
+        # None if the fetcher was stopped in the meantime
+        failures = 0
         while True:
-            latest_block = self._latest_block()
-            if self._last_processed_block == latest_block:
-                sleep(self._polling_delay)
-            else:
-                try:
-                    self._last_processed_block = self._next_block()
-                    logger.info(f"Found block {self._last_processed_block['number']}")
-                    yield self._last_processed_block
-                except BlockNotFound:
-                    # For some reason the next block call failed, retry
-                    sleep(self._polling_delay)
+            try:
+                return self._dispatcher.route_block(block)
+            except Exception as e:
+                failures += 1
+                logger.exception(f"An exception occurred while routing block {block['number']}: {e}")
+                if self._stopped.wait(min(self.ROUTE_RETRY_DELAY * 2 ** (failures - 1), self.MAX_ROUTE_RETRY_DELAY)):
+                    return None
+
+    def stop(self):
+        self._stopped.set()
+        for runner in self._runners:
+            runner.stop()
+        if self._runner_executor is not None:
+            self._runner_executor.shutdown()
 
     def start(self):
         logger.info("Starting polling for blocks...")
-        for block in self._poll():
-            self._notify_all(block)
+        try:
+            for block in self._poll():
+                # Every processor picks the block up from the cache on its own thread
+                with block_profiler().profile():
+                    routed = self._route_block(block)
+                    if routed is None:
+                        break
+                    self._cache.add(block, routed)
+                    self._store_checkpoint()
+        finally:
+            self.stop()
+            block_profiler().flush()
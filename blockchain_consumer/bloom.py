@@ -0,0 +1,38 @@
+from typing import Iterable, List, Union
+
+from hexbytes import HexBytes
+from web3 import Web3
+
+TRANSFER_TOPIC = Web3.keccak(text="Transfer(address,address,uint256)")
+
+
+def bloom_mask(value: bytes) -> int:
+    # Each value sets 3 of the 2048 bits of a logs bloom, picked by the low 11 bits of the first 3 pairs of its hash
+    value_hash = Web3.keccak(value)
+    mask = 0
+    for i in (0, 2, 4):
+        mask |= 1 << (int.from_bytes(value_hash[i:i + 2], "big") & 2047)
+    return mask
+
+
+def _address_topic(address: str) -> bytes:
+    # Indexed addresses are left-padded to 32 bytes
+    return bytes(HexBytes(address)).rjust(32, b"\0")
+
+
+class TransferBloom:
+    # Masks of the watched addresses, computed once, so that testing a block's bloom only takes a few ANDs
+    def __init__(self, token_addresses: Iterable[str], account_addresses: Iterable[str]):
+        self._transfer_mask = bloom_mask(TRANSFER_TOPIC)
+        self._token_masks: List[int] = list({bloom_mask(bytes(HexBytes(address))) for address in token_addresses})
+        self._account_masks: List[int] = list({bloom_mask(_address_topic(address)) for address in account_addresses})
+
+    def may_contain_transfer(self, logs_bloom: Union[bytes, str]) -> bool:
+        # A Transfer event emitted by one of the tokens, with one of the accounts as sender or receiver.
+        # Blooms have false positives but no false negatives
+        bloom = int.from_bytes(HexBytes(logs_bloom), "big")
+        return (
+            bloom & self._transfer_mask == self._transfer_mask and
+            any(bloom & mask == mask for mask in self._token_masks) and
+            any(bloom & mask == mask for mask in self._account_masks)
+        )
@@ -0,0 +1,129 @@
+import json
+import logging
+import sqlite3
+import threading
+import zlib
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from eth_utils import function_signature_to_4byte_selector
+from web3._utils.encoding import Web3JsonEncoder
+
+logger = logging.getLogger(__name__)
+
+# Token metadata never changes once a contract is deployed, whatever block it is read at
+METADATA_CALL_DATA = {
+    "0x" + function_signature_to_4byte_selector(signature).hex()
+    for signature in ("name()", "symbol()", "decimals()")
+}
+
+
+def _block_number(value: Any) -> Optional[int]:
+    # Block tags such as "latest" are never final
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.startswith("0x"):
+        return int(value, 16)
+    return None
+
+
+def cache_key(method: str, params: list) -> Optional[str]:
+    # Only requests whose answer can't change once their block is final are worth a key
+    if method in ("eth_getBlockByNumber", "eth_getBlockByHash", "eth_getTransactionReceipt", "eth_getTransactionByHash"):
+        return method + json.dumps(params, cls=Web3JsonEncoder)
+    if method == "eth_getLogs" and "blockHash" not in params[0]:
+        return method + json.dumps(params, cls=Web3JsonEncoder, sort_keys=True)
+    if method == "eth_call" and params[0].get("data") in METADATA_CALL_DATA:
+        # The block the metadata is read at doesn't matter
+        return method + json.dumps([params[0]["to"].lower(), params[0]["data"]])
+    return None
+
+
+def is_final(method: str, params: list, result: Any, finalized_block: Optional[int]) -> bool:
+    if method == "eth_call":
+        return True
+    if result is None or finalized_block is None:
+        # Missing blocks and transactions may show up later
+        return False
+    if method == "eth_getBlockByNumber":
+        block_number = _block_number(params[0])
+    elif method == "eth_getLogs":
+        block_number = _block_number(params[0].get("toBlock", "latest"))
+        if _block_number(params[0].get("fromBlock", "latest")) is None:
+            return False
+    else:
+        block_number = _block_number(result.get("blockNumber", result.get("number")))
+    return block_number is not None and block_number <= finalized_block
+
+
+class ChainDataCache:
+    # Responses to requests about finalized blocks, kept in a local SQLite file shared by every process on the host.
+    # The least recently used entries are evicted once the file grows past its size limit.
+    def __init__(self, path: str, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(f"PRAGMA mmap_size={max_bytes}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        # Estimate of the cache size, only checked against the file when it crosses the limit
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                if rows:
+                    self._connection.execute(
+                        f"UPDATE entries SET used = ? WHERE key IN ({', '.join('?' * len(rows))})",
+                        [time(), *(key for key, _ in rows)]
+                    )
+                found.update((key, json.loads(zlib.decompress(value))) for key, value in rows)
+        return found
+
+    def put_many(self, items: List[Tuple[str, Any]]):
+        if not items:
+            return
+        now = time()
+        rows = [(key, zlib.compress(json.dumps(value).encode())) for key, value in items]
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+                [(key, value, len(key) + len(value), now) for key, value in rows]
+            )
+            self._connection.execute("COMMIT")
+            self._size += sum(len(key) + len(value) for key, value in rows)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes write to the same file, so the actual size is read back first
+        self._size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        # Evicts down to 90% of the limit, so that eviction doesn't run on every write
+        excess = self._size - int(self._max_bytes * 0.9)
+        if excess <= 0:
+            return
+        evicted, freed = [], 0
+        cursor = self._connection.execute("SELECT key, size FROM entries ORDER BY used")
+        for key, size in cursor:
+            evicted.append(key)
+            freed += size
+            if freed >= excess:
+                break
+        cursor.close()
+        self._connection.execute("BEGIN")
+        self._connection.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+        self._connection.execute("COMMIT")
+        self._size -= freed
+        logger.info(f"Evicted {len(evicted)} entries from the chain data cache.")
@@ -0,0 +1,167 @@
+import heapq
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from Wallet.models import PendingTransaction
+
+logger = logging.getLogger(__name__)
+
+
+class PendingRecord:
+    __slots__ = (
+        "processor", "transaction_hash", "block_number", "account_id", "token_id", "counterparty", "amount", "log_index"
+    )
+
+    def __init__(
+        self,
+        processor: str,
+        transaction_hash: bytes,
+        block_number: int,
+        account_id: int,
+        token_id: Optional[int],
+        counterparty: str,
+        amount: int,
+        log_index: Optional[int] = None
+    ):
+        self.processor = processor
+        self.transaction_hash = bytes(transaction_hash)
+        self.block_number = block_number
+        self.account_id = account_id
+        self.token_id = token_id
+        self.counterparty = counterparty
+        self.amount = amount
+        # Only transfers read from the logs have one, it tells apart the transfers of a single transaction
+        self.log_index = log_index
+
+    @property
+    def key(self) -> Tuple[str, bytes, Optional[int]]:
+        return self.processor, self.transaction_hash, self.log_index
+
+    @classmethod
+    def from_model(cls, pending_transaction: PendingTransaction) -> "PendingRecord":
+        return cls(
+            pending_transaction.processor,
+            pending_transaction.transaction_hash,
+            pending_transaction.block_number,
+            pending_transaction.account_id,
+            pending_transaction.token_id,
+            pending_transaction.counterparty,
+            pending_transaction.amount_wei,
+            pending_transaction.log_index
+        )
+
+    def to_model(self) -> PendingTransaction:
+        return PendingTransaction(
+            processor=self.processor,
+            transaction_hash=self.transaction_hash,
+            block_number=self.block_number,
+            account_id=self.account_id,
+            token_id=self.token_id,
+            counterparty=self.counterparty,
+            amount_wei=self.amount,
+            log_index=self.log_index
+        )
+
+
+class ConfirmationScheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Block number at which the transactions become confirmed -> transactions
+        self._buckets: Dict[int, List[PendingRecord]] = defaultdict(list)
+        self._due_blocks: List[int] = []
+        self._keys: Set[Tuple[str, bytes, Optional[int]]] = set()
+        self._confirmations: Dict[str, int] = {}
+        self._size = 0
+        self._loaded = False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def register(self, processor: str, confirmations_required: int):
+        self._confirmations[processor] = confirmations_required
+
+    def _schedule(self, record: PendingRecord, due_block: int):
+        if record.key in self._keys:
+            # The block was seen before, e.g. right after restoring from the database
+            return
+        self._keys.add(record.key)
+        if due_block not in self._buckets:
+            heapq.heappush(self._due_blocks, due_block)
+        self._buckets[due_block].append(record)
+        self._size += 1
+
+    def _due_block(self, record: PendingRecord) -> int:
+        return record.block_number + self._confirmations[record.processor]
+
+    def ensure_loaded(self):
+        # Transactions that were still pending when the service stopped
+        if self._loaded:
+            return
+        with self._lock:
+            for pending_transaction in PendingTransaction.objects.filter(processor__in=self._confirmations).iterator():
+                record = PendingRecord.from_model(pending_transaction)
+                self._schedule(record, self._due_block(record))
+            self._loaded = True
+        if self._size:
+            logger.info(f"Restored {self._size} pending transactions.")
+
+    def add(self, records: List[PendingRecord]):
+        if not records:
+            return
+        PendingTransaction.objects.bulk_create([record.to_model() for record in records], ignore_conflicts=True)
+        with self._lock:
+            for record in records:
+                self._schedule(record, self._due_block(record))
+
+    def retry(self, records: Iterable[PendingRecord], block_number: int):
+        with self._lock:
+            for record in records:
+                self._schedule(record, block_number)
+
+    def pop_due(self, block_number: int) -> List[PendingRecord]:
+        # Only the buckets that became due are touched, no matter how many transactions are pending
+        due = []
+        with self._lock:
+            while self._due_blocks and self._due_blocks[0] <= block_number:
+                due.extend(self._buckets.pop(heapq.heappop(self._due_blocks)))
+            for record in due:
+                self._keys.discard(record.key)
+            self._size -= len(due)
+        return due
+
+    def rollback(self, block_number: int) -> int:
+        # Drops the transactions of blocks after block_number, which are no longer part of the chain
+        self.ensure_loaded()
+        with self._lock:
+            kept = [
+                (due_block, record)
+                for due_block, records in self._buckets.items()
+                for record in records
+                if record.block_number <= block_number
+            ]
+            dropped = self._size - len(kept)
+            self._buckets.clear()
+            self._due_blocks.clear()
+            self._keys.clear()
+            self._size = 0
+            for due_block, record in kept:
+                self._schedule(record, due_block)
+        PendingTransaction.objects.filter(processor__in=self._confirmations, block_number__gt=block_number).delete()
+        return dropped
+
+    def complete(self, records: List[PendingRecord]):
+        # The transfers of a transaction are in the same block, so they're always completed together
+        hashes_by_processor = defaultdict(set)
+        for record in records:
+            hashes_by_processor[record.processor].add(record.transaction_hash)
+
+        for processor, transaction_hashes in hashes_by_processor.items():
+            transaction_hashes = list(transaction_hashes)
+            # Keeps the number of query parameters below SQLite's limit
+            for start in range(0, len(transaction_hashes), 500):
+                PendingTransaction.objects.filter(
+                    processor=processor,
+                    transaction_hash__in=transaction_hashes[start:start + 500]
+                ).delete()
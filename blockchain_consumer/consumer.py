@@ -0,0 +1,212 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from time import monotonic, sleep
+from typing import List, Optional, Union
+
+from django.conf import settings
+from web3 import Web3
+
+from Wallet.models import BlockCheckpoint, ConsumerLease
+from blockchain_consumer.balances import reconcile_balances
+from blockchain_consumer.block_fetcher import BlockFetcher
+from blockchain_consumer.incoming import (
+    IncomingERC20Processor,
+    IncomingERC20TransferProcessor,
+    IncomingTransactionProcessor,
+)
+from blockchain_consumer.ledger import check_balance_drift, snapshot_balances
+from blockchain_consumer.outgoing import (
+    OutgoingERC20Processor,
+    OutgoingERC20TransferProcessor,
+    OutgoingTransactionProcessor,
+)
+from blockchain_consumer.pipeline import AsyncBlockPipeline
+from blockchain_consumer.sharding import Shard
+from blockchain_consumer.transaction_processor import TransactionProcessor
+from blockchain_consumer.watch_index import watch_index
+
+logger = logging.getLogger(__name__)
+
+
+def build_processors(web3_client: Web3, shard: Optional[Shard] = None) -> List[TransactionProcessor]:
+    if settings.ERC20_INGESTION_MODE == "logs":
+        erc20_processors = [
+            IncomingERC20TransferProcessor(web3_client, shard),
+            OutgoingERC20TransferProcessor(web3_client, shard),
+        ]
+    else:
+        erc20_processors = [
+            IncomingERC20Processor(web3_client, shard),
+            OutgoingERC20Processor(web3_client, shard),
+        ]
+
+    if not settings.TRACK_ETH_TRANSACTIONS:
+        return erc20_processors
+    return [
+        IncomingTransactionProcessor(web3_client, shard),
+        OutgoingTransactionProcessor(web3_client, shard),
+        *erc20_processors,
+    ]
+
+
+def build_block_fetcher(web3_client: Web3, shard: Optional[Shard] = None) -> Union[BlockFetcher, AsyncBlockPipeline]:
+    if settings.CONSUMER_MODE == "pipeline":
+        block_fetcher = AsyncBlockPipeline(
+            web3_client,
+            batch_size=settings.BLOCK_BATCH_SIZE,
+            queue_size=settings.PIPELINE_QUEUE_SIZE,
+            shard=shard,
+            prefilter=settings.BLOCK_BLOOM_PREFILTER
+        )
+    else:
+        block_fetcher = BlockFetcher(
+            web3_client,
+            backfill_workers=settings.BACKFILL_WORKERS,
+            batch_size=settings.BLOCK_BATCH_SIZE,
+            shard=shard,
+            prefilter=settings.BLOCK_BLOOM_PREFILTER
+        )
+    for processor in build_processors(web3_client, shard):
+        block_fetcher.subscribe(processor)
+    return block_fetcher
+
+
+def start_balance_reconciliation(
+    web3_client: Web3,
+    shard: Optional[Shard] = None,
+    stopped: Optional[threading.Event] = None
+):
+    if settings.BALANCE_MODE == "ledger":
+        start_ledger_maintenance(web3_client, shard, stopped)
+        return
+    interval = settings.BALANCE_RECONCILIATION_INTERVAL
+    if not interval:
+        return
+    stopped = stopped or threading.Event()
+
+    def _reconcile_periodically():
+        while not stopped.wait(interval):
+            try:
+                reconcile_balances(
+                    web3_client,
+                    batch_size=settings.BALANCE_RECONCILIATION_BATCH_SIZE,
+                    max_workers=settings.BALANCE_RECONCILIATION_WORKERS,
+                    shard=shard
+                )
+            except Exception as e:
+                logger.exception(f"An exception occurred while reconciling balances: {e}")
+
+    threading.Thread(target=_reconcile_periodically, daemon=True).start()
+
+
+def start_ledger_maintenance(
+    web3_client: Web3,
+    shard: Optional[Shard] = None,
+    stopped: Optional[threading.Event] = None
+):
+    # Snapshots and drift checks are taken at the checkpoint, the last block whose transactions were all stored
+    shard = shard or Shard()
+    stopped = stopped or threading.Event()
+    checkpoint_name = BlockFetcher.CHECKPOINT_NAME + shard.suffix
+    jobs = []
+    if settings.BALANCE_SNAPSHOT_INTERVAL:
+        jobs.append((
+            "snapshotting",
+            settings.BALANCE_SNAPSHOT_INTERVAL,
+            lambda block_number: snapshot_balances(
+                block_number,
+                batch_size=settings.BALANCE_RECONCILIATION_BATCH_SIZE,
+                shard=shard
+            )
+        ))
+    if settings.BALANCE_RECONCILIATION_INTERVAL:
+        jobs.append((
+            "checking",
+            settings.BALANCE_RECONCILIATION_INTERVAL,
+            lambda block_number: check_balance_drift(
+                web3_client,
+                block_number,
+                batch_size=settings.BALANCE_RECONCILIATION_BATCH_SIZE,
+                max_workers=settings.BALANCE_RECONCILIATION_WORKERS,
+                shard=shard,
+                fix=True
+            )
+        ))
+
+    # Both jobs write the snapshots, they take turns rather than race each other
+    jobs_lock = threading.Lock()
+
+    def _run_periodically(action: str, interval: int, job):
+        while not stopped.wait(interval):
+            try:
+                with jobs_lock:
+                    block_number = BlockCheckpoint.load(checkpoint_name)
+                    if block_number is not None:
+                        job(block_number)
+            except Exception as e:
+                logger.exception(f"An exception occurred while {action} ledger balances: {e}")
+
+    for job in jobs:
+        threading.Thread(target=_run_periodically, args=job, daemon=True).start()
+
+
+def _run_block_fetcher(block_fetcher: Union[BlockFetcher, AsyncBlockPipeline]):
+    try:
+        block_fetcher.start()
+    except Exception as e:
+        logger.exception(f"The consumer stopped because of an exception: {e}")
+
+
+def _hold_lease(lease_name: str, owner: str, lease_duration: timedelta, block_fetcher_thread: threading.Thread) -> bool:
+    # Renews the lease while the consumer runs, returns False once it's lost
+    renewed_at = monotonic()
+    while block_fetcher_thread.is_alive():
+        sleep(lease_duration.total_seconds() / 3)
+        try:
+            if not ConsumerLease.acquire(lease_name, owner, lease_duration):
+                return False
+            renewed_at = monotonic()
+        except Exception as e:
+            logger.exception(f"An exception occurred while renewing the lease on {lease_name}: {e}")
+            if monotonic() - renewed_at >= lease_duration.total_seconds():
+                # Another instance may already have taken over
+                return False
+    return True
+
+
+def run_consumer(web3_client: Web3, shard: Optional[Shard] = None, lease_duration: Optional[timedelta] = None):
+    shard = shard or Shard()
+    lease_duration = lease_duration or timedelta(seconds=settings.CONSUMER_LEASE_DURATION)
+    # Instances consuming the same shard elect a leader through a lease, the others stand by
+    lease_name = "consumer" + shard.suffix
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    watch_index.set_shard(shard)
+
+    try:
+        while True:
+            if not ConsumerLease.acquire(lease_name, owner, lease_duration):
+                logger.info(f"Waiting for the lease on {lease_name}, which is held by another consumer...")
+                sleep(lease_duration.total_seconds() / 3)
+                continue
+            logger.info(f"Acquired the lease on {lease_name} as {owner}.")
+
+            stopped = threading.Event()
+            block_fetcher = build_block_fetcher(web3_client, shard)
+            start_balance_reconciliation(web3_client, shard, stopped)
+            block_fetcher_thread = threading.Thread(target=_run_block_fetcher, args=(block_fetcher,), daemon=True)
+            block_fetcher_thread.start()
+
+            if not _hold_lease(lease_name, owner, lease_duration, block_fetcher_thread):
+                logger.error(f"Lost the lease on {lease_name}, stopping the consumer.")
+            stopped.set()
+            block_fetcher.stop()
+            block_fetcher_thread.join()
+            ConsumerLease.release(lease_name, owner)
+            # Gives the other instances a chance to take over before trying again
+            sleep(lease_duration.total_seconds() / 3)
+    finally:
+        ConsumerLease.release(lease_name, owner)
@@ -0,0 +1,77 @@
+import json
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from eth_utils import function_abi_to_4byte_selector
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.contract import Contract
+
+from Wallet.models import Token
+
+
+# (function name, input types)
+Function = Tuple[str, List[str]]
+
+
+class CompiledContract:
+    __slots__ = ("client", "contract", "functions")
+
+    def __init__(self, client: Web3, contract: Contract, functions: Dict[bytes, Function]):
+        self.client = client
+        self.contract = contract
+        # 4-byte function selector -> function, the only selector table of the token, also used to decode the calls
+        self.functions = functions
+
+    def function(self, transaction_input: Union[str, bytes]) -> Optional[Function]:
+        return self.functions.get(bytes(HexBytes(transaction_input)[:4]))
+
+    def function_name(self, transaction_input: Union[str, bytes]) -> Optional[str]:
+        function = self.function(transaction_input)
+        return function[0] if function is not None else None
+
+
+class ContractCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Token primary key -> compiled contract
+        self._contracts: Dict[int, CompiledContract] = {}
+
+    @staticmethod
+    def _compile(web3_client: Web3, token: Token) -> CompiledContract:
+        abi = json.loads(token.abi)
+        contract = web3_client.eth.contract(address=token.contract_address, abi=abi)
+        functions = {
+            function_abi_to_4byte_selector(entry): (entry["name"], [argument["type"] for argument in entry.get("inputs", [])])
+            for entry in abi
+            if entry.get("type", "function") == "function" and "name" in entry
+        }
+        return CompiledContract(web3_client, contract, functions)
+
+    def get(self, web3_client: Web3, token: Token) -> CompiledContract:
+        # Edits to a token drop its entry through the model signals below, so the ABI doesn't need to be compared
+        compiled = self._contracts.get(token.pk)
+        # Contracts are bound to the client they were built with
+        if compiled is None or compiled.client is not web3_client:
+            compiled = self._compile(web3_client, token)
+            with self._lock:
+                self._contracts[token.pk] = compiled
+        return compiled
+
+    def contract(self, web3_client: Web3, token: Token) -> Contract:
+        return self.get(web3_client, token).contract
+
+    def invalidate(self, token_pk: int):
+        with self._lock:
+            self._contracts.pop(token_pk, None)
+
+
+contract_cache = ContractCache()
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def _token_changed(sender, instance: Token, **kwargs):
+    contract_cache.invalidate(instance.pk)
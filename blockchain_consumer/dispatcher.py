@@ -0,0 +1,173 @@
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from web3.datastructures import AttributeDict
+from web3.types import BlockData, TxData
+
+from blockchain_consumer.confirmations import ConfirmationScheduler, PendingRecord
+from blockchain_consumer.metrics import PENDING_TRANSACTIONS, block_profiler, observe_stage
+from blockchain_consumer.routing import Route, classify, classify_transfer, matches
+from blockchain_consumer.transaction_processor import TransactionProcessor
+from blockchain_consumer.transfer_logs import TransferLogSource
+from blockchain_consumer.watch_index import watch_index
+
+logger = logging.getLogger(__name__)
+
+
+class BlockDispatcher:
+    def __init__(self, transfer_source: Optional[TransferLogSource] = None):
+        self._processors: Dict[Route, List[TransactionProcessor]] = defaultdict(list)
+        self._transfer_source = transfer_source
+        # Transactions waiting for their confirmations, per processor
+        self._schedulers: Dict[str, ConfirmationScheduler] = {}
+
+    def subscribe(self, processor: TransactionProcessor):
+        if processor.ROUTE & Route.TRANSFER_LOG and self._transfer_source is None:
+            raise ValueError(f"{processor.name} needs a dispatcher with a transfer log source.")
+        self._processors[processor.ROUTE].append(processor)
+        scheduler = ConfirmationScheduler()
+        scheduler.register(processor.name, processor.CONFIRMATIONS_REQUIRED)
+        self._schedulers[processor.name] = scheduler
+
+    def processors(self) -> List[TransactionProcessor]:
+        return [processor for processors in self._processors.values() for processor in processors]
+
+    def scheduler(self, processor: TransactionProcessor) -> ConfirmationScheduler:
+        return self._schedulers[processor.name]
+
+    def _transaction_routes(self) -> List[Route]:
+        return [route for route in self._processors if not route & Route.TRANSFER_LOG]
+
+    def _transfer_routes(self) -> List[Route]:
+        return [route for route in self._processors if route & Route.TRANSFER_LOG]
+
+    @staticmethod
+    def _route(items: Iterable, classify_item: Callable, routes: List[Route]) -> Dict[Route, list]:
+        routed = {route: [] for route in routes}
+        for item in items:
+            item_route = classify_item(item)
+            for route, matched in routed.items():
+                if matches(item_route, route):
+                    matched.append(item)
+        return routed
+
+    def route(self, transactions: Iterable[TxData]) -> Dict[Route, List[TxData]]:
+        return self._route(transactions, classify, self._transaction_routes())
+
+    def route_transfers(self, transfers: Iterable[AttributeDict]) -> Dict[Route, List[AttributeDict]]:
+        return self._route(transfers, classify_transfer, self._transfer_routes())
+
+    def fetch_transfers(self, from_block: int, to_block: int) -> Optional[Dict[int, List[AttributeDict]]]:
+        if not self._transfer_routes():
+            return None
+        watch_index.ensure_current()
+        return self._transfer_source.get_transfers(from_block, to_block)
+
+    @staticmethod
+    def _route_needs_transactions(route: Route, header: BlockData) -> bool:
+        # Plain ETH transfers leave no trace in the logs bloom, only the token routes can be ruled out by it
+        return not route & Route.TO_TOKEN or watch_index.may_have_transfer(header["logsBloom"])
+
+    def needs_transactions(self, headers: List[BlockData]) -> List[bool]:
+        # Decides from block headers, with transaction hashes only, whether the blocks' transactions can concern
+        # any processor. Transfer log routes get their transfers from eth_getLogs and never need them
+        routes = self._transaction_routes()
+        return [
+            bool(header["transactions"]) and any(self._route_needs_transactions(route, header) for route in routes)
+            for header in headers
+        ]
+
+    def bloom_prefilter(self) -> Optional[Callable[[List[BlockData]], List[bool]]]:
+        # While a processor follows ETH transactions, every block that has some is downloaded in full,
+        # and fetching the headers first would only add a request per block
+        if any(not route & Route.TO_TOKEN for route in self._transaction_routes()):
+            logger.warning("The bloom prefilter is disabled while ETH transactions are followed.")
+            return None
+        return self.needs_transactions
+
+    def confirmations_required(self) -> int:
+        return max(
+            (processor.CONFIRMATIONS_REQUIRED for processor in self.processors()),
+            default=TransactionProcessor.CONFIRMATIONS_REQUIRED
+        )
+
+    def rollback(self, block_number: int) -> int:
+        return sum(scheduler.rollback(block_number) for scheduler in self._schedulers.values())
+
+    def route_block(
+        self,
+        block: BlockData,
+        transfers: Optional[List[AttributeDict]] = None
+    ) -> Dict[Route, list]:
+        watch_index.ensure_current()
+        routed = self.route(block["transactions"])
+        if self._transfer_routes():
+            if transfers is None:
+                # Raises when the logs can't be fetched, a block routed without its transfers would have them skipped
+                transfers = self.fetch_transfers(block["number"], block["number"]).get(block["number"], [])
+            routed.update(self.route_transfers(transfers))
+        return routed
+
+    def filter_block(
+        self,
+        block: BlockData,
+        transfers: Optional[List[AttributeDict]] = None
+    ) -> Tuple[Dict[str, List[PendingRecord]], List[str]]:
+        # Also returns the names of the processors that failed, which didn't handle the block
+        routed = self.route_block(block, transfers)
+        records_by_processor, failed = {}, []
+        for route, processors in self._processors.items():
+            for processor in processors:
+                try:
+                    records_by_processor[processor.name] = processor.filter(block, routed[route])
+                except Exception as e:
+                    logger.exception(f"An exception occurred while filtering block: {e}")
+                    failed.append(processor.name)
+        return records_by_processor, failed
+
+    def schedule(self, block_number: int, records_by_processor: Dict[str, List[PendingRecord]]) -> Dict[str, List[PendingRecord]]:
+        # Adds the new transactions of a block and returns the ones that became confirmed with it
+        due = {}
+        for processor in self.processors():
+            scheduler = self._schedulers[processor.name]
+            with observe_stage("confirm", processor.name):
+                scheduler.ensure_loaded()
+                scheduler.add(records_by_processor.get(processor.name, []))
+                due[processor.name] = scheduler.pop_due(block_number)
+            PENDING_TRANSACTIONS.set(len(scheduler), processor=processor.name)
+
+        pending = sum(len(scheduler) for scheduler in self._schedulers.values())
+        if pending:
+            logger.info(f"{pending} transactions are waiting for confirmations.")
+        return due
+
+    def persist(self, records_by_processor: Dict[str, List[PendingRecord]], retry_at: Optional[int] = None) -> List[str]:
+        # Returns the names of the processors that failed
+        failed = []
+        for processor in self.processors():
+            records = records_by_processor.get(processor.name)
+            if not records:
+                continue
+            try:
+                processor.persist(records)
+                self._schedulers[processor.name].complete(records)
+            except Exception as e:
+                logger.exception(f"An exception occurred while processing block: {e}")
+                failed.append(processor.name)
+                if retry_at is not None:
+                    # The transactions stay pending and are tried again with the next block
+                    self._schedulers[processor.name].retry(records, retry_at)
+        return failed
+
+    def dispatch(
+        self,
+        block: BlockData,
+        confirmed: bool = False,
+        transfers: Optional[List[AttributeDict]] = None
+    ) -> List[str]:
+        with block_profiler().profile():
+            records_by_processor, failed = self.filter_block(block, transfers)
+            if confirmed:
+                return failed + self.persist(records_by_processor)
+            return failed + self.persist(self.schedule(block["number"], records_by_processor), retry_at=block["number"] + 1)
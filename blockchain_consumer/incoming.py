@@ -1,86 +1,88 @@
-from typing import List, Tuple
+from typing import List, Optional
 
+from web3.datastructures import AttributeDict
 from web3.types import BlockData, TxData
-from Wallet.models import Account, ReceivedTransaction, Token, TokenBalance
+from Wallet.models import Account, ReceivedTransaction, Token
+from blockchain_consumer.abi_decoding import transfer_decoder
 from blockchain_consumer.block_fetcher import TransactionProcessor
+from blockchain_consumer.confirmations import PendingRecord
+from blockchain_consumer.contract_cache import contract_cache
+from blockchain_consumer.metrics import observe_stage
+from blockchain_consumer.routing import Route
+from blockchain_consumer.watch_index import watch_index
 
 
-class IncomingTransactionProcessor(TransactionProcessor):
-    def _filter_transactions(self, block: BlockData) -> List[Tuple[TxData, list, dict]]:
-        result = []
-        for transaction in block["transactions"]:
-            transaction: TxData
-            try:
-                account = Account.objects.get(public_key=transaction["to"])
-                # This processor only processes ETH transactions
-                if not transaction["value"]:
-                    continue
-            except Account.DoesNotExist:
-                pass
-            else:
-                result.append((transaction, [], {"account": account}))
-        return result
-
-    def _process_transaction(self, transaction_raw: TxData, *args, **kwargs):
-        self._get_logger().info(f"Processing ETH transaction {transaction_raw['hash']}")
+class IncomingProcessor(TransactionProcessor):
+    TRANSACTION_MODEL = ReceivedTransaction
 
-        account = kwargs["account"]
-
-        transaction = ReceivedTransaction(
-            transaction_hash=transaction_raw["hash"],
-            amount_wei=transaction_raw["value"],
-            sender=transaction_raw["from"],
-            receiver=account
+    def _build_transaction(self, record: PendingRecord, account: Account, token: Optional[Token]) -> ReceivedTransaction:
+        return ReceivedTransaction(
+            transaction_hash=record.transaction_hash,
+            amount_wei=record.amount,
+            sender=record.counterparty,
+            receiver=account,
+            token=token
         )
-        transaction.save()
 
-        account.update_balance(web3_client=self._web3_client)
 
+class IncomingTransactionProcessor(IncomingProcessor):
+    # This processor only processes ETH transactions
+    ROUTE = Route.TO_ACCOUNT | Route.HAS_VALUE
 
-class IncomingERC20Processor(TransactionProcessor):
-    def _filter_transactions(self, block: BlockData) -> List[Tuple[TxData, list, dict]]:
+    def _filter_transactions(self, block: BlockData, transactions: List[TxData]) -> List[PendingRecord]:
         result = []
-        for transaction in block["transactions"]:
-            transaction: TxData
-            try:
-                # This processor only processes ERC20 transactions
-                if transaction["value"]:
-                    continue
-                token = Token.objects.get(contract_address=transaction["to"])
-                contract = self._web3_client.eth.contract(
-                    address=token.contract_address,
-                    abi=token.abi
-                )
-                _, parameters = contract.decode_function_input(transaction["input"])
-                account = Account.objects.get(public_key=parameters.get("to"))
-
-            except (Account.DoesNotExist, Token.DoesNotExist):
-                pass
-            else:
-                result.append((transaction, [], {"account": account, "token": token, "contract": contract}))
+        for transaction in transactions:
+            account_id = watch_index.account_id(transaction["to"])
+            if account_id is not None:
+                result.append(self._record(transaction, account_id, transaction["from"], transaction["value"]))
         return result
 
-    def _process_transaction(self, transaction_raw: TxData, *args, **kwargs):
-        self._get_logger().info(f"Processing ERC20 transaction {transaction_raw['hash']}")
 
-        token = kwargs["token"]
+class IncomingERC20Processor(IncomingProcessor):
+    # This processor only processes ERC20 transactions
+    ROUTE = Route.TO_TOKEN | Route.NO_VALUE
 
-        contract = kwargs["contract"]
+    def _filter_transactions(self, block: BlockData, transactions: List[TxData]) -> List[PendingRecord]:
+        if not transactions:
+            return []
+        tokens = Token.objects.in_bulk({watch_index.token_id(transaction["to"]) for transaction in transactions})
 
-        _, parameters = contract.decode_function_input(transaction_raw["input"])
-        account = kwargs["account"]
+        candidates = []
+        for transaction in transactions:
+            token = tokens.get(watch_index.token_id(transaction["to"]))
+            if token is None:
+                continue
+            # Calls other than transfer (approve, transferFrom...) are rejected without decoding them
+            function = contract_cache.get(self._web3_client, token).function(transaction["input"])
+            if function is None or function[0] != "transfer":
+                continue
+            candidates.append((transaction, token, function[1]))
 
-        token_balance = TokenBalance(
-            account=account,
-            token=token
-        )
-        token_balance.update_balance(contract)
+        # All transfers of the block are decoded at once, possibly by several processes
+        with observe_stage("decode", self.name):
+            decoded_transfers = transfer_decoder().decode([(types, transaction["input"]) for transaction, _, types in candidates])
 
-        transaction = ReceivedTransaction(
-            transaction_hash=transaction_raw["hash"],
-            amount_wei=parameters["tokens"],
-            sender=transaction_raw["from"],
-            receiver=account,
-            token=token
-        )
-        transaction.save()
+        result = []
+        for (transaction, token, _), decoded in zip(candidates, decoded_transfers):
+            if decoded is None:
+                continue
+            receiver, amount = decoded
+            account_id = watch_index.account_id(receiver)
+            if account_id is not None:
+                result.append(self._record(transaction, account_id, transaction["from"], amount, token.pk))
+        return result
+
+
+class IncomingERC20TransferProcessor(IncomingProcessor):
+    # This processor reads ERC20 Transfer events instead of decoding transactions, so it also
+    # picks up transferFrom calls and transfers made by other contracts
+    ROUTE = Route.TRANSFER_LOG | Route.TO_ACCOUNT
+
+    def _filter_transactions(self, block: BlockData, transactions: List[AttributeDict]) -> List[PendingRecord]:
+        result = []
+        for transfer in transactions:
+            token_id = watch_index.token_id(transfer["token"])
+            account_id = watch_index.account_id(transfer["to"])
+            if token_id is not None and account_id is not None:
+                result.append(self._record(transfer, account_id, transfer["from"], transfer["value"], token_id))
+        return result
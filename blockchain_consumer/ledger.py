@@ -0,0 +1,158 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from itertools import islice
+from operator import or_
+from typing import Dict, Iterable, List, Optional, Type
+
+from django.db import transaction
+from django.db.models import Q, Sum
+from web3 import Web3
+
+from Wallet.models import BalanceSnapshot, ReceivedTransaction, SentTransaction, Transaction
+from blockchain_consumer.balances import BalanceFetcher, all_balance_keys
+from blockchain_consumer.persistence import BalanceKey, persist_balances, persist_transactions
+from blockchain_consumer.sharding import Shard
+
+logger = logging.getLogger(__name__)
+
+
+def _rows_after(snapshot: Optional[BalanceSnapshot], to_block: Optional[int]) -> Q:
+    if snapshot is None:
+        # Without a snapshot, every transaction counts, including the ones stored before block numbers were recorded
+        condition = Q()
+        if to_block is not None:
+            condition &= Q(block_number__lte=to_block) | Q(block_number__isnull=True)
+    else:
+        condition = Q(block_number__gt=snapshot.block_number)
+        if to_block is not None:
+            condition &= Q(block_number__lte=to_block)
+    return condition
+
+
+def _totals(model: Type[Transaction], account_field: str, conditions: List[Q], field: str, by_token: bool = True) -> dict:
+    if not conditions:
+        return {}
+    group_by = [f"{account_field}_id", "token_id"] if by_token else [f"{account_field}_id"]
+    rows = model.objects.filter(reduce(or_, conditions)).values(*group_by).annotate(total=Sum(field))
+    return {tuple(row[column] for column in group_by): row["total"] or 0 for row in rows}
+
+
+def ledger_balances(keys: Iterable[BalanceKey], to_block: Optional[int] = None) -> Dict[BalanceKey, int]:
+    # Balances at the end of to_block (or with every stored transaction), as the last snapshot of each balance
+    # plus the transactions stored after it. ETH balances also pay the gas of every transaction sent
+    keys = list(set(keys))
+    if not keys:
+        return {}
+    snapshots = {
+        (snapshot.account_id, snapshot.token_id): snapshot
+        for snapshot in BalanceSnapshot.objects.filter(account__in={account for account, _ in keys})
+    }
+
+    received_conditions, sent_conditions, fee_conditions = [], [], []
+    for account, token in keys:
+        after_snapshot = _rows_after(snapshots.get((account.pk, token.pk if token else None)), to_block)
+        received_conditions.append(Q(receiver=account, token=token) & after_snapshot)
+        sent_conditions.append(Q(sender=account, token=token) & after_snapshot)
+        if token is None:
+            fee_conditions.append(Q(sender=account) & after_snapshot)
+
+    received = _totals(ReceivedTransaction, "receiver", received_conditions, "amount_wei")
+    sent = _totals(SentTransaction, "sender", sent_conditions, "amount_wei")
+    fees = _totals(SentTransaction, "sender", fee_conditions, "fee_wei", by_token=False)
+
+    balances = {}
+    for account, token in keys:
+        key = (account.pk, token.pk if token else None)
+        snapshot = snapshots.get(key)
+        balance = int(snapshot.balance) if snapshot is not None else 0
+        balance += received.get(key, 0) - sent.get(key, 0)
+        if token is None:
+            balance -= fees.get((account.pk,), 0)
+        balances[(account, token)] = balance
+    return balances
+
+
+def refresh_balances(keys: Iterable[BalanceKey]):
+    balances = {}
+    for (account, token), balance in ledger_balances(keys).items():
+        if balance < 0:
+            # Missed transactions (internal transfers, failed calls...) show up here, until a drift check fixes them
+            logger.warning(f"Ledger balance of {account.public_key} in {token or 'ETH'} is negative: {balance}")
+        balances[(account, token)] = max(balance, 0)
+    persist_balances(balances)
+
+
+def persist_ledger_transactions(model: Type[Transaction], records: List[Transaction], keys: List[BalanceKey]):
+    # The transactions and the balances they change are written together
+    with transaction.atomic():
+        persist_transactions(model, records, {})
+        refresh_balances(keys)
+
+
+def _store_snapshots(balances: Dict[BalanceKey, int], block_number: int, create_empty: bool = False):
+    existing = {
+        (snapshot.account_id, snapshot.token_id): snapshot
+        for snapshot in BalanceSnapshot.objects.filter(account__in={account for account, _ in balances})
+    }
+    to_update, to_create = [], []
+    for (account, token), balance in balances.items():
+        snapshot = existing.get((account.pk, token.pk if token else None))
+        if snapshot is None:
+            # Balances that never moved don't need a snapshot, unless the ledger has to be corrected to zero
+            if balance or create_empty:
+                to_create.append(BalanceSnapshot(account=account, token=token, block_number=block_number, balance=str(balance)))
+        elif snapshot.block_number < block_number or int(snapshot.balance) != balance:
+            snapshot.block_number, snapshot.balance = block_number, str(balance)
+            to_update.append(snapshot)
+
+    with transaction.atomic():
+        BalanceSnapshot.objects.bulk_update(to_update, ["block_number", "balance"])
+        BalanceSnapshot.objects.bulk_create(to_create)
+
+
+def snapshot_balances(block_number: int, batch_size: int = 100, shard: Optional[Shard] = None):
+    # Every transaction up to block_number must already be stored, which the block fetcher's checkpoint guarantees
+    snapshots = 0
+    for keys in all_balance_keys(batch_size, shard or Shard()):
+        balances = ledger_balances(keys, to_block=block_number)
+        _store_snapshots(balances, block_number)
+        snapshots += len(balances)
+    logger.info(f"Snapshotted {snapshots} ledger balances at block {block_number}.")
+
+
+def check_balance_drift(
+    web3_client: Web3,
+    block_number: int,
+    batch_size: int = 100,
+    max_workers: int = 4,
+    shard: Optional[Shard] = None,
+    fix: bool = False
+) -> int:
+    # Compares the ledger with the chain at a block whose transactions were all stored. With fix, the balances
+    # that drifted are snapshotted with their value on chain, and the ledger continues from there
+    fetcher = BalanceFetcher(web3_client)
+    batches = all_balance_keys(batch_size, shard or Shard())
+    drifted = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            # Only a bounded number of batches is in flight at a time, the database work happens on this thread
+            window = list(islice(batches, max_workers * 2))
+            if not window:
+                break
+            chain_balances = executor.map(lambda keys: fetcher.fetch(keys, block_identifier=hex(block_number)), window)
+            for keys, on_chain in zip(window, chain_balances):
+                in_ledger = ledger_balances(keys, to_block=block_number)
+                drifts = {key: balance for key, balance in on_chain.items() if in_ledger[key] != balance}
+                for (account, token), balance in drifts.items():
+                    logger.warning(
+                        f"Ledger balance of {account.public_key} in {token or 'ETH'} at block {block_number} "
+                        f"is {in_ledger[(account, token)]}, but {balance} on chain."
+                    )
+                drifted += len(drifts)
+                if fix and drifts:
+                    _store_snapshots(drifts, block_number, create_empty=True)
+                    refresh_balances(drifts)
+
+    logger.info(f"Checked ledger balances at block {block_number}, {drifted} drifted.")
+    return drifted
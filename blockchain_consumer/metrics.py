@@ -0,0 +1,298 @@
+import cProfile
+import logging
+import pstats
+import random
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import monotonic, perf_counter, time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds, in seconds, of the latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: Union[int, float]) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {self.label_names}, not {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[Tuple[str, str, Union[int, float]]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: Union[int, float] = 1, **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, str, Union[int, float]]]:
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _format_labels(self.label_names, key), value) for key, value in values]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value: Union[int, float], **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self._buckets = tuple(buckets)
+        # Label values -> (count per bucket, with one more for +Inf, sum of the observed values)
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: Union[int, float], **labels: str):
+        key = self._label_values(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self._buckets) + 1), [0.0]))
+            counts[bisect_left(self._buckets, value)] += 1
+            total[0] += value
+
+    def samples(self) -> List[Tuple[str, str, Union[int, float]]]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            # Buckets are cumulative in the exposition format
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names + ("le",), key + (_format_value(bound),))
+                samples.append((f"{self.name}_bucket", labels, cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.label_names, key), total))
+            samples.append((f"{self.name}_count", _format_labels(self.label_names, key), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"A metric named {metric.name} is already registered.")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+HEAD_LAG_BLOCKS = registry.register(Gauge(
+    "consumer_head_lag_blocks",
+    "Blocks between the head of the chain and the last block fetched by the consumer."
+))
+HEAD_LAG_SECONDS = registry.register(Gauge(
+    "consumer_head_lag_seconds",
+    "Seconds since the last block fetched by the consumer was produced."
+))
+STAGE_SECONDS = registry.register(Histogram(
+    "consumer_stage_seconds",
+    "Time spent per block in each stage by processor, or per batch of blocks for the fetch stage.",
+    ("stage", "processor")
+))
+STAGE_QUERIES = registry.register(Histogram(
+    "consumer_db_queries_per_block",
+    "Database queries per block in each stage, by processor.",
+    ("stage", "processor"),
+    buckets=QUERY_BUCKETS
+))
+PENDING_TRANSACTIONS = registry.register(Gauge(
+    "consumer_pending_transactions",
+    "Transactions waiting for their confirmations, by processor.",
+    ("processor",)
+))
+RPC_CALLS = registry.register(Counter(
+    "rpc_calls_total",
+    "JSON-RPC calls sent to the providers, by method. Calls of a batch are counted separately.",
+    ("method",)
+))
+RPC_CACHED_CALLS = registry.register(Counter(
+    "rpc_cached_calls_total",
+    "JSON-RPC calls answered from the local chain data cache, by method.",
+    ("method",)
+))
+RPC_SECONDS = registry.register(Histogram(
+    "rpc_request_seconds",
+    "Latency of the JSON-RPC requests, by method. Batches mixing several methods are reported as \"batch\".",
+    ("method",)
+))
+
+
+@contextmanager
+def observe_stage(stage: str, processor: str = "") -> Iterator[None]:
+    # Times the stage and counts the queries it runs on this thread's database connection
+    queries = 0
+
+    def count_query(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    started = perf_counter()
+    try:
+        with connection.execute_wrapper(count_query):
+            yield
+    finally:
+        STAGE_SECONDS.observe(perf_counter() - started, stage=stage, processor=processor)
+        STAGE_QUERIES.observe(queries, stage=stage, processor=processor)
+
+
+def observe_head(head_block_number: int, block_number: int, block_timestamp: int):
+    HEAD_LAG_BLOCKS.set(max(head_block_number - block_number, 0))
+    HEAD_LAG_SECONDS.set(max(time() - block_timestamp, 0))
+
+
+def observe_rpc(methods: Sequence[str], seconds: float, cached: Sequence[str] = ()):
+    for method in methods:
+        RPC_CALLS.inc(method=method)
+    for method in cached:
+        RPC_CACHED_CALLS.inc(method=method)
+    if methods:
+        RPC_SECONDS.observe(seconds, method=methods[0] if len(set(methods)) == 1 else "batch")
+
+
+class BlockProfiler:
+    # Profiles a random sample of the blocks, and writes the statistics accumulated over all samples to a file
+    # that can be read with pstats or snakeviz. Profiling only covers the thread handling the block.
+    def __init__(self, sample_rate: float, path: Union[str, Path], dump_interval: Union[int, float] = 60):
+        self._sample_rate = sample_rate
+        self._path = str(path)
+        self._dump_interval = dump_interval
+        self._stats: Optional[pstats.Stats] = None
+        self._samples = 0
+        self._dumped_at = monotonic()
+        self._lock = threading.Lock()
+
+    def _collect(self, profiler: cProfile.Profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+            self._samples += 1
+            if monotonic() - self._dumped_at >= self._dump_interval:
+                self._dump()
+
+    def _dump(self):
+        self._stats.dump_stats(self._path)
+        self._dumped_at = monotonic()
+        logger.info(f"Wrote the profile of {self._samples} blocks to {self._path}.")
+
+    def flush(self):
+        with self._lock:
+            if self._stats is not None:
+                self._dump()
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        if not self._sample_rate or random.random() >= self._sample_rate:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running on this thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._collect(profiler)
+
+
+_block_profiler: Optional[BlockProfiler] = None
+_block_profiler_lock = threading.Lock()
+
+
+def block_profiler() -> BlockProfiler:
+    global _block_profiler
+    with _block_profiler_lock:
+        if _block_profiler is None:
+            _block_profiler = BlockProfiler(settings.BLOCK_PROFILE_SAMPLE_RATE, settings.BLOCK_PROFILE_PATH)
+        return _block_profiler
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the consumer's logs
+        pass
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    # The consumer usually runs in its own process, where the Django view can't see its metrics
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on port {port}.")
+    return server
@@ -1,84 +1,119 @@
-from typing import List, Tuple
+from typing import List, Optional
 
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
 from web3.types import BlockData, TxData
-from Wallet.models import Account, SentTransaction, Token, TokenBalance
+from Wallet.models import Account, SentTransaction, Token
+from blockchain_consumer.abi_decoding import transfer_decoder
 from blockchain_consumer.block_fetcher import TransactionProcessor
-
-
-class OutgoingTransactionProcessor(TransactionProcessor):
-    def _filter_transactions(self, block: BlockData) -> List[Tuple[TxData, list, dict]]:
-        result = []
-        for transaction in block["transactions"]:
-            transaction: TxData
-            try:
-                account = Account.objects.get(public_key=transaction["from"])
-                # This processor only processes ETH transactions
-                if not transaction["value"]:
-                    continue
-            except Account.DoesNotExist:
-                pass
-            else:
-                result.append((transaction, [], {"account": account}))
-        return result
-
-    def _process_transaction(self, transaction_raw: TxData, *args, **kwargs):
-        self._get_logger().info(f"Processing ETH transaction {transaction_raw['hash']}")
-
-        account = kwargs["account"]
-
-        transaction = SentTransaction(
-            transaction_hash=transaction_raw["hash"],
-            amount_wei=transaction_raw["value"],
+from blockchain_consumer.confirmations import PendingRecord
+from blockchain_consumer.contract_cache import contract_cache
+from blockchain_consumer.metrics import observe_stage
+from blockchain_consumer.persistence import BalanceKey
+from blockchain_consumer.routing import Route
+from blockchain_consumer.watch_index import watch_index
+
+
+class OutgoingProcessor(TransactionProcessor):
+    TRANSACTION_MODEL = SentTransaction
+
+    def _prepare_ledger(self, transactions: List[SentTransaction], balance_keys: List[BalanceKey]) -> List[BalanceKey]:
+        # The sender of a transaction pays its gas in ETH, which only the receipt tells. A transfer made for the
+        # account by a spender it approved costs it nothing, and the fee is only counted once per transaction
+        receipts = self._receipts(transactions)
+        # Receipts from before EIP-1559 don't have the effective gas price, the transaction's gas price applies
+        legacy = [
+            transaction_hash for transaction_hash, receipt in receipts.items()
+            if receipt is not None and "effectiveGasPrice" not in receipt
+        ]
+        legacy_transactions = self._rpc.call("eth_getTransactionByHash", [[transaction_hash] for transaction_hash in legacy])
+        gas_prices = {
+            transaction_hash: legacy_transaction["gasPrice"]
+            for transaction_hash, legacy_transaction in zip(legacy, legacy_transactions)
+        }
+
+        charged = set()
+        for transaction in transactions:
+            transaction_hash = HexBytes(transaction.transaction_hash).hex()
+            receipt = receipts[transaction_hash]
+            if receipt is None:
+                self._get_logger().warning(f"No receipt for transaction {transaction_hash}, its fee is left out.")
+                continue
+            if transaction_hash in charged or receipt["from"].lower() != transaction.sender.public_key.lower():
+                continue
+            charged.add(transaction_hash)
+            gas_price = gas_prices.get(transaction_hash, receipt.get("effectiveGasPrice"))
+            transaction.fee_wei = receipt["gasUsed"] * (gas_price if isinstance(gas_price, int) else int(gas_price, 16))
+        return balance_keys + [(transaction.sender, None) for transaction in transactions]
+
+    def _build_transaction(self, record: PendingRecord, account: Account, token: Optional[Token]) -> SentTransaction:
+        return SentTransaction(
+            transaction_hash=record.transaction_hash,
+            amount_wei=record.amount,
             sender=account,
-            receiver=transaction_raw["to"]
+            receiver=record.counterparty,
+            token=token
         )
-        transaction.save()
 
-        account.update_balance(web3_client=self._web3_client)
 
+class OutgoingTransactionProcessor(OutgoingProcessor):
+    # This processor only processes ETH transactions
+    ROUTE = Route.FROM_ACCOUNT | Route.HAS_VALUE
 
-class OutgoingERC20Processor(TransactionProcessor):
-    def _filter_transactions(self, block: BlockData) -> List[Tuple[TxData, list, dict]]:
+    def _filter_transactions(self, block: BlockData, transactions: List[TxData]) -> List[PendingRecord]:
         result = []
-        for transaction in block["transactions"]:
-            transaction: TxData
-            try:
-                # This processor only processes ERC20 transactions
-                if transaction["value"]:
-                    continue
-                token = Token.objects.get(contract_address=transaction["to"])
-                account = Account.objects.get(public_key=transaction["from"])
-
-            except (Account.DoesNotExist, Token.DoesNotExist):
-                pass
-            else:
-                result.append((transaction, [], {"account": account, "token": token}))
+        for transaction in transactions:
+            account_id = watch_index.account_id(transaction["from"])
+            if account_id is not None:
+                result.append(self._record(transaction, account_id, transaction["to"], transaction["value"]))
         return result
 
-    def _process_transaction(self, transaction_raw: TxData, *args, **kwargs):
-        self._get_logger().info(f"Processing ERC20 transaction {transaction_raw['hash']}")
 
-        token = kwargs["token"]
+class OutgoingERC20Processor(OutgoingProcessor):
+    # This processor only processes ERC20 transactions
+    ROUTE = Route.FROM_ACCOUNT | Route.TO_TOKEN | Route.NO_VALUE
+
+    def _filter_transactions(self, block: BlockData, transactions: List[TxData]) -> List[PendingRecord]:
+        if not transactions:
+            return []
+        tokens = Token.objects.in_bulk({watch_index.token_id(transaction["to"]) for transaction in transactions})
+
+        candidates = []
+        for transaction in transactions:
+            token = tokens.get(watch_index.token_id(transaction["to"]))
+            account_id = watch_index.account_id(transaction["from"])
+            if token is None or account_id is None:
+                continue
+            # Calls other than transfer (approve, transferFrom...) are rejected without decoding them
+            function = contract_cache.get(self._web3_client, token).function(transaction["input"])
+            if function is None or function[0] != "transfer":
+                continue
+            candidates.append((transaction, token, account_id, function[1]))
+
+        # All transfers of the block are decoded at once, possibly by several processes
+        with observe_stage("decode", self.name):
+            decoded_transfers = transfer_decoder().decode(
+                [(types, transaction["input"]) for transaction, _, _, types in candidates]
+            )
 
-        contract = self._web3_client.eth.contract(
-            address=token.contract_address,
-            abi=token.abi
-        )
+        result = []
+        for (transaction, token, account_id, _), decoded in zip(candidates, decoded_transfers):
+            if decoded is not None:
+                receiver, amount = decoded
+                result.append(self._record(transaction, account_id, receiver, amount, token.pk))
+        return result
 
-        _, parameters = contract.decode_function_input(transaction_raw["input"])
-        account = kwargs["account"]
 
-        token_balance = TokenBalance(
-            account=account,
-            token=token
-        )
-        token_balance.update_balance(contract)
+class OutgoingERC20TransferProcessor(OutgoingProcessor):
+    # This processor reads ERC20 Transfer events instead of decoding transactions, so it also
+    # picks up transferFrom calls and transfers made by other contracts
+    ROUTE = Route.TRANSFER_LOG | Route.FROM_ACCOUNT
 
-        transaction = SentTransaction(
-            transaction_hash=transaction_raw["hash"],
-            amount_wei=parameters["tokens"],
-            sender=account,
-            receiver=parameters.get("to"),
-            token=token
-        )
-        transaction.save()
+    def _filter_transactions(self, block: BlockData, transactions: List[AttributeDict]) -> List[PendingRecord]:
+        result = []
+        for transfer in transactions:
+            token_id = watch_index.token_id(transfer["token"])
+            account_id = watch_index.account_id(transfer["from"])
+            if token_id is not None and account_id is not None:
+                result.append(self._record(transfer, account_id, transfer["to"], transfer["value"], token_id))
+        return result
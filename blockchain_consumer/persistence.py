@@ -0,0 +1,57 @@
+from typing import Dict, List, Optional, Tuple, Type
+
+from django.db import transaction
+
+from Wallet.models import Account, Token, TokenBalance, Transaction
+
+# ETH balances have no token
+BalanceKey = Tuple[Account, Optional[Token]]
+
+
+def _upsert_token_balances(token_balances: Dict[Tuple[Account, Token], int]):
+    existing = {
+        (token_balance.account_id, token_balance.token_id): token_balance
+        for token_balance in TokenBalance.objects.filter(
+            account__in={account for account, _ in token_balances},
+            token__in={token for _, token in token_balances}
+        )
+    }
+
+    to_update, to_create = [], []
+    for (account, token), balance in token_balances.items():
+        token_balance = existing.get((account.pk, token.pk))
+        if token_balance is None:
+            to_create.append(TokenBalance(account=account, token=token, balance=balance))
+        else:
+            token_balance.balance = balance
+            to_update.append(token_balance)
+
+    TokenBalance.objects.bulk_update(to_update, ["balance"])
+    TokenBalance.objects.bulk_create(to_create, ignore_conflicts=True)
+
+
+def _write_balances(balances: Dict[BalanceKey, int]):
+    accounts = []
+    token_balances = {}
+    for (account, token), balance in balances.items():
+        if token is None:
+            account.balance_wei = balance
+            accounts.append(account)
+        else:
+            token_balances[(account, token)] = balance
+
+    Account.objects.bulk_update(accounts, ["balance_wei"])
+    _upsert_token_balances(token_balances)
+
+
+def persist_balances(balances: Dict[BalanceKey, int]):
+    with transaction.atomic():
+        _write_balances(balances)
+
+
+def persist_transactions(model: Type[Transaction], records: List[Transaction], balances: Dict[BalanceKey, int]):
+    # Everything confirmed in a block is written in a single transaction. Transactions that were
+    # already stored (e.g. when a block is processed again) are skipped by their unique hash and log index.
+    with transaction.atomic():
+        model.objects.bulk_create(records, ignore_conflicts=True)
+        _write_balances(balances)
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import threading
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from django.db import connections
+from web3 import Web3
+from web3.exceptions import BlockNotFound
+from web3.types import BlockData
+
+from Wallet.models import BlockCheckpoint
+from blockchain_consumer.block_fetcher import AdaptivePollingInterval, BlockFetcher, BlockHistory
+from blockchain_consumer.confirmations import PendingRecord
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.metrics import STAGE_SECONDS, block_profiler, observe_head
+from blockchain_consumer.rpc_batch import BatchRpcClient, merge_prefiltered
+from blockchain_consumer.sharding import Shard
+from blockchain_consumer.transaction_processor import TransactionProcessor
+from blockchain_consumer.transfer_logs import TransferLogSource
+
+logger = logging.getLogger(__name__)
+
+
+class _Rewind:
+    __slots__ = ("fork_point",)
+
+    def __init__(self, fork_point: int):
+        self.fork_point = fork_point
+
+
+class AsyncBlockPipeline:
+    # Fetching, filtering, confirmation tracking and persistence run as separate stages connected by bounded
+    # queues: blocks are downloaded while the previous ones are still being filtered and written, and a slow
+    # stage makes the ones before it wait instead of buffering an unbounded number of blocks.
+    CHECKPOINT_NAME = BlockFetcher.CHECKPOINT_NAME
+    # Attempts at storing the transactions of a confirmed block again after a failure, and the first delay in seconds
+    PERSIST_RETRIES = 3
+    PERSIST_RETRY_DELAY = 1
+
+    def __init__(
+        self,
+        web3_client: Web3,
+        polling_delay: Union[int, float] = 10,
+        min_polling_delay: Union[int, float] = 1,
+        batch_size: int = 20,
+        fetch_concurrency: int = 4,
+        queue_size: int = 100,
+        reorg_history_size: int = 64,
+        shard: Optional[Shard] = None,
+        prefilter: bool = False
+    ):
+        self._checkpoint_name = self.CHECKPOINT_NAME + (shard or Shard()).suffix
+        self._stopped = threading.Event()
+        self._dispatcher = BlockDispatcher(TransferLogSource(web3_client))
+        self._client = web3_client
+        # Requests go through the shared client, with its rate limit, retries, failover and cache, on threads
+        # of their own so that several windows are fetched at once
+        self._rpc = BatchRpcClient(web3_client)
+        self._fetch_executor = ThreadPoolExecutor(max_workers=fetch_concurrency, thread_name_prefix="pipeline-fetch")
+        self._batch_size = batch_size
+        self._fetch_concurrency = fetch_concurrency
+        self._queue_size = queue_size
+        self._prefilter = prefilter
+        self._needs_transactions: Optional[Callable[[List[BlockData]], List[bool]]] = None
+        self._polling_interval = AdaptivePollingInterval(min_polling_delay, polling_delay)
+        self._history = BlockHistory(reorg_history_size)
+        # First confirmed block whose transactions couldn't be stored, the checkpoint can't move past it
+        self._first_failed_block: Optional[int] = None
+        # Filtering reads the database, while the writes go through a single dedicated thread
+        self._filter_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline-filter")
+        self._orm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline-orm")
+
+    def subscribe(self, observer: TransactionProcessor):
+        self._dispatcher.subscribe(observer)
+
+    @staticmethod
+    async def _run_in(executor: ThreadPoolExecutor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def _head_block_number(self) -> int:
+        # Through the provider, which keeps track of the head of each endpoint
+        return await self._run_in(self._fetch_executor, lambda: self._client.eth.block_number)
+
+    async def _get_blocks(self, block_numbers: List[int], full_transactions: bool = True) -> List[BlockData]:
+        blocks = await self._run_in(
+            self._fetch_executor,
+            self._rpc.call,
+            "eth_getBlockByNumber",
+            [[hex(number), full_transactions] for number in block_numbers]
+        )
+        for block_number, block in zip(block_numbers, blocks):
+            if block is None:
+                raise BlockNotFound(f"Block with id: '{block_number}' not found.")
+        return blocks
+
+    async def _resume(self) -> int:
+        # The prefilter depends on the processors, which all subscribed by now
+        self._needs_transactions = self._dispatcher.bloom_prefilter() if self._prefilter else None
+        checkpoint = await self._run_in(self._orm_executor, BlockCheckpoint.load, self._checkpoint_name)
+        if checkpoint is None:
+            return await self._head_block_number()
+        logger.info(f"Resuming from checkpoint {checkpoint}...")
+        # Blocks after the checkpoint are processed again, so their pending transactions are picked up again
+        # from the blocks that are part of the chain now
+        await self._run_in(self._orm_executor, self._dispatcher.rollback, checkpoint)
+        return checkpoint
+
+    async def _find_fork_point(self) -> int:
+        fork_point = None
+        for block_number, block_hash in self._history.newest_first():
+            fork_point = block_number - 1
+            block = (await self._get_blocks([block_number], full_transactions=False))[0]
+            if bytes(block["hash"]) == block_hash:
+                return block_number
+        logger.error(f"Chain reorganization deeper than the last {len(self._history)} blocks.")
+        return fork_point
+
+    async def _get_prefiltered_blocks(self, block_numbers: List[int]) -> List[BlockData]:
+        if self._needs_transactions is None:
+            return await self._get_blocks(block_numbers)
+        # Headers come first, the transactions are only downloaded for the blocks that may concern us
+        headers = await self._get_blocks(block_numbers, full_transactions=False)
+        needed = [header["number"] for header, needs in zip(headers, self._needs_transactions(headers)) if needs]
+        return merge_prefiltered(headers, await self._get_blocks(needed) if needed else [])
+
+    async def _fetch_window(self, block_numbers: List[int]) -> List[BlockData]:
+        started = perf_counter()
+        blocks = await self._get_prefiltered_blocks(block_numbers)
+        STAGE_SECONDS.observe(perf_counter() - started, stage="fetch", processor="")
+        return blocks
+
+    async def _fetch_range(self, from_block: int, to_block: int) -> List[BlockData]:
+        windows = [
+            list(range(start, min(start + self._batch_size, to_block + 1)))
+            for start in range(from_block, to_block + 1, self._batch_size)
+        ]
+        blocks = []
+        for window_blocks in await asyncio.gather(*(self._fetch_window(window) for window in windows)):
+            blocks.extend(window_blocks)
+        return blocks
+
+    async def _fetch(self, blocks: asyncio.Queue, to_block: Optional[int]):
+        start_block = await self._resume()
+        last_fetched = (await self._get_blocks([start_block], full_transactions=False))[0]
+        self._history.append(last_fetched)
+        next_block = start_block + 1
+        while not self._stopped.is_set() and (to_block is None or next_block <= to_block):
+            head_block_number = await self._head_block_number()
+            observe_head(head_block_number, last_fetched["number"], last_fetched["timestamp"])
+            last_block = head_block_number if to_block is None else min(head_block_number, to_block)
+            if last_block < next_block:
+                await asyncio.sleep(self._polling_interval.next_delay())
+                continue
+
+            last_block = min(last_block, next_block + self._batch_size * self._fetch_concurrency - 1)
+            try:
+                fetched = await self._fetch_range(next_block, last_block)
+                transfers = await self._run_in(self._filter_executor, self._dispatcher.fetch_transfers, next_block, last_block)
+            except BlockNotFound:
+                # The head moved, but the node we hit doesn't serve the block yet, retry
+                await asyncio.sleep(self._polling_interval.next_delay())
+                continue
+
+            # Blocks that already have enough confirmations skip the confirmation tracking
+            confirmed_head = head_block_number - self._dispatcher.confirmations_required()
+            for block in fetched:
+                if not self._history.extends(block):
+                    fork_point = await self._find_fork_point()
+                    logger.warning(
+                        f"Chain reorganization detected at block {block['number']}, rewinding to block {fork_point}."
+                    )
+                    self._history.rewind(fork_point)
+                    next_block = fork_point + 1
+                    await blocks.put(_Rewind(fork_point))
+                    break
+                self._history.append(block)
+                self._polling_interval.observe_block(block["timestamp"])
+                last_fetched = block
+                observe_head(head_block_number, block["number"], block["timestamp"])
+                logger.info(f"Found block {block['number']}")
+                await blocks.put((
+                    block,
+                    block["number"] <= confirmed_head,
+                    None if transfers is None else transfers.get(block["number"], [])
+                ))
+                next_block = block["number"] + 1
+        await blocks.put(None)
+
+    async def _filter(self, blocks: asyncio.Queue, records: asyncio.Queue):
+        while True:
+            item = await blocks.get()
+            if item is None or isinstance(item, _Rewind):
+                await records.put(item)
+                if item is None:
+                    return
+                continue
+            block, confirmed, transfers = item
+            records_by_processor, failed = await self._run_in(self._filter_executor, self._filter_block, block, transfers)
+            await records.put((block["number"], confirmed, records_by_processor, failed))
+
+    async def _confirm(self, records: asyncio.Queue, persisting: asyncio.Queue):
+        while True:
+            item = await records.get()
+            if item is None:
+                await persisting.put(None)
+                return
+            if isinstance(item, _Rewind):
+                dropped = await self._run_in(self._orm_executor, self._dispatcher.rollback, item.fork_point)
+                if dropped:
+                    logger.warning(f"Dropped {dropped} pending transactions from orphaned blocks.")
+                continue
+            block_number, confirmed, records_by_processor, failed = item
+            if confirmed:
+                await persisting.put((block_number, records_by_processor, None, failed))
+            else:
+                due = await self._run_in(self._orm_executor, self._dispatcher.schedule, block_number, records_by_processor)
+                await persisting.put((block_number, due, block_number + 1, failed))
+
+    def _filter_block(self, block: BlockData, transfers: Optional[list]) -> Tuple[Dict[str, List[PendingRecord]], List[str]]:
+        with block_profiler().profile():
+            return self._dispatcher.filter_block(block, transfers)
+
+    def _retry_confirmed(self, records_by_processor: Dict[str, List[PendingRecord]], failed: List[str]) -> List[str]:
+        # Confirmed blocks skip the schedulers, nothing would try their transactions again
+        for attempt in range(self.PERSIST_RETRIES):
+            if not failed or self._stopped.is_set():
+                break
+            sleep(self.PERSIST_RETRY_DELAY * 2 ** attempt)
+            failed = self._dispatcher.persist({name: records_by_processor[name] for name in failed})
+        return failed
+
+    def _persist_block(
+        self,
+        block_number: int,
+        records_by_processor: Dict[str, List[PendingRecord]],
+        retry_at: Optional[int],
+        filter_failed: Sequence[str] = ()
+    ):
+        # Processors that failed to filter the block never saw its transactions, confirmed or not
+        with block_profiler().profile():
+            failed = self._dispatcher.persist(records_by_processor, retry_at=retry_at)
+            if retry_at is None:
+                failed = self._retry_confirmed(records_by_processor, failed)
+        # The schedulers retry the transactions of unconfirmed blocks that couldn't be stored
+        missed = list(filter_failed) + (failed if retry_at is None else [])
+        if missed and self._first_failed_block is None:
+            logger.error(
+                f"Transactions of block {block_number} couldn't be handled by {', '.join(missed)}, "
+                f"the checkpoint stays before it until the consumer restarts."
+            )
+            self._first_failed_block = block_number
+
+        # Transactions in the last blocks may still be waiting for confirmations,
+        # so only the blocks that are fully confirmed count as processed
+        confirmed_block_number = block_number - self._dispatcher.confirmations_required()
+        if self._first_failed_block is not None:
+            # Resuming from the checkpoint processes the failed block again
+            confirmed_block_number = min(confirmed_block_number, self._first_failed_block - 1)
+        if confirmed_block_number >= 0:
+            BlockCheckpoint.store(self._checkpoint_name, confirmed_block_number)
+
+    async def _persist(self, persisting: asyncio.Queue):
+        while True:
+            item = await persisting.get()
+            if item is None:
+                return
+            await self._run_in(self._orm_executor, self._persist_block, *item)
+
+    async def run(self, to_block: Optional[int] = None):
+        blocks, records, persisting = (asyncio.Queue(maxsize=self._queue_size) for _ in range(3))
+        try:
+            await asyncio.gather(
+                self._fetch(blocks, to_block),
+                self._filter(blocks, records),
+                self._confirm(records, persisting),
+                self._persist(persisting),
+            )
+        finally:
+            self._fetch_executor.shutdown()
+            for executor in (self._filter_executor, self._orm_executor):
+                # Executor threads get their own database connection, which Django won't close for us
+                executor.submit(connections.close_all).result()
+
+    def stop(self):
+        # The blocks that were already fetched still go through the remaining stages
+        self._stopped.set()
+
+    def start(self):
+        logger.info("Starting block pipeline...")
+        try:
+            asyncio.run(self.run())
+        finally:
+            block_profiler().flush()
@@ -0,0 +1,47 @@
+from enum import IntFlag
+from typing import Iterable, List
+
+from web3.datastructures import AttributeDict
+from web3.types import TxData
+
+from blockchain_consumer.watch_index import watch_index
+
+
+class Route(IntFlag):
+    # A processor with an empty route receives every transaction in the block
+    ANY = 0
+    FROM_ACCOUNT = 1
+    TO_ACCOUNT = 2
+    TO_TOKEN = 4
+    HAS_VALUE = 8
+    NO_VALUE = 16
+    # ERC20 Transfer events read from the block's logs rather than from its transactions
+    TRANSFER_LOG = 32
+
+
+def classify(transaction: TxData) -> Route:
+    route = Route.HAS_VALUE if transaction["value"] else Route.NO_VALUE
+    if watch_index.has_account(transaction["from"]):
+        route |= Route.FROM_ACCOUNT
+    if watch_index.has_account(transaction["to"]):
+        route |= Route.TO_ACCOUNT
+    if watch_index.has_token(transaction["to"]):
+        route |= Route.TO_TOKEN
+    return route
+
+
+def classify_transfer(transfer: AttributeDict) -> Route:
+    route = Route.TRANSFER_LOG
+    if watch_index.has_account(transfer["from"]):
+        route |= Route.FROM_ACCOUNT
+    if watch_index.has_account(transfer["to"]):
+        route |= Route.TO_ACCOUNT
+    return route
+
+
+def matches(transaction_route: Route, route: Route) -> bool:
+    return transaction_route & route == route
+
+
+def route_transactions(transactions: Iterable[TxData], route: Route) -> List[TxData]:
+    return [transaction for transaction in transactions if matches(classify(transaction), route)]
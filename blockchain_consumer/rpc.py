@@ -0,0 +1,262 @@
+import logging
+import random
+import threading
+from time import monotonic, sleep
+from typing import Any, List, Optional, Tuple, Union
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3.providers import HTTPProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from blockchain_consumer.chain_cache import ChainDataCache, cache_key, is_final
+from blockchain_consumer.metrics import observe_rpc
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying, possibly on another endpoint
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate: Optional[float], capacity: int):
+        # No rate means no limit
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        if not self._rate:
+            return
+        # A batch bigger than the bucket would never get through otherwise
+        tokens = min(tokens, self._capacity)
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            sleep(wait)
+
+
+class RpcEndpoint:
+    def __init__(self, uri: str, pool_size: int, smoothing: float = 0.2):
+        self.uri = uri
+        # Connections are kept alive and reused by every thread of the process
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._smoothing = smoothing
+        # Exponential moving average of the response time, unknown until the first response
+        self.latency: Optional[float] = None
+        self.head_block_number: Optional[int] = None
+        self._failures = 0
+        self._unavailable_until = 0.0
+
+    def __str__(self) -> str:
+        return self.uri
+
+    def available(self) -> bool:
+        return monotonic() >= self._unavailable_until
+
+    def observe_success(self, latency: float):
+        self._failures = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self._smoothing * (latency - self.latency)
+
+    def observe_failure(self):
+        # Failing endpoints are avoided for longer and longer, up to a minute
+        self._failures += 1
+        self._unavailable_until = monotonic() + min(2 ** self._failures, 60)
+
+
+class PooledHTTPProvider(HTTPProvider):
+    def __init__(
+        self,
+        endpoint_uris: List[str],
+        requests_per_second: Optional[float] = None,
+        burst: int = 20,
+        max_retries: int = 3,
+        retry_delay: float = 0.5,
+        timeout: Union[int, float] = 10,
+        pool_size: int = 10,
+        max_head_lag: int = 3,
+        cache: Optional[ChainDataCache] = None,
+        cache_confirmations: int = 6,
+        head_probe_interval: Optional[Union[int, float]] = 30
+    ):
+        super().__init__(endpoint_uris[0], request_kwargs={"timeout": timeout})
+        self._endpoints = [RpcEndpoint(uri, pool_size) for uri in endpoint_uris]
+        self._rate_limiter = TokenBucket(requests_per_second, burst)
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._timeout = timeout
+        self._max_head_lag = max_head_lag
+        self._cache = cache
+        self._cache_confirmations = cache_confirmations
+        self._head_probe_interval = head_probe_interval
+        self._probed_at: Optional[float] = None
+        self._probe_lock = threading.Lock()
+
+    def _probe_head(self, endpoint: RpcEndpoint):
+        self._rate_limiter.acquire()
+        started = monotonic()
+        try:
+            response = endpoint.session.post(
+                endpoint.uri,
+                data=self.encode_rpc_request(RPCEndpoint("eth_blockNumber"), []),
+                headers=self.get_request_headers(),
+                timeout=self._timeout
+            )
+            response.raise_for_status()
+            endpoint.head_block_number = int(self.decode_rpc_response(response.content)["result"], 16)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            endpoint.observe_failure()
+            logger.warning(f"Probing the head of {endpoint} failed ({e}).")
+        else:
+            endpoint.observe_success(monotonic() - started)
+        observe_rpc(["eth_blockNumber"], monotonic() - started)
+
+    def _probe_heads(self):
+        # Heads are otherwise only learned from the endpoint that served eth_blockNumber. Probing them all lets
+        # a stalled endpoint be noticed even when it's the one every request goes to
+        if len(self._endpoints) < 2 or self._head_probe_interval is None:
+            return
+        if self._probed_at is not None and monotonic() - self._probed_at < self._head_probe_interval:
+            return
+        # A single thread probes, the others carry on with their requests
+        if not self._probe_lock.acquire(blocking=False):
+            return
+        try:
+            self._probed_at = monotonic()
+            for endpoint in self._endpoints:
+                self._probe_head(endpoint)
+        finally:
+            self._probe_lock.release()
+
+    def _lagging(self, endpoint: RpcEndpoint) -> bool:
+        # An endpoint whose head stays behind the others has most likely stalled
+        heads = [other.head_block_number for other in self._endpoints if other.head_block_number is not None]
+        return (
+            endpoint.head_block_number is not None and
+            endpoint.head_block_number < max(heads) - self._max_head_lag
+        )
+
+    def _choose_endpoint(self, exclude: Optional[RpcEndpoint] = None) -> RpcEndpoint:
+        candidates = [endpoint for endpoint in self._endpoints if endpoint is not exclude] or self._endpoints
+        healthy = [endpoint for endpoint in candidates if endpoint.available() and not self._lagging(endpoint)]
+        # Endpoints that weren't measured yet are tried first, then the fastest one wins
+        return min(
+            healthy or candidates,
+            key=lambda endpoint: endpoint.latency if endpoint.latency is not None else 0
+        )
+
+    def _post(self, data: bytes, weight: int) -> Tuple[bytes, RpcEndpoint]:
+        last_endpoint, last_error = None, None
+        for attempt in range(self._max_retries + 1):
+            if attempt:
+                # Exponential backoff with full jitter, so that retrying clients don't all come back at once
+                sleep(random.uniform(0, self._retry_delay * 2 ** (attempt - 1)))
+
+            self._probe_heads()
+            endpoint = self._choose_endpoint(exclude=last_endpoint)
+            self._rate_limiter.acquire(weight)
+            started = monotonic()
+            try:
+                response = endpoint.session.post(
+                    endpoint.uri,
+                    data=data,
+                    headers=self.get_request_headers(),
+                    timeout=self._timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    response.raise_for_status()
+                    endpoint.observe_success(monotonic() - started)
+                    return response.content, endpoint
+                error = requests.HTTPError(f"{response.status_code} from {endpoint}", response=response)
+
+            endpoint.observe_failure()
+            logger.warning(f"Request to {endpoint} failed ({error}), retrying...")
+            last_endpoint, last_error = endpoint, error
+        raise last_error
+
+    def post(self, data: bytes, weight: int = 1) -> bytes:
+        # The weight is the number of calls in a JSON-RPC batch, which providers count separately
+        return self._post(data, weight)[0]
+
+    def _finalized_block(self) -> Optional[int]:
+        # Until a head was seen, no block is known to be final
+        heads = [endpoint.head_block_number for endpoint in self._endpoints if endpoint.head_block_number is not None]
+        return max(heads) - self._cache_confirmations if heads else None
+
+    def cached_responses(self, calls: List[Tuple[str, list]]) -> List[Optional[RPCResponse]]:
+        if self._cache is None:
+            return [None] * len(calls)
+        keys = [cache_key(method, params) for method, params in calls]
+        found = self._cache.get_many([key for key in keys if key is not None])
+        return [{"jsonrpc": "2.0", "id": None, "result": found[key]} if key in found else None for key in keys]
+
+    def store_responses(self, calls: List[Tuple[str, list]], responses: List[RPCResponse]):
+        if self._cache is None:
+            return
+        finalized_block = self._finalized_block()
+        items = []
+        for (method, params), response in zip(calls, responses):
+            key = cache_key(method, params)
+            if key is not None and "result" in response and is_final(method, params, response["result"], finalized_block):
+                items.append((key, response["result"]))
+        self._cache.put_many(items)
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        cached = self.cached_responses([(method, params)])[0]
+        if cached is not None:
+            observe_rpc([], 0, cached=[method])
+            return cached
+
+        started = monotonic()
+        raw_response, endpoint = self._post(self.encode_rpc_request(method, params), 1)
+        observe_rpc([method], monotonic() - started)
+        response = self.decode_rpc_response(raw_response)
+        if method == "eth_blockNumber" and "result" in response:
+            endpoint.head_block_number = int(response["result"], 16)
+        self.store_responses([(method, params)], [response])
+        return response
+
+
+_web3_client: Optional[Web3] = None
+_web3_client_lock = threading.Lock()
+
+
+def get_web3_client() -> Web3:
+    # A single client per process, so that every caller shares the connection pools and the rate limit
+    global _web3_client
+    with _web3_client_lock:
+        if _web3_client is None:
+            _web3_client = Web3(PooledHTTPProvider(
+                settings.RPC_ENDPOINTS or [settings.INFURA_URL],
+                requests_per_second=settings.RPC_REQUESTS_PER_SECOND,
+                burst=settings.RPC_BURST,
+                max_retries=settings.RPC_MAX_RETRIES,
+                timeout=settings.RPC_TIMEOUT,
+                pool_size=settings.RPC_POOL_SIZE,
+                cache=ChainDataCache(
+                    settings.CHAIN_CACHE_PATH,
+                    settings.CHAIN_CACHE_MAX_BYTES
+                ) if settings.CHAIN_CACHE_PATH else None,
+                cache_confirmations=settings.CHAIN_CACHE_CONFIRMATIONS,
+                head_probe_interval=settings.RPC_HEAD_PROBE_INTERVAL
+            ))
+        return _web3_client
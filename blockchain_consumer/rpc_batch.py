@@ -0,0 +1,167 @@
+import itertools
+import json
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Generator, Iterator, List, Optional, Tuple
+
+from web3 import Web3
+from web3._utils.method_formatters import PYTHONIC_RESULT_FORMATTERS
+from web3._utils.request import make_post_request
+from web3.datastructures import AttributeDict
+from web3.exceptions import BlockNotFound
+from web3.providers import HTTPProvider
+from web3.types import BlockData
+
+from blockchain_consumer.metrics import observe_rpc, observe_stage
+from blockchain_consumer.rpc import PooledHTTPProvider
+
+
+def _batch_payload(calls: List[Tuple[str, list]], request_ids: Iterator[int]) -> List[dict]:
+    return [
+        {"jsonrpc": "2.0", "method": method, "params": params, "id": next(request_ids)}
+        for method, params in calls
+    ]
+
+
+def _batch_responses(payload: List[dict], raw_response: bytes) -> List[dict]:
+    responses = json.loads(raw_response)
+    if isinstance(responses, dict):
+        # The whole batch was rejected
+        raise ValueError(responses.get("error", responses))
+
+    # Batch responses may come back in any order
+    responses_by_id = {response["id"]: response for response in responses}
+    return [responses_by_id.get(request["id"], {"error": "Missing response"}) for request in payload]
+
+
+def _format_results(calls: List[Tuple[str, list]], responses: List[dict]) -> List[Any]:
+    results = []
+    for (method, _), response in zip(calls, responses):
+        if "error" in response:
+            raise ValueError(response["error"])
+        formatter = PYTHONIC_RESULT_FORMATTERS.get(method)
+        result = formatter(response["result"]) if formatter else response["result"]
+        results.append(AttributeDict.recursive(result))
+    return results
+
+
+class BatchRpcClient:
+    def __init__(self, web3_client: Web3):
+        self._provider = web3_client.provider
+        self._request_ids = itertools.count()
+
+    def _send(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        if not isinstance(self._provider, HTTPProvider):
+            # Only HTTP endpoints accept JSON-RPC batches, fall back to one request per call
+            return [self._provider.make_request(method, params) for method, params in calls]
+
+        if isinstance(self._provider, PooledHTTPProvider):
+            return self._send_pooled(calls)
+
+        payload = _batch_payload(calls, self._request_ids)
+        started = monotonic()
+        raw_response = make_post_request(
+            self._provider.endpoint_uri,
+            json.dumps(payload).encode(),
+            **self._provider.get_request_kwargs()
+        )
+        observe_rpc([method for method, _ in calls], monotonic() - started)
+        return _batch_responses(payload, raw_response)
+
+    def _send_pooled(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        # Calls about finalized blocks are answered from the local cache, only the others are sent
+        responses = self._provider.cached_responses(calls)
+        missing = [index for index, response in enumerate(responses) if response is None]
+        cached_methods = [method for (method, _), response in zip(calls, responses) if response is not None]
+        if not missing:
+            observe_rpc([], 0, cached=cached_methods)
+            return responses
+
+        missing_calls = [calls[index] for index in missing]
+        payload = _batch_payload(missing_calls, self._request_ids)
+        # Goes through the shared connection pools, rate limit and failover
+        started = monotonic()
+        raw_response = self._provider.post(json.dumps(payload).encode(), weight=len(missing_calls))
+        observe_rpc([method for method, _ in missing_calls], monotonic() - started, cached=cached_methods)
+        fetched = _batch_responses(payload, raw_response)
+        self._provider.store_responses(missing_calls, fetched)
+        for index, response in zip(missing, fetched):
+            responses[index] = response
+        return responses
+
+    def call_many(self, calls: List[Tuple[str, list]]) -> List[Any]:
+        if not calls:
+            return []
+        return _format_results(calls, self._send(calls))
+
+    def call(self, method: str, params_list: List[list]) -> List[Any]:
+        return self.call_many([(method, params) for params in params_list])
+
+    def send_many(self, calls: List[Tuple[str, list]]) -> List[dict]:
+        # Raw responses, so that an error in one call doesn't hide the outcome of the others
+        if not calls:
+            return []
+        return self._send(calls)
+
+
+def without_transactions(header: BlockData) -> BlockData:
+    # Stands in for a block whose transactions can't concern any processor
+    return AttributeDict({**header, "transactions": []})
+
+
+def merge_prefiltered(headers: List[BlockData], blocks: List[BlockData]) -> List[BlockData]:
+    blocks_by_number = {block["number"]: block for block in blocks}
+    return [blocks_by_number.get(header["number"]) or without_transactions(header) for header in headers]
+
+
+class BatchBlockSource:
+    def __init__(
+        self,
+        web3_client: Web3,
+        window: int = 20,
+        prefilter: Optional[Callable[[List[BlockData]], List[bool]]] = None
+    ):
+        self._rpc = BatchRpcClient(web3_client)
+        self._window = window
+        self.set_prefilter(prefilter)
+
+    def set_prefilter(self, prefilter: Optional[Callable[[List[BlockData]], List[bool]]]):
+        # Tells from the headers which blocks need their transactions, the others are never downloaded in full
+        self._prefilter = prefilter
+
+    def _get_blocks(self, block_numbers: List[int], full_transactions: bool) -> List[BlockData]:
+        if not block_numbers:
+            return []
+        blocks = self._rpc.call(
+            "eth_getBlockByNumber",
+            [[hex(block_number), full_transactions] for block_number in block_numbers]
+        )
+        for block_number, block in zip(block_numbers, blocks):
+            if block is None:
+                raise BlockNotFound(f"Block with id: '{block_number}' not found.")
+        return blocks
+
+    def get_blocks(self, block_numbers: List[int]) -> List[BlockData]:
+        with observe_stage("fetch"):
+            if self._prefilter is None:
+                return self._get_blocks(block_numbers, full_transactions=True)
+            headers = self._get_blocks(block_numbers, full_transactions=False)
+            needed = [header["number"] for header, needs in zip(headers, self._prefilter(headers)) if needs]
+            return merge_prefiltered(headers, self._get_blocks(needed, full_transactions=True))
+
+    def iter_blocks(self, from_block: int, to_block: int) -> Generator[BlockData, None, None]:
+        windows = [
+            list(range(start, min(start + self._window, to_block + 1)))
+            for start in range(from_block, to_block + 1, self._window)
+        ]
+        if not windows:
+            return
+
+        # While the blocks of one window are being processed, the next window is already being downloaded
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(self.get_blocks, windows[0])
+            for next_window in windows[1:] + [None]:
+                blocks = pending.result()
+                if next_window is not None:
+                    pending = executor.submit(self.get_blocks, next_window)
+                yield from blocks
@@ -0,0 +1,161 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+from django.db import connection
+from web3.types import BlockData
+
+from Wallet.models import BlockCheckpoint
+from blockchain_consumer.dispatcher import BlockDispatcher
+from blockchain_consumer.metrics import PENDING_TRANSACTIONS, block_profiler, observe_stage
+from blockchain_consumer.routing import Route
+from blockchain_consumer.rpc_batch import BatchBlockSource
+from blockchain_consumer.transaction_processor import TransactionProcessor
+
+logger = logging.getLogger(__name__)
+
+RoutedBlock = Tuple[BlockData, Dict[Route, list]]
+
+
+class BlockCache:
+    # Recently fetched blocks, already routed, shared by all processor runners so that every block
+    # is only downloaded and classified once
+    def __init__(self, block_source: BatchBlockSource, dispatcher: BlockDispatcher, size: int = 128):
+        self._block_source = block_source
+        self._dispatcher = dispatcher
+        self._size = size
+        self._blocks: Dict[int, RoutedBlock] = OrderedDict()
+        self._head: Optional[int] = None
+        self._condition = threading.Condition()
+
+    def add(self, block: BlockData, routed: Dict[Route, list]):
+        with self._condition:
+            self._blocks[block["number"]] = (block, routed)
+            while len(self._blocks) > self._size:
+                self._blocks.popitem(last=False)
+            self._head = block["number"]
+            self._condition.notify_all()
+
+    def rewind(self, block_number: int):
+        with self._condition:
+            for number in [number for number in self._blocks if number > block_number]:
+                del self._blocks[number]
+            if self._head is not None:
+                self._head = min(self._head, block_number)
+
+    def get(self, block_number: int, timeout: Union[int, float]) -> Optional[RoutedBlock]:
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._head is not None and self._head >= block_number,
+                timeout=timeout
+            ):
+                return None
+            routed_block = self._blocks.get(block_number)
+        if routed_block is None:
+            # The runner fell further behind than the cache reaches, it catches up on its own
+            block = self._block_source.get_blocks([block_number])[0]
+            routed_block = (block, self._dispatcher.route_block(block))
+        return routed_block
+
+
+class ProcessorRunner:
+    # Runs a single processor on its own thread, so a slow or failing processor doesn't hold back the others.
+    # The last block the processor handled is stored as its cursor, and it retries from there on failure.
+    CURSOR_PREFIX = "processor:"
+
+    def __init__(
+        self,
+        processor: TransactionProcessor,
+        dispatcher: BlockDispatcher,
+        cache: BlockCache,
+        retry_delay: Union[int, float] = 5,
+        max_retry_delay: Union[int, float] = 300
+    ):
+        self._processor = processor
+        self._scheduler = dispatcher.scheduler(processor)
+        self._cache = cache
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # Bumped on every rewind, so blocks read from the cache before a rewind are not processed after it
+        self._generation = 0
+        self.cursor: Optional[int] = None
+
+    @property
+    def processor(self) -> TransactionProcessor:
+        return self._processor
+
+    @property
+    def cursor_name(self) -> str:
+        return self.CURSOR_PREFIX + self._processor.name
+
+    def load_cursor(self) -> Optional[int]:
+        self.cursor = BlockCheckpoint.load(self.cursor_name)
+        return self.cursor
+
+    def set_cursor(self, block_number: int):
+        self.cursor = block_number
+        BlockCheckpoint.store(self.cursor_name, block_number)
+
+    def rewind(self, block_number: int) -> int:
+        # Waits for the block being processed, if any, before dropping the orphaned transactions
+        with self._lock:
+            self._generation += 1
+            if self.cursor is not None and self.cursor > block_number:
+                self.set_cursor(block_number)
+            return self._scheduler.rollback(block_number)
+
+    def _process(self, block: BlockData, transactions: list):
+        block_number = block["number"]
+        records = self._processor.filter(block, transactions)
+        with observe_stage("confirm", self._processor.name):
+            self._scheduler.ensure_loaded()
+            self._scheduler.add(records)
+            due = self._scheduler.pop_due(block_number)
+        PENDING_TRANSACTIONS.set(len(self._scheduler), processor=self._processor.name)
+        if not due:
+            return
+        try:
+            self._processor.persist(due)
+        except Exception:
+            # Processing the block again pops the transactions again
+            self._scheduler.retry(due, block_number)
+            raise
+        self._scheduler.complete(due)
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            block_number, generation = self.cursor + 1, self._generation
+            try:
+                # Routing a block the cache no longer holds fetches it again, which can fail too
+                routed_block = self._cache.get(block_number, timeout=1)
+                if routed_block is None:
+                    continue
+
+                block, routed = routed_block
+                with self._lock:
+                    if generation != self._generation:
+                        # Rewound by a chain reorganization in the meantime
+                        continue
+                    with block_profiler().profile():
+                        self._process(block, routed[self._processor.ROUTE])
+                    self.set_cursor(block_number)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.exception(f"{self._processor.name} failed to process block {block_number}: {e}")
+            if failures:
+                self._stopped.wait(min(self._retry_delay * 2 ** (failures - 1), self._max_retry_delay))
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            # Runner threads get their own database connection, which Django won't close for us
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
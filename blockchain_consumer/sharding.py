@@ -0,0 +1,28 @@
+import hashlib
+from typing import Optional
+
+
+class Shard:
+    # Watched accounts are split between consumers by ranges of the hash of their address,
+    # so every account is tracked by exactly one of them
+    def __init__(self, index: int = 0, count: int = 1):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard index {index} is out of range for {count} shards.")
+        self.index = index
+        self.count = count
+
+    def __str__(self) -> str:
+        return f"{self.index + 1}/{self.count}"
+
+    @property
+    def suffix(self) -> str:
+        # Appended to the names of checkpoints and pending transactions, so shards don't share them
+        return "" if self.count == 1 else f"@{self.index}/{self.count}"
+
+    def owns(self, address: Optional[str]) -> bool:
+        if self.count == 1:
+            return True
+        if not address:
+            return False
+        address_hash = int.from_bytes(hashlib.sha256(address.lower().encode()).digest()[:8], "big")
+        return address_hash * self.count >> 64 == self.index
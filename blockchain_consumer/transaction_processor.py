@@ -1,18 +1,38 @@
 import logging
 from abc import ABCMeta, abstractmethod
-from typing import Dict, Any, Tuple, List
+from typing import Dict, List, Optional, Type
 
+from django.conf import settings
+from hexbytes import HexBytes
 from web3 import Web3
+from web3.datastructures import AttributeDict
 from web3.types import TxData, BlockData
 
+from Wallet.models import Account, Token, Transaction
+from blockchain_consumer.balances import BalanceFetcher
+from blockchain_consumer.confirmations import PendingRecord
+from blockchain_consumer.ledger import persist_ledger_transactions
+from blockchain_consumer.metrics import observe_stage
+from blockchain_consumer.persistence import BalanceKey, persist_transactions
+from blockchain_consumer.routing import Route, route_transactions
+from blockchain_consumer.rpc_batch import BatchRpcClient
+from blockchain_consumer.sharding import Shard
+from blockchain_consumer.watch_index import watch_index
+
 
 class TransactionProcessor(metaclass=ABCMeta):
     CONFIRMATIONS_REQUIRED = 6
+    # Only transactions matching every flag of the route are handed to the processor
+    ROUTE = Route.ANY
+    # Model the processed transactions are stored in
+    TRANSACTION_MODEL: Type[Transaction] = None
     _logger = None
 
-    def __init__(self, web3_client: Web3):
-        self._unconfirmed_transactions: Dict[TxData, Dict[str, Any]] = {}
+    def __init__(self, web3_client: Web3, shard: Optional[Shard] = None):
         self._web3_client = web3_client
+        self._balance_fetcher = BalanceFetcher(web3_client)
+        self._rpc = BatchRpcClient(web3_client)
+        self._shard = shard or Shard()
 
     @classmethod
     def _get_logger(cls) -> logging.Logger:
@@ -20,33 +40,96 @@ class TransactionProcessor(metaclass=ABCMeta):
             cls._logger = logging.getLogger(cls.__name__)
         return cls._logger
 
-    def process_block(self, block: BlockData):
-        self._unconfirmed_transactions |= {
-            transaction: {
-                "block_number": block["number"],
-                "args": args,
-                "kwargs": kwargs
-            }
-            for transaction, args, kwargs in self._filter_transactions(block)
-        }
-        if self._unconfirmed_transactions:
-            self.__class__._get_logger().info(f"{len(self._unconfirmed_transactions)} pending transactions.")
-
-        confirmed_transactions = set()
-        for transaction, tx_info in self._unconfirmed_transactions.items():
-            tx_block_number, args, kwargs = tx_info["block_number"], tx_info["args"], tx_info["kwargs"]
-            if block["number"] - tx_block_number >= self.CONFIRMATIONS_REQUIRED:
-                self.__class__._get_logger().info(f"Transaction {transaction['hash']} received {self.CONFIRMATIONS_REQUIRED} confirmations!")
-                confirmed_transactions.add(transaction)
-                self._process_transaction(transaction, *args, **kwargs)
-
-        for transaction in confirmed_transactions:
-            del self._unconfirmed_transactions[transaction]
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__ + self._shard.suffix
+
+    def _record(
+        self,
+        transaction: TxData,
+        account_id: int,
+        counterparty: str,
+        amount: int,
+        token_id: Optional[int] = None
+    ) -> PendingRecord:
+        return PendingRecord(
+            self.name,
+            transaction["hash"],
+            transaction["blockNumber"],
+            account_id,
+            token_id,
+            counterparty,
+            amount,
+            # Transfers read from the logs, a transaction can emit several of them
+            transaction.get("logIndex")
+        )
+
+    def filter(self, block: BlockData, transactions: Optional[List[TxData]] = None) -> List[PendingRecord]:
+        if transactions is None:
+            if self.ROUTE & Route.TRANSFER_LOG:
+                raise ValueError(f"{self.name} needs the block's transfers to be passed in.")
+            watch_index.ensure_current()
+            transactions = route_transactions(block["transactions"], self.ROUTE)
+        with observe_stage("filter", self.name):
+            return self._filter_transactions(block, transactions)
+
+    def persist(self, records: List[PendingRecord]):
+        if not records:
+            return
+        with observe_stage("persist", self.name):
+            self._persist(records)
+
+    def _persist(self, records: List[PendingRecord]):
+        accounts = Account.objects.in_bulk({record.account_id for record in records})
+        tokens = Token.objects.in_bulk({record.token_id for record in records if record.token_id is not None})
+
+        transactions, balance_keys = [], []
+        for record in records:
+            account = accounts.get(record.account_id)
+            token = tokens.get(record.token_id)
+            if account is None or (record.token_id is not None and token is None):
+                # The account or the token was deleted while the transaction was pending
+                continue
+
+            self._get_logger().info(f"Processing transaction {HexBytes(record.transaction_hash).hex()}")
+            transaction = self._build_transaction(record, account, token)
+            transaction.block_number = record.block_number
+            transaction.log_index = record.log_index
+            transactions.append(transaction)
+            balance_keys.append((account, token))
+
+        if settings.BALANCE_MODE == "ledger":
+            # Balances are added up from the stored transactions, without asking the chain
+            balance_keys = self._prepare_ledger(transactions, balance_keys)
+            persist_ledger_transactions(self.TRANSACTION_MODEL, transactions, balance_keys)
+        else:
+            # All balances touched by the block are refreshed with a single JSON-RPC batch
+            persist_transactions(self.TRANSACTION_MODEL, transactions, self._balance_fetcher.fetch(balance_keys))
+
+    def _prepare_ledger(self, transactions: List[Transaction], balance_keys: List[BalanceKey]) -> List[BalanceKey]:
+        # Completes the transactions with what the ledger needs, and returns the balances they change.
+        # Transfers read from the logs were emitted by successful transactions, only the others can have failed
+        self._receipts([transaction for transaction in transactions if transaction.log_index is None])
+        return balance_keys
+
+    def _receipts(self, transactions: List[Transaction]) -> Dict[str, Optional[AttributeDict]]:
+        # By transaction hash, the transfers of a transaction share its receipt. A failed transaction is still
+        # mined, but moves nothing, so it's recorded with a zero amount
+        transaction_hashes = list(dict.fromkeys(HexBytes(transaction.transaction_hash).hex() for transaction in transactions))
+        receipts = dict(zip(
+            transaction_hashes,
+            self._rpc.call("eth_getTransactionReceipt", [[transaction_hash] for transaction_hash in transaction_hashes])
+        ))
+        for transaction in transactions:
+            receipt = receipts[HexBytes(transaction.transaction_hash).hex()]
+            if receipt is not None and receipt["status"] == 0:
+                transaction.amount_wei = 0
+        return receipts
 
     @abstractmethod
-    def _filter_transactions(self, block: BlockData) -> List[Tuple[TxData, list, dict]]:
+    def _filter_transactions(self, block: BlockData, transactions: List[TxData]) -> List[PendingRecord]:
         pass
 
     @abstractmethod
-    def _process_transaction(self, transaction_raw: TxData, *args, **kwargs):
+    def _build_transaction(self, record: PendingRecord, account: Account, token: Optional[Token]) -> Transaction:
         pass
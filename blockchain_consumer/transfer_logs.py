@@ -0,0 +1,54 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from eth_utils import to_checksum_address
+from web3 import Web3
+from web3.datastructures import AttributeDict
+from web3.types import LogReceipt
+
+from blockchain_consumer.bloom import TRANSFER_TOPIC
+from blockchain_consumer.watch_index import watch_index
+
+
+def decode_transfer(log: LogReceipt) -> Optional[AttributeDict]:
+    # ERC721 transfers share the event signature, but index the token id as a 4th topic
+    if len(log["topics"]) != 3 or len(log["data"]) < 3:
+        return None
+
+    return AttributeDict({
+        "hash": log["transactionHash"],
+        "blockNumber": log["blockNumber"],
+        "logIndex": log["logIndex"],
+        "token": log["address"],
+        # Indexed addresses are left-padded to 32 bytes
+        "from": to_checksum_address(log["topics"][1][-20:]),
+        "to": to_checksum_address(log["topics"][2][-20:]),
+        "value": int(log["data"], 16),
+    })
+
+
+class TransferLogSource:
+    def __init__(self, web3_client: Web3):
+        self._client = web3_client
+
+    def get_transfers(self, from_block: int, to_block: int) -> Dict[int, List[AttributeDict]]:
+        token_addresses = watch_index.token_addresses()
+        if not token_addresses:
+            return {}
+
+        # A single filtered request covers every watched token in the whole range
+        logs = self._client.eth.get_logs({
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "address": token_addresses,
+            "topics": [TRANSFER_TOPIC.hex()],
+        })
+
+        transfers = defaultdict(list)
+        for log in logs:
+            if log.get("removed"):
+                continue
+            transfer = decode_transfer(log)
+            if transfer is not None:
+                transfers[transfer["blockNumber"]].append(transfer)
+        return transfers
@@ -0,0 +1,139 @@
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from web3 import Web3
+
+from Wallet.models import Account, Token
+from blockchain_consumer.bloom import TransferBloom
+from blockchain_consumer.sharding import Shard
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_address(address: Optional[str]) -> Optional[str]:
+    return address.lower() if address else None
+
+
+class WatchIndex:
+    # Changes made in this process are applied immediately through model signals.
+    # Changes made by other processes, or through bulk operations that don't send signals,
+    # are picked up by ensure_current(), which compares a cheap fingerprint of both tables.
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Normalized address -> primary key
+        self._accounts: Dict[str, int] = {}
+        self._tokens: Dict[str, int] = {}
+        self._fingerprint: Optional[Tuple] = None
+        # Built from the addresses on first use, and dropped whenever they change
+        self._bloom: Optional[TransferBloom] = None
+        # Only the accounts owned by this shard are watched, tokens are watched by every shard
+        self._shard = Shard()
+
+    def set_shard(self, shard: Shard):
+        with self._lock:
+            self._shard = shard
+            self._fingerprint = None
+
+    @staticmethod
+    def _current_fingerprint() -> Tuple:
+        accounts = Account.objects.aggregate(count=Count("pk"), last=Max("pk"))
+        tokens = Token.objects.aggregate(count=Count("pk"), last=Max("pk"))
+        return accounts["count"], accounts["last"], tokens["count"], tokens["last"]
+
+    def reload(self):
+        with self._lock:
+            self._fingerprint = self._current_fingerprint()
+            self._accounts = {
+                normalize_address(public_key): pk
+                for pk, public_key in Account.objects.values_list("pk", "public_key").iterator()
+                if self._shard.owns(public_key)
+            }
+            self._tokens = {
+                normalize_address(contract_address): pk
+                for pk, contract_address in Token.objects.values_list("pk", "contract_address")
+            }
+            self._bloom = None
+        if self._shard.count > 1:
+            logger.info(f"Watching {len(self._accounts)} accounts of shard {self._shard} and {len(self._tokens)} tokens.")
+        else:
+            logger.info(f"Watching {len(self._accounts)} accounts and {len(self._tokens)} tokens.")
+
+    def ensure_current(self):
+        if self._fingerprint is None or self._current_fingerprint() != self._fingerprint:
+            self.reload()
+
+    def has_account(self, address: Optional[str]) -> bool:
+        return normalize_address(address) in self._accounts
+
+    def has_token(self, address: Optional[str]) -> bool:
+        return normalize_address(address) in self._tokens
+
+    def account_id(self, address: Optional[str]) -> Optional[int]:
+        return self._accounts.get(normalize_address(address))
+
+    def token_id(self, address: Optional[str]) -> Optional[int]:
+        return self._tokens.get(normalize_address(address))
+
+    def may_have_transfer(self, logs_bloom: bytes) -> bool:
+        with self._lock:
+            if self._fingerprint is None:
+                # Not loaded yet, which happens when routing the first block, so nothing can be ruled out
+                return True
+            if self._bloom is None:
+                self._bloom = TransferBloom(self._tokens, self._accounts)
+            bloom = self._bloom
+        return bloom.may_contain_transfer(logs_bloom)
+
+    def token_addresses(self) -> List[str]:
+        with self._lock:
+            return [Web3.toChecksumAddress(address) for address in self._tokens]
+
+    def add_account(self, address: str, pk: int):
+        with self._lock:
+            if self._shard.owns(address):
+                self._accounts[normalize_address(address)] = pk
+                self._bloom = None
+
+    def remove_account(self, address: str):
+        with self._lock:
+            self._accounts.pop(normalize_address(address), None)
+            self._bloom = None
+
+    def add_token(self, address: str, pk: int):
+        with self._lock:
+            self._tokens[normalize_address(address)] = pk
+            self._bloom = None
+
+    def remove_token(self, address: str):
+        with self._lock:
+            self._tokens.pop(normalize_address(address), None)
+            self._bloom = None
+
+
+watch_index = WatchIndex()
+
+
+@receiver(post_save, sender=Account)
+def _account_saved(sender, instance: Account, created: bool, **kwargs):
+    if created:
+        watch_index.add_account(instance.public_key, instance.pk)
+
+
+@receiver(post_delete, sender=Account)
+def _account_deleted(sender, instance: Account, **kwargs):
+    watch_index.remove_account(instance.public_key)
+
+
+@receiver(post_save, sender=Token)
+def _token_saved(sender, instance: Token, created: bool, **kwargs):
+    if created:
+        watch_index.add_token(instance.contract_address, instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def _token_deleted(sender, instance: Token, **kwargs):
+    watch_index.remove_token(instance.contract_address)